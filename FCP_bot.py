@@ -1,18 +1,42 @@
 
+import time
+AVVIO = time.perf_counter()  # per misurare il tempo dall'avvio al primo update gestito
+
+import os
+import signal
+import asyncio
 import json
-import uuid
-import re
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+import functools
+from array import array
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.helpers import escape_markdown
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, InlineQueryHandler, MessageHandler, TypeHandler, filters
+from archivio_indice import StatoArchivio, carica_archivio, carica_json, id_breve, leggi_snapshot
+from cache_lru import CacheLRU
+from esecutore import EsecutoreCPU, Sovraccarico
+from processore_update import ProcessoreUpdatePerChat, chiave_click
+from limitatore_invii import LimitatoreInvii
+from metriche import registro
+from log_strutturato import configura_logging
+from smistatore import Smistatore, invia_messaggio, leggi_messaggio
+from popolari import ContatorePopolari, carica_popolari, salva_popolari
 
 # Inserisci qui il tuo TOKEN
 token = "inserisci qui il tuo token"
 
-# Configura il logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
+# Configura il logging: i record passano da una coda e un thread li scrive sulla console e,
+# se LOG_FILE_JSON è impostato, in un file con una riga JSON per record (per le analisi).
+# LOG_CAMPIONAMENTO: frazione degli eventi frequenti da tenere (avvisi ed errori si tengono sempre)
+LOG_LIVELLO = logging.INFO
+LOG_FILE_JSON = "bot_eventi.jsonl"
+LOG_CAMPIONAMENTO = {"naviga": 0.1, "inline": 0.05}
+LOG_FORMATO = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+configura_logging(
+    LOG_LIVELLO,
+    formato_testo=LOG_FORMATO,
+    file_json=LOG_FILE_JSON,
+    campionamento=LOG_CAMPIONAMENTO,
 )
 logger = logging.getLogger(__name__)
 
@@ -20,152 +44,474 @@ logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 
-# ordine numerico e alfabetico
-def sort_key(titolo):
-    match = re.match(r"(\d+)", titolo)
-    if match:
-        return (int(match.group(1)), titolo.lower())
-    return (float('inf'), titolo.lower())
-
-
-id_to_path = {}
-path_to_id = {}
-mail_id_to_path = {}
-mail_path_to_id = {}
-
-# Mappa: ID breve per il file archivio.json
-def get_or_create_id(percorso):
-    key = "::".join(percorso)
-    if key in path_to_id:
-        return path_to_id[key]
-    new_id = str(uuid.uuid4())[:8]
-    path_to_id[key] = new_id
-    id_to_path[new_id] = percorso
-    return new_id
-
-# Mappa: ID breve per il file email.json
-def get_or_create_mail_id(percorso):
-    key = "::".join(percorso)
-    if key in mail_path_to_id:
-        return mail_path_to_id[key]
-    new_id = str(uuid.uuid4())[:8]
-    mail_path_to_id[key] = new_id
-    mail_id_to_path[new_id] = percorso
-    return new_id
-
-# Carico archivio.json
-with open("archivio.json", "r", encoding="utf-8") as f:
-    archivio = json.load(f)
-
-# Carico emails.json:
-with open("emails.json", "r", encoding="utf-8") as f:
-    rubrica = json.load(f)
-
-# Recupero cartella da percorso
-def get_folder_from_path(path, current_folder):
-    for p in path:
-        current_folder = current_folder["subfolders"].get(p)
-        if current_folder is None:
-            return None
-    return current_folder
+# File dati e ricaricamento a caldo
+PERCORSO_ARCHIVIO = "archivio.json"
+PERCORSO_RUBRICA = "emails.json"
+# Snapshot binario generato da crea_archivio_conTag.py / crea_snapshot.py (se manca o è vecchio uso il JSON)
+PERCORSO_SNAPSHOT = "archivio.snapshot"
+# Utenti Telegram autorizzati a usare /ricarica (lista di id numerici)
+ADMIN_IDS = []
+# Ogni quanti secondi controllare se i file sono cambiati (0 = solo con /ricarica)
+RICARICA_INTERVALLO = 60
 
-# Creazione tastiera di navigazione
-ELEMENTI_PER_PAGINA = 10
+# Ordine dei risultati di /cerca: "rilevanza" (i più pertinenti prima) o "alfabetico" (per titolo)
+ORDINAMENTO_RICERCA = "rilevanza"
+# Con "rilevanza" calcolo subito i risultati di questo numero di pagine (poi, se servono, altri)
+PAGINE_PER_RICERCA = 5
 
-def genera_keyboard(cartella_corrente, percorso_attuale, page=0):
-    keyboard = []
-    items = []
+# Cache dei risultati: ID breve -> posizioni dei file trovati, già ordinate. Limite sul numero totale
+# di file tenuti (4 byte l'uno nell'array): con l'ordine alfabetico ogni ricerca tiene tutti i suoi risultati
+RISULTATI_CACHE_FILE = 500_000
+RISULTATI_CACHE_TTL = 15 * 60  # secondi
+# Tastiere di navigazione già costruite per (cartella, pagina)
+TASTIERE_CACHE_MAX = 4096
+
+# Ricerche e tastiere più richieste: contate mentre il bot lavora e salvate in POPOLARI_FILE
+# (ogni POPOLARI_SALVATAGGIO secondi e all'arresto), con i conteggi che si dimezzano ogni POPOLARI_EMIVITA
+# secondi. All'avvio e a ogni ricaricamento le prime RISCALDA_QUERY ricerche e RISCALDA_TASTIERE tastiere
+# vengono calcolate subito, così i primi utenti le trovano già in cache (0 = non riscaldare)
+POPOLARI_FILE = "popolari.json"
+POPOLARI_SALVATAGGIO = 300
+POPOLARI_CAPACITA = 2000
+POPOLARI_EMIVITA = 7 * 24 * 3600
+RISCALDA_QUERY = 200
+RISCALDA_TASTIERE = 500
+
+# Docenti mostrati al massimo da /mail <nome o materia> (oltre si chiede di aggiungere parole)
+MAIL_RISULTATI_MAX = 20
+
+# Ricerca inline (@bot query): risultati per risposta (max 50), secondi di cache lato Telegram,
+# attesa prima di rispondere (se nel frattempo l'utente ha scritto altro la query viene scartata)
+INLINE_RISULTATI = 20
+INLINE_CACHE_TIME = 300
+INLINE_ATTESA = 0.3
+# Cache delle query inline: query normalizzata -> id di tutti i file trovati. Limite sul numero totale
+# di id tenuti (8 byte l'uno nella lista, quindi ~8 MB), perché i prefissi corti corrispondono a quasi
+# tutto l'archivio; una sola query ne occupa al massimo INLINE_CACHE_VOCE_MAX, oltre si ricalcola
+INLINE_CACHE_ID = 1_000_000
+INLINE_CACHE_VOCE_MAX = INLINE_CACHE_ID // 10
+INLINE_CACHE_TTL = 10 * 60  # secondi
+# Se una query più corta in cache ha al massimo tanti risultati, filtro quelli invece di usare l'indice
+INLINE_FILTRA_MAX = 5000
+
+# Dove eseguire ricerca e costruzione delle tastiere: "thread", "processo" o "diretta" (nel loop)
+ESECUZIONE = "thread"
+ESECUZIONE_WORKER = 4
+# Lavori in coda oltre i quali le nuove richieste vengono rifiutate, e timeout per richiesta (secondi)
+ESECUZIONE_CODA_MAX = 64
+ESECUZIONE_TIMEOUT = 10
+
+# Ricezione degli update: "polling" (long polling, come prima) o "webhook" (server HTTP locale)
+MODALITA_UPDATE = "polling"
+# Webhook: indirizzo e porta su cui ascoltare, percorso dell'URL e URL pubblico da registrare
+# su Telegram (es. "https://esempio.it/telegram" dietro un proxy HTTPS). Il segreto, se impostato,
+# deve arrivare nell'header X-Telegram-Bot-Api-Secret-Token di ogni richiesta
+WEBHOOK_ASCOLTO = "127.0.0.1"
+WEBHOOK_PORTA = 8443
+WEBHOOK_PERCORSO = "telegram"
+WEBHOOK_URL = None
+WEBHOOK_SEGRETO = None
+# Update gestiti in parallelo (quelli della stessa chat restano in ordine, uno alla volta)
+# e update di una stessa chat in fila dietro a quello in corso: oltre, i nuovi vengono scartati
+UPDATE_CONCORRENTI = 16
+UPDATE_IN_ATTESA_CHAT = 32
+# Processi worker, solo in modalità webhook (0 = un solo processo). Con N > 0 questo processo carica
+# l'archivio, riceve il webhook e smista gli update a N worker creati con fork, che leggono la sua
+# immagine piatta di file e indice (dallo snapshot mappato in memoria) senza copiarla;
+# gli update di una chat vanno sempre allo stesso worker.
+# Ogni worker ha log JSON, file e porta delle metriche propri (METRICHE_PORTA + 1 + numero del worker)
+WORKER_PROCESSI = 0
+
+# Limiti di invio verso Telegram: messaggi al secondo in tutto, per chat privata (con raffica)
+# e al minuto per gruppo; tentativi dopo un errore 429 (retry_after)
+INVII_AL_SECONDO = 30
+INVII_CHAT_AL_SECONDO = 1
+INVII_CHAT_RAFFICA = 3
+INVII_GRUPPO_AL_MINUTO = 20
+INVII_TENTATIVI = 3
+
+# Metriche in formato Prometheus: endpoint HTTP locale (porta 0 = disattivato) e file scritto
+# alla ricezione di SIGUSR1 (kill -USR1 <pid>) e all'arresto
+METRICHE_ASCOLTO = "127.0.0.1"
+METRICHE_PORTA = 9108
+METRICHE_FILE = "metriche_bot.prom"
+# Ricerche più lente di così (secondi) finiscono nel log con la query
+RICERCA_LENTA = 0.5
+
+# Tutti i menu di /mail, costruiti una volta al caricamento: callback_data -> (testo, tastiera).
+# "mail:back" è l'elenco degli anni, "mail:<mid1>" le materie di un anno, "mail:<mid1>:<mid2>" i docenti
+def costruisci_menu_mail(rubrica, registro_mail):
+    menu = {}
+    anni = []
+    for anno, materie in rubrica.items():
+        mid1 = registro_mail.id([anno])
+        anni.append([InlineKeyboardButton(anno, callback_data=f"mail:{mid1}")])
+        righe_materie = []
+        for materia, profs in materie.items():
+            dati = f"mail:{mid1}:{registro_mail.id([anno, materia])}"
+            righe_materie.append([InlineKeyboardButton(materia, callback_data=dati)])
+            text = f"📧 *Rubrica* — _{anno} → {materia}_\n\n"
+            text += "\n".join(f"• *{n}*: `{e}`" for n, e in profs.items())
+            menu[dati] = (text, InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Materie", callback_data=f"mail:{mid1}"),
+                InlineKeyboardButton("🏠 Anni",    callback_data="mail:back")
+            ]]))
+        righe_materie.append([InlineKeyboardButton("🔙 Anni", callback_data="mail:back")])
+        menu[f"mail:{mid1}"] = (
+            f"📧 *Rubrica* — _{anno}_\n\nSeleziona la materia:", InlineKeyboardMarkup(righe_materie)
+        )
+    menu["mail:back"] = (
+        "📧 *Rubrica email docenti*\n\nSeleziona l'anno di corso:\n"
+        "_oppure cerca un docente o una materia: /mail rossi_",
+        InlineKeyboardMarkup(anni),
+    )
+    return menu
+
+# Carico l'archivio dallo snapshot (già indicizzato) se è aggiornato, altrimenti da archivio.json
+# in forma compatta costruendo indice, elenchi ordinati e registro; poi emails.json e le cache
+def carica_stato():
+    inizio = time.perf_counter()
+    archivio, derivati = None, leggi_snapshot(PERCORSO_SNAPSHOT, PERCORSO_ARCHIVIO)
+    if derivati is not None:
+        origine = PERCORSO_SNAPSHOT
+    else:
+        archivio = carica_archivio(PERCORSO_ARCHIVIO)
+        origine = PERCORSO_ARCHIVIO
+    stato = StatoArchivio(
+        archivio,
+        carica_json(PERCORSO_RUBRICA),
+        cache_risultati=CacheLRU(RISULTATI_CACHE_FILE, RISULTATI_CACHE_TTL, peso=lambda voce: len(voce[0])),
+        cache_tastiere=CacheLRU(TASTIERE_CACHE_MAX),
+        cache_inline=CacheLRU(INLINE_CACHE_ID, INLINE_CACHE_TTL, peso=len),
+        derivati=derivati,
+    )
+    stato.menu_mail = costruisci_menu_mail(stato.rubrica, stato.registro_mail)
+    logger.info("Archivio caricato da %s in %.2f s", origine, time.perf_counter() - inizio)
+    return stato
+
+# Data di modifica dei file dati (None se il file non c'è), per accorgersi di una nuova versione
+def firma_file():
+    return tuple(
+        os.stat(p).st_mtime_ns if os.path.exists(p) else None
+        for p in (PERCORSO_ARCHIVIO, PERCORSO_RUBRICA, PERCORSO_SNAPSHOT)
+    )
+
+# Stato in uso: viene sostituito in blocco da ricarica_stato, mai modificato.
+# Ogni handler lo legge una sola volta all'inizio.
+firma_caricata = firma_file()
+stato_corrente = carica_stato()
+
+# Code di invio verso Telegram (limiti di frequenza, retry_after)
+limitatore_invii = LimitatoreInvii(
+    INVII_AL_SECONDO, INVII_CHAT_AL_SECONDO, INVII_CHAT_RAFFICA, INVII_GRUPPO_AL_MINUTO, INVII_TENTATIVI
+)
 
-    # Cartelle ordinate
-    nomi_cartelle_ordinate = sorted(
-        cartella_corrente.get("subfolders", {}).keys(), key=sort_key
+# Click che sostituiscono il messaggio su cui sono stati fatti: in fila conta solo l'ultimo.
+# "🔍 Cerca qui" invece manda un messaggio nuovo e va sempre gestito
+def click_che_modifica(update):
+    if update.callback_query is not None and (update.callback_query.data or "").startswith("cercaqui:"):
+        return None
+    return chiave_click(update)
+
+# Update in parallelo, in ordine e con una fila limitata per ogni chat
+processore_chat = ProcessoreUpdatePerChat(UPDATE_CONCORRENTI, UPDATE_IN_ATTESA_CHAT, click_che_modifica)
+
+# Pool che esegue le funzioni pure (ricerca, tastiere) fuori dal loop asyncio
+esecutore = EsecutoreCPU(ESECUZIONE, ESECUZIONE_WORKER, ESECUZIONE_CODA_MAX, ESECUZIONE_TIMEOUT)
+
+# Ricerche (query normalizzata, cartella) e tastiere (cartella, pagina, tutti) più richieste:
+# non dipendono dall'archivio caricato, quindi sopravvivono ai ricaricamenti (e ai riavvii, tramite file)
+def nuovi_popolari():
+    return {
+        "query": ContatorePopolari(POPOLARI_CAPACITA, POPOLARI_EMIVITA),
+        "tastiere": ContatorePopolari(POPOLARI_CAPACITA, POPOLARI_EMIVITA),
+    }
+
+popolari = nuovi_popolari()
+if POPOLARI_FILE:
+    carica_popolari(POPOLARI_FILE, popolari)
+
+# Metriche del bot: durata di ogni handler e delle fasi (ricerca, tastiera = costruzione dei pulsanti);
+# l'invio a Telegram è misurato per metodo dal limitatore (fcp_telegram_secondi)
+LATENZA_HANDLER = registro.istogramma("fcp_handler_secondi", "Durata degli handler", ("handler",))
+LATENZA_FASE = registro.istogramma("fcp_fase_secondi", "Durata delle fasi di un handler", ("fase",))
+ERRORI = registro.contatore("fcp_errori_totale", "Errori durante la gestione degli update", ("tipo",))
+RICERCHE_LENTE = registro.contatore("fcp_ricerche_lente_totale", f"Ricerche più lente di {RICERCA_LENTA} s")
+
+# Decoratore degli handler: misura la durata (fcp_handler_secondi) e alla fine registra un evento
+# con utente, dati dell'update (testo, callback_data o query inline), esito e durata
+def gestore(evento):
+    def decoratore(funzione):
+        @functools.wraps(funzione)
+        async def avvolta(update, context):
+            inizio = time.perf_counter()
+            esito = "ok"
+            try:
+                return await funzione(update, context)
+            except Exception as e:
+                esito = type(e).__name__
+                raise
+            finally:
+                durata = time.perf_counter() - inizio
+                LATENZA_HANDLER.osserva(durata, handler=evento)
+                if logger.isEnabledFor(logging.INFO):
+                    log_evento(evento, update, esito, durata)
+        return avvolta
+    return decoratore
+
+def log_evento(evento, update, esito, durata):
+    user = update.effective_user
+    if update.callback_query is not None:
+        dati = update.callback_query.data
+    elif update.inline_query is not None:
+        dati = update.inline_query.query
+    elif update.effective_message is not None:
+        dati = update.effective_message.text
+    else:
+        dati = None
+    logger.info(
+        "User %s (%s) %s %r: %s in %.1f ms", user.id, user.username, evento, dati, esito, durata * 1000,
+        extra={
+            "evento": evento, "utente": user.id, "username": user.username, "dati": dati,
+            "esito": esito, "durata_ms": round(durata * 1000, 2),
+        },
     )
-    for nome_sottocartella in nomi_cartelle_ordinate:
-        nuovo_percorso = percorso_attuale + [nome_sottocartella]
-        short_id = get_or_create_id(nuovo_percorso)
-        items.append(("cartella", nome_sottocartella, short_id))
-
-    # File ordinati
-    files = sorted(
-        cartella_corrente.get("files", []), key=lambda f: sort_key(f.get("titolo", ""))
+
+# Hit e miss delle cache (ripartono da zero a ogni ricaricamento dell'archivio)
+def statistiche_cache():
+    stato = stato_corrente
+    cache = {
+        "risultati": stato.cache_risultati,
+        "tastiere": stato.cache_tastiere,
+        "inline": stato.cache_inline,
+        "query_per_id": query_per_id,
+    }
+    valori = {}
+    for nome, c in cache.items():
+        valori[(nome, "hit")] = c.hits
+        valori[(nome, "miss")] = c.misses
+    return valori
+
+# Frazione di richieste servite dalla cache (None se non ce ne sono state)
+def percentuali_hit():
+    valori = statistiche_cache()
+    percentuali = {}
+    for nome, esito in valori:
+        if esito == "hit":
+            totale = valori[(nome, "hit")] + valori[(nome, "miss")]
+            percentuali[nome] = valori[(nome, "hit")] / totale if totale else None
+    return percentuali
+
+def log_percentuali_hit():
+    percentuali = percentuali_hit()
+    logger.info(
+        "Hit delle cache: %s",
+        ", ".join(f"{n} {p:.0%}" if p is not None else f"{n} -" for n, p in percentuali.items()),
+        extra={"evento": "cache", **{f"hit_{n}": p for n, p in percentuali.items()}},
     )
-    for file in files:
-        items.append(("file", file.get("titolo", "File"), file.get("link", "#")))
+
+registro.misura("fcp_cache_richieste", "Richieste alle cache per esito", statistiche_cache, ("cache", "esito"))
+registro.misura(
+    "fcp_cache_hit_ratio", "Frazione di richieste servite dalla cache",
+    lambda: {n: p for n, p in percentuali_hit().items() if p is not None}, ("cache",),
+)
+registro.misura("fcp_esecutore_in_corso", "Lavori in corso o in coda nell'esecutore", lambda: esecutore.in_corso)
+registro.misura("fcp_invii", "Code di invio verso Telegram", lambda: limitatore_invii.statistiche(), ("statistica",))
+registro.misura("fcp_update_in_fila", "Update in fila per chat", lambda: processore_chat.statistiche(), ("statistica",))
+registro.misura("fcp_archivio_file", "File nell'archivio caricato", lambda: len(stato_corrente.indice.files))
+
+# Creazione tastiera di navigazione
+ELEMENTI_PER_PAGINA = 10
+
+# Le tastiere già costruite per (cartella, pagina) stanno nella cache dello stato,
+# quindi si ricalcolano solo quando cambia l'archivio; le nuove si costruiscono nell'esecutore.
+# tutti=True: l'elenco di tutti i file sotto la cartella (costruisci_elenco_completo)
+async def genera_keyboard(stato, percorso_attuale, page=0, tutti=False):
+    chiave = (tuple(percorso_attuale), page, tutti)
+    popolari["tastiere"].aggiungi(chiave)
+    keyboard = stato.cache_tastiere.get(chiave)
+    if keyboard is None:
+        costruisci = costruisci_elenco_completo if tutti else costruisci_keyboard
+        with LATENZA_FASE.tempo(fase="tastiera"):
+            keyboard = await esecutore.esegui(costruisci, stato, percorso_attuale, page)
+        stato.cache_tastiere[chiave] = keyboard
+    return keyboard
+
+def costruisci_keyboard(stato, percorso_attuale, page=0):
+    keyboard = []
+    nomi_cartelle_ordinate, files = stato.elenchi[tuple(percorso_attuale)]
+    totale = len(nomi_cartelle_ordinate) + len(files)
 
     start = page * ELEMENTI_PER_PAGINA
     end = start + ELEMENTI_PER_PAGINA
-    pagina_items = items[start:end]
-
-    for tipo, nome, valore in pagina_items:
-        if tipo == "cartella":
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{' ' * 10} 📁 {nome} {' ' * 10}", callback_data=f"nav:{valore}:0"
-                )
-            ])
-        else:
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{' ' * 10}📄 {nome} {' ' * 10}", url=valore
-                )
-            ])
+
+    # Prima le cartelle ordinate, poi i file ordinati: costruisco solo i pulsanti della pagina.
+    # Accanto a ogni cartella il numero di file che contiene (sottocartelle comprese)
+    for nome_sottocartella in nomi_cartelle_ordinate[start:end]:
+        short_id = stato.registro.id(percorso_attuale + [nome_sottocartella])
+        inizio, fine, _ = stato.indice.sottoalberi[tuple(percorso_attuale) + (nome_sottocartella,)]
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{' ' * 10} 📁 {nome_sottocartella} ({fine - inizio}) {' ' * 10}", callback_data=f"nav:{short_id}:0"
+            )
+        ])
+    inizio_file = max(start - len(nomi_cartelle_ordinate), 0)
+    fine_file = max(end - len(nomi_cartelle_ordinate), 0)
+    for file in stato.indice.files[files.start + inizio_file:files.start + fine_file]:
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{' ' * 10}📄 {file.titolo or 'File'} {' ' * 10}", url=file.link
+            )
+        ])
 
     # Navigazione pagine
     nav_buttons = []
     if page > 0:
-        short_id = get_or_create_id(percorso_attuale)
+        short_id = stato.registro.id(percorso_attuale)
         nav_buttons.append(
             InlineKeyboardButton("⬅️ Indietro", callback_data=f"nav:{short_id}:{page-1}")
         )
-    if end < len(items):
-        short_id = get_or_create_id(percorso_attuale)
+    if end < totale:
+        short_id = stato.registro.id(percorso_attuale)
         nav_buttons.append(
             InlineKeyboardButton("➡️ Successivo", callback_data=f"nav:{short_id}:{page+1}")
         )
     if nav_buttons:
         keyboard.append(nav_buttons)
 
+    # Nella prima pagina di una cartella: ricerca limitata alla cartella e, se ha sottocartelle,
+    # l'elenco di tutti i file che contiene
+    if percorso_attuale and page == 0:
+        short_id = stato.registro.id(percorso_attuale)
+        azioni = [InlineKeyboardButton("🔍 Cerca qui", callback_data=f"cercaqui:{short_id}")]
+        if nomi_cartelle_ordinate:
+            inizio, fine, _ = stato.indice.sottoalberi[tuple(percorso_attuale)]
+            azioni.append(InlineKeyboardButton(f"📚 Tutti i file ({fine - inizio})", callback_data=f"tutti:{short_id}:0"))
+        keyboard.append(azioni)
+
     # Pulsante indietro
     if percorso_attuale:
-        back_id = get_or_create_id(percorso_attuale[:-1])
+        back_id = stato.registro.id(percorso_attuale[:-1])
         keyboard.append([
             InlineKeyboardButton("🔙 Indietro", callback_data=f"nav:{back_id}:0")
         ])
 
     return InlineKeyboardMarkup(keyboard)
 
-# Ricerca nei file per titolo e tag (ordinata numericamente e alfabeticamente)
-def cerca_in_cartelle(query, archivio):
-    risultati = []
-    query_terms = query.lower().split()
+# Tutti i file sotto una cartella, sottocartelle comprese: sono consecutivi nell'indice
+# (stato.indice.sottoalberi), quindi una pagina è una fetta di stato.indice.files
+def costruisci_elenco_completo(stato, percorso_attuale, page=0):
+    inizio, fine, _ = stato.indice.sottoalberi[tuple(percorso_attuale)]
+    start = inizio + page * ELEMENTI_PER_PAGINA
+    end = min(start + ELEMENTI_PER_PAGINA, fine)
+    keyboard = [
+        [InlineKeyboardButton(f"📄 {file.titolo or 'File'}", url=file.link)]
+        for file in stato.indice.files[start:end]
+    ]
+
+    short_id = stato.registro.id(percorso_attuale)
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"tutti:{short_id}:{page-1}"))
+    if end < fine:
+        nav_buttons.append(InlineKeyboardButton("➡️ Successivo", callback_data=f"tutti:{short_id}:{page+1}"))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([InlineKeyboardButton("🔙 Torna alla cartella", callback_data=f"nav:{short_id}:0")])
+    return InlineKeyboardMarkup(keyboard)
+
+# Intestazione di una cartella: nome, file contenuti e data dell'ultimo aggiunto (se nota)
+def intestazione_cartella(stato, percorso):
+    inizio, fine, ultimo = stato.indice.sottoalberi[tuple(percorso)]
+    nome = percorso[-1] if percorso else stato.root_name
+    testo = f"📂 *{nome}*\n{fine - inizio} file"
+    if ultimo is not None:
+        testo += f", ultimo aggiunto il {time.strftime('%d/%m/%Y', time.localtime(ultimo))}"
+    return testo
+
+# Ricerca nei file per titolo e tag tramite l'indice.
+# Senza k: tutti i risultati ordinati numericamente e alfabeticamente; con k: i primi k per rilevanza.
+# Con cartella (percorso come tupla) si cerca solo tra i file sotto quella cartella.
+# Restituisce le posizioni dei file in stato.indice.files (array di interi) e il numero totale
+# di risultati (funzione pura, eseguita dall'esecutore)
+def cerca_in_cartelle(stato, query, k=None, cartella=None):
+    intervallo = None
+    if cartella is not None:
+        # cartella sparita dopo un ricaricamento: nessun risultato
+        intervallo = stato.indice.sottoalberi.get(cartella, (0, 0, None))[:2]
+    if k is None:
+        ids = stato.indice.ids_ordinati(query, intervallo)
+        return array("I", ids), len(ids)
+    ids, totale = stato.indice.ids_classificati(query, k, intervallo)
+    return array("I", ids), totale
+
+# ID breve -> (query, cartella), per rifare la ricerca quando i risultati sono scaduti
+# (sopravvive ai ricaricamenti dell'archivio)
+query_per_id = CacheLRU(10240)
+
+def normalizza_query(query):
+    return " ".join(query.lower().split())
 
-    def ricerca(cartella, percorso):
-        for file in cartella.get("files", []):
-            titolo = file.get("titolo", "").lower()
-            tag_list = [tag.lower() for tag in file.get("tag", [])]
+# ID breve (8 caratteri) della query normalizzata (e della cartella), da usare nel callback_data
+def id_ricerca(query, cartella=None):
+    normalizzata = normalizza_query(query)
+    if cartella is not None:
+        normalizzata += "\n" + "::".join(cartella)
+    return id_breve(normalizzata)
 
-            if all(term in titolo or any(term in tag for tag in tag_list) for term in query_terms):
-                risultati.append(file)
+# Attende la ricerca misurandone la durata; le ricerche lente finiscono nel log con la query
+async def cronometra_ricerca(query, ricerca):
+    inizio = time.perf_counter()
+    try:
+        return await ricerca
+    finally:
+        durata = time.perf_counter() - inizio
+        LATENZA_FASE.osserva(durata, fase="ricerca")
+        if durata > RICERCA_LENTA:
+            RICERCHE_LENTE.inc()
+            logger.warning("Ricerca lenta (%.2f s): '%s'", durata, query, extra={"evento": "ricerca_lenta", "query": query, "durata_ms": round(durata * 1000, 1)})
 
-        for nome_sottocartella, sottocartella in cartella.get("subfolders", {}).items():
-            ricerca(sottocartella, percorso + [nome_sottocartella])
+# Quanti risultati calcolare per mostrarne almeno necessari (None = tutti, per l'ordine alfabetico)
+def risultati_da_calcolare(necessari):
+    if ORDINAMENTO_RICERCA == "rilevanza":
+        return max(2 * necessari, PAGINE_PER_RICERCA * RISULTATI_PER_PAGINA)
+    return None
 
-    root_name = list(archivio.keys())[0]
-    ricerca(archivio[root_name], [root_name])
-    return sorted(risultati, key=lambda f: sort_key(f.get("titolo", "")))
+# Risultati dalla cache, oppure ricerca sull'indice (nell'esecutore) e salvataggio in cache.
+# In cache c'è (risultati calcolati, totale): per rilevanza solo i primi, finché bastano per la pagina
+async def risultati_ricerca(stato, query, page=0, cartella=None):
+    rid = id_ricerca(query, cartella)
+    if page == 0:
+        popolari["query"].aggiungi((normalizza_query(query), cartella))
+    voce = stato.cache_risultati.get(rid)
+    necessari = (page + 1) * RISULTATI_PER_PAGINA
+    if voce is None or len(voce[0]) < min(necessari, voce[1]):
+        k = risultati_da_calcolare(necessari)
+        ids, totale = await cronometra_ricerca(query, esecutore.esegui(cerca_in_cartelle, stato, query, k, cartella))
+        voce = (ids, totale)
+        stato.cache_risultati[rid] = voce
+    query_per_id[rid] = (query, cartella)
+    return rid, voce
 
 # Invia risultati della ricerca con paginazione
 RISULTATI_PER_PAGINA = 10 #ho impostato solo 10 risultati per pagina, potete cambiare questo numero
-async def invia_risultati(update: Update, query: str, page: int = 0):
+# cartella: percorso (tupla) a cui limitare la ricerca, None per tutto l'archivio
+async def invia_risultati(update: Update, query: str, page: int = 0, cartella=None):
     user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ricerca '{query}' pagina {page}")
-    risultati = cerca_in_cartelle(query, archivio)
+    logger.info(
+        "User %s (%s) ricerca '%s' pagina %s", user.id, user.username, query, page,
+        extra={"evento": "ricerca", "utente": user.id, "query": query, "pagina": page,
+               "cartella": "/".join(cartella) if cartella else None},
+    )
+    stato = stato_corrente
+    rid, (risultati, totale) = await risultati_ricerca(stato, query, page, cartella)
+    dove = f" in '{cartella[-1]}'" if cartella else ""
 
-    if not risultati:
+    if not totale:
         if update.message:
-            await update.message.reply_text(f"🔍 Nessun risultato trovato per '{query}'.")
+            await update.message.reply_text(f"🔍 Nessun risultato trovato per '{query}'{dove}.")
         else:
-            await update.callback_query.edit_message_text(f"🔍 Nessun risultato trovato per '{query}'.")
+            await update.callback_query.edit_message_text(f"🔍 Nessun risultato trovato per '{query}'{dove}.")
         return
 
     start = page * RISULTATI_PER_PAGINA
@@ -173,106 +519,209 @@ async def invia_risultati(update: Update, query: str, page: int = 0):
     pagina_risultati = risultati[start:end]
 
     keyboard = [
-        [InlineKeyboardButton(f"📄 {file['titolo']}", url=file['link'])]
-        for file in pagina_risultati
+        [InlineKeyboardButton(f"📄 {file.titolo}", url=file.link)]
+        for file in (stato.indice.files[i] for i in pagina_risultati)
     ]
 
     nav_buttons = []
     if page > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"search:{query}:{page-1}"))
-    if end < len(risultati):
-        nav_buttons.append(InlineKeyboardButton("➡️ Successivo", callback_data=f"search:{query}:{page+1}"))
+        nav_buttons.append(InlineKeyboardButton("⬅️ Indietro", callback_data=f"search:{rid}:{page-1}"))
+    if end < totale:
+        nav_buttons.append(InlineKeyboardButton("➡️ Successivo", callback_data=f"search:{rid}:{page+1}"))
     if nav_buttons:
         keyboard.append(nav_buttons)
 
     if update.message:
         await update.message.reply_text(
-            f"🔍 Risultati per '{query}' (pagina {page+1}):",
+            f"🔍 Risultati per '{query}'{dove} (pagina {page+1}):",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     else:
         await update.callback_query.edit_message_text(
-            f"🔍 Risultati per '{query}' (pagina {page+1}):",
+            f"🔍 Risultati per '{query}'{dove} (pagina {page+1}):",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
 # /cerca handler
+@gestore("cerca")
 async def cerca(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha usato /cerca")
     query = ' '.join(context.args)
     if query:
-        await invia_risultati(update, query, page=0)
+        # dopo "🔍 Cerca qui" la prima ricerca vale solo per quella cartella
+        cartella = context.user_data.pop("cerca_in", None)
+        await invia_risultati(update, query, page=0, cartella=cartella)
     else:
         await update.message.reply_text("⚠️ Inserisci una query. Esempio: /cerca algebra")
 
 # /start handler
+@gestore("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha avviato il bot con /start")
-    keyboard = genera_keyboard(archivio[list(archivio.keys())[0]], [])
+    stato = stato_corrente
+    keyboard = await genera_keyboard(stato, [])
     await update.message.reply_text(
-        f"📚 *{list(archivio.keys())[0]}*", reply_markup=keyboard, parse_mode="Markdown"
+        f"📚 *{stato.root_name}*", reply_markup=keyboard, parse_mode="Markdown"
     )
 
 # Callback per navigazione tra cartelle o paginazione ricerca
+@gestore("naviga")
 async def naviga(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query_cb = update.callback_query
-    user = query_cb.from_user
     data = query_cb.data
-    logger.info(f"User {user.id} ({user.username}) ha cliccato button: {data}")
+    stato = stato_corrente
     await query_cb.answer()
     
     if data.startswith("search:"):
-        _, q, p = data.split(":", 2)
-        await invia_risultati(update, q, int(p))
+        _, rid, p = data.split(":", 2)
+        ricerca = query_per_id.get(rid)
+        if ricerca is None:
+            await query_cb.edit_message_text("⌛ Ricerca scaduta, ripetila con /cerca.")
+            return
+        q, cartella = ricerca
+        await invia_risultati(update, q, int(p), cartella)
         return
-    
+
+    if data.startswith("cercaqui:"):
+        percorso = stato.registro.percorso(data.split(":", 1)[1])
+        if percorso is None:
+            await query_cb.edit_message_text("❌ Cartella non trovata o ID non valido.")
+            return
+        context.user_data["cerca_in"] = tuple(percorso)
+        await context.bot.send_message(
+            query_cb.message.chat.id,
+            f"🔍 Scrivi /cerca seguito dalle parole chiave: cercherò solo in *{escape_markdown(percorso[-1])}*.",
+            parse_mode="Markdown",
+        )
+        return
+
+    if data.startswith("tutti:"):
+        _, short_id, page_str = data.split(":", 2)
+        path_list = stato.registro.percorso(short_id)
+        if path_list is None:
+            await query_cb.edit_message_text("❌ Cartella non trovata o ID non valido.")
+            return
+        keyboard = await genera_keyboard(stato, path_list, page=int(page_str), tutti=True)
+        await query_cb.edit_message_text(
+            intestazione_cartella(stato, path_list) + " (tutti, sottocartelle comprese)",
+            reply_markup=keyboard, parse_mode="Markdown"
+        )
+        return
+
     if data.startswith("nav:"):
         _, short_id, page_str = data.split(":", 2)
         page = int(page_str)
-        path_list = id_to_path.get(short_id)
+        path_list = stato.registro.percorso(short_id)
     else:
         short_id = data
         page = 0
-        path_list = id_to_path.get(short_id)
+        path_list = stato.registro.percorso(short_id)
 
     if path_list is None:
         await query_cb.edit_message_text("❌ Cartella non trovata o ID non valido.")
         return
 
-    folder = get_folder_from_path(path_list, archivio[list(archivio.keys())[0]])
-    if folder is None:
+    if tuple(path_list) not in stato.elenchi:
         await query_cb.edit_message_text("❌ Cartella non trovata.")
         return
 
-    keyboard = genera_keyboard(folder, path_list, page=page)
-    title = path_list[-1] if path_list else list(archivio.keys())[0]
+    keyboard = await genera_keyboard(stato, path_list, page=page)
     await query_cb.edit_message_text(
-        f"📂 *{title}*", reply_markup=keyboard, parse_mode="Markdown"
+        intestazione_cartella(stato, path_list), reply_markup=keyboard, parse_mode="Markdown"
+    )
+
+# INIZIO RICERCA INLINE (@bot query) ----------------------
+
+# Ultima query inline di ogni utente: quelle precedenti ancora in attesa vengono scartate
+ultima_inline = CacheLRU(10000)
+
+# Id dei file trovati per la query inline, in ordine di titolo (funzione pura, eseguita dall'esecutore).
+# base: risultati di un prefisso della query, che contengono di sicuro quelli della query
+def cerca_inline(stato, chiave, base=None):
+    if base is None:
+        return stato.indice.ids_ordinati(chiave)
+    termini = chiave.split()
+    return [i for i in base if stato.indice.corrisponde(i, termini)]
+
+# Risultati in cache del prefisso più lungo della query: mentre si scrive la query si allunga,
+# e i file che contengono "alg" comprendono quelli che contengono "alge" o "alg es"
+def prefisso_in_cache(stato, chiave):
+    for fine in range(len(chiave) - 1, 0, -1):
+        if chiave[fine - 1] == " ":
+            continue
+        base = stato.cache_inline.peek(chiave[:fine])
+        if base is not None:
+            return base if len(base) <= INLINE_FILTRA_MAX else None
+    return None
+
+# Handler delle query inline: risponde con i link ai file, una pagina alla volta (next_offset)
+@gestore("inline")
+async def inline_cerca(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline = update.inline_query
+    user = inline.from_user
+    chiave = normalizza_query(inline.query)
+    ultima_inline[user.id] = inline.id
+    if not chiave:
+        await inline.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+
+    stato = stato_corrente
+    ids = stato.cache_inline.get(chiave)
+    if ids is None:
+        # aspetto un attimo: se nel frattempo l'utente ha scritto ancora, questa query è già vecchia
+        await asyncio.sleep(INLINE_ATTESA)
+        if ultima_inline.get(user.id) != inline.id:
+            return
+        ids = await cronometra_ricerca(
+            chiave, esecutore.esegui(cerca_inline, stato, chiave, prefisso_in_cache(stato, chiave))
+        )
+        if len(ids) <= INLINE_CACHE_VOCE_MAX:
+            stato.cache_inline[chiave] = ids
+        if ultima_inline.get(user.id) != inline.id:
+            return
+
+    offset = int(inline.offset) if inline.offset.isdigit() else 0
+    risultati = []
+    for file_id in ids[offset:offset + INLINE_RISULTATI]:
+        file = stato.indice.files[file_id]
+        risultati.append(InlineQueryResultArticle(
+            id=str(file_id),
+            title=file.titolo,
+            description=" / ".join(file.tag) or stato.root_name,
+            url=file.link,
+            input_message_content=InputTextMessageContent(f"📄 {file.titolo}\n{file.link}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📄 Apri", url=file.link)]]),
+        ))
+    fine = offset + INLINE_RISULTATI
+    await inline.answer(
+        risultati,
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(fine) if fine < len(ids) else "",
     )
 
+# FINE RICERCA INLINE ----------------------
+
 # Comando sconosciuto
+@gestore("sconosciuto")
 async def comando_sconosciuto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha inviato comando sconosciuto: {update.message.text}")
     await update.message.reply_text("❌ Comando non riconosciuto. Usa /help per sapere come usare questo bot!")
 
 # Comando /help
+@gestore("help")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha usato /help")
     messaggio = (
         "📖 *Come usare questo bot:*\n\n"
         "🔹 Usa /start per esplorare la libreria digitale tramite pulsanti.\n\n"
         "🔹 Usa /cerca seguito da una o più parole chiave per cercare tra i file. Es.:\n"
         "`/cerca chimica esami svolti`\n\n"
-        "🔹 La ricerca considera titoli e tag dei file.\n\n"
+        "🔹 La ricerca considera titoli e tag dei file: prima vedi quelli con le parole nel titolo.\n\n"
+        "🔹 Puoi cercare anche da qualsiasi chat: scrivi @ seguito dal nome del bot e dalle parole chiave.\n\n"
         "🔹 Clicca sui pulsanti 📁 per entrare nelle cartelle, e su 📄 per aprire un file.\n\n"
+        "🔹 Dentro una cartella usa 🔍 Cerca qui per cercare solo lì, e 📚 Tutti i file per vedere "
+        "anche quelli delle sottocartelle.\n\n"
         "🔹 I risultati della ricerca sono paginati se troppi, ti basterà cliccare\n ➡️ Successivo.\n\n"
         "🔹 Usa /upload per sapere come inviarci i file!\n\n"
         "🔹 Usa /libri per trovare libri in PDF.\n\n"
-        "🔹 Usa /mail per sfogliare tutta la rubrica delle mail dei prof.\n\n"
+        "🔹 Usa /mail per sfogliare tutta la rubrica delle mail dei prof, oppure cerca un prof "
+        "o una materia. Es.: `/mail rossi`\n\n"
         "❓ *Hai domande o problemi?* \n"
         "[➡️ Scrivici, ti risponderemo subito!](https://t.me/FreeCultureProject)\n\n\n"
         "ℹ️ _Questo bot è parte del progetto FreeCultureProject._\n"
@@ -281,9 +730,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(messaggio, parse_mode="Markdown")
 
 # 📤 Comando /upload
+@gestore("upload")
 async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha usato /upload")
     messaggio = (
         "📤 *Come contribuire alla libreria:*\n\n"
         "Puoi inviarmi nuovi file direttamente in *chat privata*!\n\n"
@@ -294,9 +742,8 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(messaggio, parse_mode="Markdown", disable_web_page_preview=True)
 
 # 📚 Comando /libri
+@gestore("libri")
 async def libri_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha usato /libri")
     messaggio = (
         "📚 *Cerchi libri in PDF?*\n\n"
         "Date un'occhiata qua!\n"
@@ -308,120 +755,425 @@ async def libri_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # INIZIO COMANDO MAIL E MENU INLINE PER LE MAIL ----------------------
 
-# --- Comando /mail: presenta la lista degli anni
+# --- Comando /mail: senza argomenti presenta la lista degli anni,
+# con /mail <nome, materia o email> cerca i docenti nell'indice della rubrica
+@gestore("mail")
 async def mail_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    logger.info(f"User {user.id} ({user.username}) ha usato /mail")
-    # Inline buttons con le chiavi di primo livello (gli anni)
-    keyboard = []
-    for anno in rubrica.keys():
-        mid1 = get_or_create_mail_id([anno])
-        keyboard.append([
-            InlineKeyboardButton(
-                anno,
-                callback_data=f"mail:{mid1}"
-            )
-        ])
-    await update.message.reply_text(
-        "📧 *Rubrica email docenti*\n\nSeleziona l'anno di corso:",
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+    stato = stato_corrente
+    query = " ".join(context.args)
+    if not query:
+        text, keyboard = stato.menu_mail["mail:back"]
+        return await update.message.reply_text(text, parse_mode="Markdown", reply_markup=keyboard)
+
+    ids = stato.indice_mail.cerca(query)
+    sfoglia = InlineKeyboardMarkup([[InlineKeyboardButton("📚 Sfoglia la rubrica", callback_data="mail:back")]])
+    if not ids:
+        return await update.message.reply_text(
+            f"🔍 Nessun docente trovato per '{query}'.", reply_markup=sfoglia
+        )
+
+    text = f"📧 *Rubrica* — ricerca _{escape_markdown(query)}_\n\n"
+    text += "\n".join(
+        f"• *{n}*: `{e}`\n   _{anno} → {materia}_"
+        for anno, materia, n, e in (stato.indice_mail.voci[i] for i in ids[:MAIL_RISULTATI_MAX])
     )
+    if len(ids) > MAIL_RISULTATI_MAX:
+        text += f"\n\n… e altri {len(ids) - MAIL_RISULTATI_MAX}: aggiungi una parola per restringere la ricerca."
+    await update.message.reply_text(text, parse_mode="Markdown", reply_markup=sfoglia)
 
-# --- Callback per navigare nel menu /mail
+# --- Callback per navigare nel menu /mail: i menu sono già pronti in stato.menu_mail
+@gestore("mail_callback")
 async def mail_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    stato = stato_corrente
     await query.answer()
-    parts = query.data.split(":")
-
-    # TORNA AGLI ANNI
-    if parts[1] == "back":
-        keyboard = []
-        for anno in rubrica.keys():
-            mid1 = get_or_create_mail_id([anno])
-            keyboard.append([
-                InlineKeyboardButton(
-                    anno,
-                    callback_data=f"mail:{mid1}"
-                )
-            ])
-        return await query.edit_message_text(
-            "📧 *Rubrica email docenti*\n\nSeleziona l'anno di corso:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-
-    # HO CLICCATO SU UN ANNO (mail:<mid1>)
-    if len(parts) == 2:
-        mid1 = parts[1]
-        percorso1 = mail_id_to_path.get(mid1)
-        if not percorso1:
-            return await query.edit_message_text("❌ Anno non valido.")
-        anno = percorso1[0]
-
-        # elenco materie con doppio livello di callback
-        keyboard = []
-        for mat in rubrica[anno].keys():
-            mid2 = get_or_create_mail_id([anno, mat])
-            keyboard.append([
-                InlineKeyboardButton(
-                    mat,
-                    callback_data=f"mail:{mid1}:{mid2}"
-                )
-            ])
-        # pulsante back anni
-        keyboard.append([
-            InlineKeyboardButton("🔙 Anni", callback_data="mail:back")
-        ])
-        return await query.edit_message_text(
-            f"📧 *Rubrica* — _{anno}_\n\nSeleziona la materia:",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
 
-    # HO CLICCATO SU UNA MATERIA (mail:<mid1>:<mid2>)
-    if len(parts) == 3:
-        mid2 = parts[2]
-        percorso2 = mail_id_to_path.get(mid2)
-        if not percorso2 or len(percorso2) != 2:
-            return await query.edit_message_text("❌ Materia non valida.")
-        anno, materia = percorso2
-        profs = rubrica[anno].get(materia, {})
-
-        text = f"📧 *Rubrica* — _{anno} → {materia}_\n\n"
-        text += "\n".join(f"• *{n}*: `{e}`" for n, e in profs.items())
-
-        # pulsanti per tornare a materie o anni
-        mid1 = get_or_create_mail_id([anno])
-        keyboard = [[
-            InlineKeyboardButton("🔙 Materie", callback_data=f"mail:{mid1}"),
-            InlineKeyboardButton("🏠 Anni",    callback_data="mail:back")
-        ]]
-        return await query.edit_message_text(
-            text,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+    menu = stato.menu_mail.get(query.data)
+    if menu is None:
+        # pulsante di una rubrica precedente a un ricaricamento
+        errore = "❌ Anno non valido." if query.data.count(":") == 1 else "❌ Materia non valida."
+        return await query.edit_message_text(errore)
+    text, keyboard = menu
+    return await query.edit_message_text(text, parse_mode="Markdown", reply_markup=keyboard)
 
 # FINE COMANDO MAIL E MENU INLINE PER LE MAIL ----------------------
 
 
-# 🚀 Avvio del bot
-def main():
-    app = Application.builder().token(token).build()
+# INIZIO RISCALDAMENTO DELLE CACHE ----------------------
+
+# Calcola risultati e tastiere più richiesti per uno stato non ancora in uso (eseguita in un thread:
+# riceve gli elenchi già estratti dai contatori, che intanto il loop continua ad aggiornare).
+# Restituisce ID breve -> (query, cartella) delle ricerche calcolate, per query_per_id
+def calcola_popolari(stato, ricerche, tastiere):
+    k = risultati_da_calcolare(RISULTATI_PER_PAGINA)
+    calcolate = {}
+    for (query, cartella), _ in ricerche:
+        if cartella is not None and cartella not in stato.indice.sottoalberi:
+            continue
+        rid = id_ricerca(query, cartella)
+        ids, totale = cerca_in_cartelle(stato, query, k, cartella)
+        stato.cache_risultati[rid] = (ids, totale)
+        calcolate[rid] = (query, cartella)
+    for percorso, page, tutti in (chiave for chiave, _ in tastiere):
+        if percorso not in stato.indice.sottoalberi:
+            continue  # cartella sparita con il nuovo archivio
+        costruisci = costruisci_elenco_completo if tutti else costruisci_keyboard
+        stato.cache_tastiere[(percorso, page, tutti)] = costruisci(stato, list(percorso), page)
+    return calcolate
+
+# Riempie le cache di uno stato appena caricato con le ricerche e le tastiere più richieste,
+# prima che riceva update (all'avvio, o prima di sostituire quello in uso dopo un ricaricamento)
+async def riscalda_cache(stato):
+    if not (RISCALDA_QUERY or RISCALDA_TASTIERE):
+        return
+    inizio = time.perf_counter()
+    ricerche = popolari["query"].piu_frequenti(RISCALDA_QUERY)
+    tastiere = popolari["tastiere"].piu_frequenti(RISCALDA_TASTIERE)
+    try:
+        calcolate = await asyncio.to_thread(calcola_popolari, stato, ricerche, tastiere)
+    except Exception:
+        # le cache restano vuote, il bot funziona lo stesso
+        logger.exception("Riscaldamento delle cache fallito")
+        return
+    for rid, ricerca in calcolate.items():
+        query_per_id[rid] = ricerca
+    logger.info(
+        "Cache riscaldate: %s ricerche, %s tastiere in %.2f s",
+        len(calcolate), len(stato.cache_tastiere), time.perf_counter() - inizio,
+    )
+
+def salva_conteggi():
+    if POPOLARI_FILE:
+        try:
+            salva_popolari(POPOLARI_FILE, popolari)
+        except OSError:
+            logger.exception("Salvataggio dei conteggi in %s fallito", POPOLARI_FILE)
+
+# Ogni POPOLARI_SALVATAGGIO secondi: invecchio e salvo i conteggi, e registro gli hit delle cache
+async def salva_popolari_periodicamente():
+    while True:
+        await asyncio.sleep(POPOLARI_SALVATAGGIO)
+        for contatore in popolari.values():
+            contatore.invecchia(POPOLARI_SALVATAGGIO)
+        salva_conteggi()
+        log_percentuali_hit()
+
+# FINE RISCALDAMENTO DELLE CACHE ----------------------
+
+# INIZIO RICARICAMENTO A CALDO DI archivio.json ED emails.json ----------------------
+
+lock_ricarica = asyncio.Lock()
+
+# Costruisco il nuovo stato in un thread (il loop continua a servire gli utenti)
+# e lo sostituisco in un colpo solo a quello in uso
+async def ricarica_stato():
+    global stato_corrente, firma_caricata
+    async with lock_ricarica:
+        firma = firma_file()
+        nuovo = await asyncio.to_thread(carica_stato)
+        await riscalda_cache(nuovo)
+        stato_corrente = nuovo
+        firma_caricata = firma
+        esecutore.aggiorna_stato(nuovo)
+    logger.info("Archivio ricaricato: %s file, %s cartelle", len(nuovo.indice.files), len(nuovo.registro))
+    return nuovo
+
+# Controllo periodico dei file: se sono cambiati li ricarico
+async def osserva_file():
+    while True:
+        await asyncio.sleep(RICARICA_INTERVALLO)
+        try:
+            if firma_file() != firma_caricata:
+                await ricarica_stato()
+        except Exception:
+            # file a metà scrittura o non valido: tengo lo stato attuale e riprovo al prossimo giro
+            logger.exception("Ricaricamento automatico fallito, riprovo più tardi")
+
+def avvia_osservatore(app: Application):
+    # nei worker i file li controlla lo smistatore, che poi ricrea tutti i worker
+    if RICARICA_INTERVALLO and worker_corrente is None:
+        app.bot_data["osservatore"] = asyncio.create_task(osserva_file())
+
+def ferma_osservatore(app: Application):
+    task = app.bot_data.pop("osservatore", None)
+    if task:
+        task.cancel()
+
+# Comando /ricarica (solo admin)
+@gestore("ricarica")
+async def ricarica_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Comando riservato agli amministratori.")
+        return
+    if worker_corrente is not None:
+        # lo stato è quello dello smistatore: ricarica lui (SIGHUP) e ricrea tutti i worker
+        os.kill(os.getppid(), signal.SIGHUP)
+        await update.message.reply_text("🔄 Ricaricamento avviato: i worker ripartono con il nuovo archivio.")
+        return
+    try:
+        nuovo = await ricarica_stato()
+    except Exception as e:
+        logger.exception("Ricaricamento da /ricarica fallito")
+        await update.message.reply_text(f"❌ Ricaricamento fallito, resta in uso l'archivio precedente: {e}")
+        return
+    await update.message.reply_text(
+        f"✅ Archivio ricaricato: {len(nuovo.indice.files)} file in {len(nuovo.registro)} cartelle."
+    )
+
+# FINE RICARICAMENTO A CALDO ----------------------
+
+
+# Dopo il primo update gestito registro il tempo trascorso dall'avvio (cold start).
+# Sta nel gruppo 1, quindi viene eseguito dopo gli handler del gruppo 0
+primo_update_gestito = False
+
+async def primo_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global primo_update_gestito
+    if not primo_update_gestito:
+        primo_update_gestito = True
+        logger.info("Primo update gestito a %.2f s dall'avvio", time.perf_counter() - AVVIO)
+
+
+# Errori: se l'esecutore è pieno o troppo lento avviso l'utente, il resto finisce nel log
+async def gestisci_errore(update: object, context: ContextTypes.DEFAULT_TYPE):
+    ERRORI.inc(tipo=type(context.error).__name__)
+    if isinstance(context.error, (Sovraccarico, asyncio.TimeoutError)):
+        logger.warning("Richiesta rifiutata (%s), lavori in corso: %s", type(context.error).__name__, esecutore.in_corso)
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("⏳ Il bot è molto occupato, riprova tra qualche secondo.")
+        return
+    logger.error("Errore durante la gestione di un update", exc_info=context.error)
+
+# Metriche: endpoint HTTP e scrittura del file con SIGUSR1
+def scrivi_metriche():
+    registro.scrivi(METRICHE_FILE)
+    logger.info("Metriche scritte in %s", METRICHE_FILE)
+
+async def avvia_metriche(app: Application):
+    if METRICHE_PORTA:
+        try:
+            app.bot_data["server_metriche"] = await registro.avvia_server(METRICHE_ASCOLTO, METRICHE_PORTA)
+            logger.info("Metriche su http://%s:%s/metrics", METRICHE_ASCOLTO, METRICHE_PORTA)
+        except OSError as e:
+            # porta occupata: il bot funziona lo stesso, restano il file e SIGUSR1
+            logger.warning("Endpoint delle metriche non avviato: %s", e)
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, scrivi_metriche)
+
+def ferma_metriche(app: Application):
+    server = app.bot_data.pop("server_metriche", None)
+    if server:
+        server.close()
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+    scrivi_metriche()
+
+# Avvio e arresto: cache riscaldate, pool dell'esecutore, controllo periodico dei file,
+# salvataggio dei conteggi delle ricerche e metriche
+async def all_avvio(app: Application):
+    await riscalda_cache(stato_corrente)
+    esecutore.aggiorna_stato(stato_corrente)
+    avvia_osservatore(app)
+    if POPOLARI_SALVATAGGIO:
+        app.bot_data["salvataggio_popolari"] = asyncio.create_task(salva_popolari_periodicamente())
+    await avvia_metriche(app)
+
+async def all_arresto(app: Application):
+    logger.info("Invii verso Telegram: %s", limitatore_invii.statistiche())
+    logger.info("Update in fila per chat: %s", processore_chat.statistiche())
+    log_percentuali_hit()
+    ferma_osservatore(app)
+    task = app.bot_data.pop("salvataggio_popolari", None)
+    if task:
+        task.cancel()
+    salva_conteggi()
+    ferma_metriche(app)
+    esecutore.chiudi()
+
+
+# Costruisce l'applicazione con tutti gli handler, senza avviarla.
+# base_url: indirizzo alternativo della Bot API (es. il server finto di benchmark/carico_bot.py)
+def crea_app(token_bot=None, base_url=None):
+    builder = (
+        Application.builder()
+        .token(token_bot or token)
+        .concurrent_updates(processore_chat)
+        .rate_limiter(limitatore_invii)
+        .post_init(all_avvio)
+        .post_shutdown(all_arresto)
+    )
+    if base_url:
+        builder = builder.base_url(base_url + "/bot").base_file_url(base_url + "/file/bot")
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("cerca", cerca))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("upload", upload_command))
     app.add_handler(CommandHandler("libri", libri_command))
     app.add_handler(CommandHandler("mail", mail_command))
+    app.add_handler(CommandHandler("ricarica", ricarica_command))
     app.add_handler(CallbackQueryHandler(mail_callback, pattern=r"^mail:"))
     app.add_handler(CallbackQueryHandler(naviga, pattern=r"^(?!mail:).*"))
+    # block=False: l'attesa delle query inline non blocca gli altri update
+    app.add_handler(InlineQueryHandler(inline_cerca, block=False))
     # ⛔ Catch-all per comandi non riconosciuti
     app.add_handler(MessageHandler(filters.COMMAND, comando_sconosciuto))
+    app.add_handler(TypeHandler(Update, primo_update), group=1)
+    app.add_error_handler(gestisci_errore)
+    return app
+
+
+# INIZIO DEPLOYMENT MULTI-PROCESSO (WORKER_PROCESSI > 0) ----------------------
+
+# Numero del worker in questo processo (None nel processo unico e nello smistatore)
+worker_corrente = None
+
+# Nome del file di un worker: bot_eventi.jsonl -> bot_eventi.w2.jsonl
+def file_del_worker(percorso, indice):
+    radice, estensione = os.path.splitext(percorso)
+    return f"{radice}.w{indice}{estensione}"
+
+# Quello che un worker passa al successore quando viene sostituito (tramite lo smistatore):
+# conteggi delle ricerche, per riscaldarne le cache, e ricerche recenti, per i pulsanti "search:" già inviati
+def stato_da_passare():
+    return {
+        "popolari": {nome: contatore.voci() for nome, contatore in popolari.items()},
+        "query_per_id": [
+            [rid, query, list(cartella) if cartella is not None else None]
+            for rid, (query, cartella) in query_per_id.items()
+        ],
+    }
+
+def riprendi_stato(corpo):
+    global popolari
+    dati = json.loads(corpo)
+    popolari = nuovi_popolari()
+    for nome, contatore in popolari.items():
+        contatore.unisci(dati["popolari"].get(nome, []))
+    for rid, query, cartella in dati["query_per_id"]:
+        query_per_id[rid] = (query, tuple(cartella) if cartella is not None else None)
+
+# Eseguito nel processo worker appena creato: log, metriche ed esecutore propri, poi l'Application.
+# eredita: lo stato_da_passare del worker sostituito (dopo un ricaricamento), altrimenti None
+def esegui_worker(indice, connessione, eredita=None):
+    global worker_corrente, esecutore, limitatore_invii, popolari, METRICHE_PORTA, METRICHE_FILE, POPOLARI_FILE
+    global AVVIO, primo_update_gestito
+    # il tempo fino al primo update si conta dalla nascita del worker, non da quella dello smistatore
+    AVVIO = time.perf_counter()
+    primo_update_gestito = False
+    worker_corrente = indice
+    configura_logging(
+        LOG_LIVELLO,
+        formato_testo=LOG_FORMATO.replace("%(name)s", f"w{indice} %(name)s"),
+        file_json=file_del_worker(LOG_FILE_JSON, indice) if LOG_FILE_JSON else None,
+        campionamento=LOG_CAMPIONAMENTO,
+    )
+    if METRICHE_PORTA:
+        METRICHE_PORTA += 1 + indice
+    METRICHE_FILE = file_del_worker(METRICHE_FILE, indice)
+    # ogni worker conta le ricerche delle proprie chat e le salva nel proprio file. Dopo un ricaricamento
+    # riceve i conteggi dal worker che sostituisce; altrimenti li legge dal file, e se non c'è ancora
+    # tiene quelli ereditati dallo smistatore (quelli del processo unico)
+    if POPOLARI_FILE:
+        POPOLARI_FILE = file_del_worker(POPOLARI_FILE, indice)
+    if eredita is not None:
+        riprendi_stato(eredita)
+    elif POPOLARI_FILE:
+        propri = nuovi_popolari()
+        if carica_popolari(POPOLARI_FILE, propri):
+            popolari = propri
+    esecutore = EsecutoreCPU(ESECUZIONE, ESECUZIONE_WORKER, ESECUZIONE_CODA_MAX, ESECUZIONE_TIMEOUT)
+    # il limite globale di Telegram vale per tutto il bot: ogni worker ne ha una parte. I limiti per chat
+    # restano interi, perché gli update di una chat vanno sempre allo stesso worker
+    limitatore_invii = LimitatoreInvii(
+        INVII_AL_SECONDO / WORKER_PROCESSI, INVII_CHAT_AL_SECONDO, INVII_CHAT_RAFFICA,
+        INVII_GRUPPO_AL_MINUTO, INVII_TENTATIVI,
+    )
+    asyncio.run(servi_worker(connessione))
 
+# Passa all'Application gli update ricevuti dallo smistatore; alla chiusura della connessione
+# finisce quelli già ricevuti, si ferma e manda allo smistatore lo stato per il successore
+async def servi_worker(connessione):
+    app = crea_app()
+    await app.initialize()
+    await all_avvio(app)
+    await app.start()
+    reader, writer = await asyncio.open_connection(sock=connessione)
+    try:
+        while (corpo := await leggi_messaggio(reader)) is not None:
+            await app.update_queue.put(Update.de_json(json.loads(corpo), app.bot))
+    finally:
+        await app.stop()
+        await all_arresto(app)
+        await app.shutdown()
+        try:
+            await invia_messaggio(writer, json.dumps(stato_da_passare(), ensure_ascii=False).encode("utf-8"))
+        except ConnectionError:
+            pass  # smistatore già chiuso
+        writer.close()
+
+# Processo frontale: riceve il webhook e smista gli update. I file dati li controlla lui
+# (ogni RICARICA_INTERVALLO secondi, o con SIGHUP, che arriva anche da /ricarica): se cambiano
+# carica il nuovo stato e ricrea i worker, che lo condividono come il precedente
+async def esegui_smistatore():
+    global stato_corrente, firma_caricata
+    smistatore = Smistatore(esegui_worker, WORKER_PROCESSI, WEBHOOK_PERCORSO, WEBHOOK_SEGRETO)
+    await smistatore.avvia_worker()
+    await smistatore.ascolta(WEBHOOK_ASCOLTO, WEBHOOK_PORTA)
+    logger.info("Webhook su %s:%s/%s, %s worker", WEBHOOK_ASCOLTO, WEBHOOK_PORTA, WEBHOOK_PERCORSO, WORKER_PROCESSI)
+    if WEBHOOK_URL:
+        async with Bot(token) as bot:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SEGRETO)
+
+    loop = asyncio.get_running_loop()
+    fine = asyncio.Event()
+    ricarica = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, fine.set)
+    loop.add_signal_handler(signal.SIGTERM, fine.set)
+    loop.add_signal_handler(signal.SIGHUP, ricarica.set)
+    try:
+        while not fine.is_set():
+            attese = [asyncio.create_task(fine.wait()), asyncio.create_task(ricarica.wait())]
+            await asyncio.wait(attese, timeout=RICARICA_INTERVALLO or None, return_when=asyncio.FIRST_COMPLETED)
+            for attesa in attese:
+                attesa.cancel()
+            if fine.is_set() or not (ricarica.is_set() or firma_file() != firma_caricata):
+                continue
+            ricarica.clear()
+            try:
+                firma = firma_file()
+                stato_corrente = await asyncio.to_thread(carica_stato)
+                firma_caricata = firma
+            except Exception:
+                logger.exception("Ricaricamento fallito, i worker restano con l'archivio precedente")
+                continue
+            await smistatore.avvia_worker()
+            logger.info("Archivio ricaricato: %s file, worker ricreati", len(stato_corrente.indice.files))
+    finally:
+        await smistatore.chiudi()
+
+# FINE DEPLOYMENT MULTI-PROCESSO ----------------------
+
+
+# 🚀 Avvio del bot
+def main():
+    if MODALITA_UPDATE == "webhook" and WORKER_PROCESSI:
+        print(f"✅ Bot avviato con {WORKER_PROCESSI} worker")
+        asyncio.run(esegui_smistatore())
+        return
+    app = crea_app()
     print("✅ Bot avviato")
-    app.run_polling()
+    if MODALITA_UPDATE == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_ASCOLTO,
+            port=WEBHOOK_PORTA,
+            url_path=WEBHOOK_PERCORSO,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SEGRETO,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
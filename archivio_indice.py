@@ -0,0 +1,875 @@
+import os
+import re
+import json
+import math
+import mmap
+import heapq
+import pickle
+import base64
+from array import array
+from bisect import bisect_left
+import hashlib
+import threading
+import unicodedata
+
+from cache_lru import CacheLRU
+from file_atomico import scrittura_atomica
+
+
+# ordine numerico e alfabetico
+def sort_key(titolo):
+    match = re.match(r"(\d+)", titolo)
+    if match:
+        return (int(match.group(1)), titolo.lower())
+    return (float('inf'), titolo.lower())
+
+
+# Link standard generato da crea_archivio_conTag.py: in memoria tengo solo l'ID Drive
+FORMATO_LINK_DRIVE = "https://drive.google.com/file/d/{}/view?usp=sharing"
+RE_LINK_DRIVE = re.compile(r"https://drive\.google\.com/file/d/([\w-]+)/view\?usp=sharing")
+
+
+class RecordFile:
+    """
+    Un file dell'archivio in forma compatta (letto da archivio.json, o ricostruito al momento
+    dall'immagine piatta dell'indice, vedi ElencoFile):
+      - titolo
+      - tag: tupla condivisa da tutti i file con gli stessi tag (di solito quelli della stessa cartella)
+      - drive_id: l'ID Drive, da cui il link viene ricostruito quando serve;
+        se il link non è quello standard di Drive resta in link_esterno
+      - aggiunto: data di creazione su Drive (secondi dal 1970), None se l'archivio non la riporta
+    """
+
+    __slots__ = ("titolo", "tag", "drive_id", "link_esterno", "aggiunto")
+
+    def __init__(self, titolo, link, tag, aggiunto=None):
+        self.titolo = titolo
+        self.tag = tag
+        self.aggiunto = aggiunto
+        match = RE_LINK_DRIVE.fullmatch(link)
+        self.drive_id = match.group(1) if match else None
+        self.link_esterno = None if match else link
+
+    @property
+    def link(self):
+        if self.drive_id is not None:
+            return FORMATO_LINK_DRIVE.format(self.drive_id)
+        return self.link_esterno
+
+    # Record dai campi già separati, senza riconoscere di nuovo il link
+    @classmethod
+    def da_campi(cls, titolo, tag, drive_id, link_esterno, aggiunto):
+        file = cls.__new__(cls)
+        file.titolo, file.tag, file.drive_id, file.link_esterno, file.aggiunto = \
+            titolo, tag, drive_id, link_esterno, aggiunto
+        return file
+
+    def __repr__(self):
+        return f"RecordFile({self.titolo!r}, {self.link!r}, {self.tag!r})"
+
+
+def carica_archivio(percorso):
+    """
+    Carica archivio.json in forma compatta: le cartelle restano dict {files, subfolders},
+    ogni file diventa un RecordFile appena letto (object_hook), così i dict dei file
+    non vengono mai tenuti tutti in memoria insieme, e le tuple dei tag sono condivise.
+    """
+    tuple_tag = {}
+
+    def converti(oggetto):
+        if isinstance(oggetto.get("titolo"), str):
+            tag = tuple(oggetto.get("tag", ()))
+            tag = tuple_tag.setdefault(tag, tag)
+            return RecordFile(oggetto["titolo"], oggetto.get("link", "#"), tag, oggetto.get("aggiunto"))
+        return oggetto
+
+    with open(percorso, "r", encoding="utf-8") as f:
+        return json.load(f, object_hook=converti)
+
+
+# ID breve (8 caratteri, sicuri per il callback_data) ricavato in modo deterministico dal testo
+def id_breve(testo):
+    digest = hashlib.blake2b(testo.encode("utf-8"), digest_size=6).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")
+
+
+class RegistroPercorsi:
+    """
+    Registro dei percorsi costruito una sola volta al caricamento.
+    Ogni percorso è salvato una volta sola (come tupla) nella lista percorsi;
+    l'ID è un hash del percorso, quindi resta lo stesso dopo un riavvio
+    e i pulsanti già inviati continuano a funzionare.
+    """
+
+    def __init__(self, percorsi):
+        self.percorsi = []
+        self.ids = []
+        self._da_id = {}
+        self._da_percorso = {}
+        for percorso in percorsi:
+            self.aggiungi(tuple(percorso))
+
+    def aggiungi(self, percorso):
+        if percorso in self._da_percorso:
+            return
+        chiave = "::".join(percorso)
+        short_id = id_breve(chiave)
+        # collisione (molto improbabile): rigenero con un suffisso finché l'ID è libero
+        tentativo = 0
+        while short_id in self._da_id:
+            tentativo += 1
+            short_id = id_breve(f"{chiave}#{tentativo}")
+        posizione = len(self.percorsi)
+        self.percorsi.append(percorso)
+        self.ids.append(short_id)
+        self._da_id[short_id] = posizione
+        self._da_percorso[percorso] = posizione
+
+    # ID del percorso, None se il percorso non esiste
+    def id(self, percorso):
+        posizione = self._da_percorso.get(tuple(percorso))
+        return None if posizione is None else self.ids[posizione]
+
+    # Percorso (lista) dell'ID, None se l'ID non è valido
+    def percorso(self, short_id):
+        posizione = self._da_id.get(short_id)
+        return None if posizione is None else list(self.percorsi[posizione])
+
+    def __len__(self):
+        return len(self.percorsi)
+
+
+# Percorsi della rubrica: [anno] e [anno, materia]
+def percorsi_rubrica(rubrica):
+    for anno, materie in rubrica.items():
+        yield (anno,)
+        for materia in materie:
+            yield (anno, materia)
+
+
+# Contenuto di ogni cartella già ordinato: percorso (tupla, senza la root) -> (nomi sottocartelle, file)
+def elenchi_ordinati(archivio):
+    elenchi = {}
+
+    def visita(cartella, percorso):
+        sottocartelle = cartella.get("subfolders", {})
+        elenchi[percorso] = (
+            sorted(sottocartelle, key=sort_key),
+            sorted(cartella.get("files", []), key=lambda f: sort_key(f.titolo)),
+        )
+        for nome, sottocartella in sottocartelle.items():
+            visita(sottocartella, percorso + (nome,))
+
+    root_name = list(archivio.keys())[0]
+    visita(archivio[root_name], ())
+    return elenchi
+
+
+# IMMAGINE PIATTA DI FILE E INDICE: nessun oggetto Python per file, token o lista di id, solo
+# testi UTF-8 e array di interi (memoryview) letti sul posto. Leggerli non scrive nulla nelle loro
+# pagine (niente contatori di riferimento), quindi restano condivise tra i processi che le mappano
+# dallo snapshot o le ereditano con fork
+
+# Data non nota negli array di date (secondi dal 1970)
+NESSUNA_DATA = -1
+
+
+class _Piatto:
+    """
+    Base delle strutture piatte: gli attributi elencati in VETTORI sono memoryview (di interi o byte).
+    Nel pickle dello snapshot vanno fuori banda (PickleBuffer, protocollo 5) e alla lettura
+    tornano viste sulla mappa del file, senza copiarli.
+    """
+
+    VETTORI = ()
+
+    def __getstate__(self):
+        stato = self.__dict__.copy()
+        for nome in self.VETTORI:
+            stato[nome] = (stato[nome].format, pickle.PickleBuffer(stato[nome]))
+        return stato
+
+    def __setstate__(self, stato):
+        for nome in self.VETTORI:
+            formato, dati = stato[nome]
+            stato[nome] = memoryview(dati).cast("B").cast(formato)
+        self.__dict__.update(stato)
+
+
+class TestiCompatti(_Piatto):
+    """
+    Sequenza di testi in un unico blob UTF-8, uno dopo l'altro, con l'offset di inizio di ognuno
+    (più la fine del blob): testi[i] decodifica il testo i al momento.
+    Se i testi sono in ordine, posizione() ne trova uno con la ricerca binaria.
+    """
+
+    VETTORI = ("blob", "offset")
+
+    def __init__(self, testi):
+        blob = bytearray()
+        offset = array("I", [0])
+        for testo in testi:
+            blob += testo.encode("utf-8")
+            offset.append(len(blob))
+        self.blob = memoryview(bytes(blob))
+        self.offset = memoryview(offset)
+
+    def __len__(self):
+        return len(self.offset) - 1
+
+    def __getitem__(self, i):
+        return str(self.blob[self.offset[i]:self.offset[i + 1]], "utf-8")
+
+    def grezzo(self, i):
+        return bytes(self.blob[self.offset[i]:self.offset[i + 1]])
+
+    # Posizione del testo (se i testi sono in ordine), None se non c'è
+    def posizione(self, testo):
+        cercato = testo.encode("utf-8")
+        basso, alto = 0, len(self)
+        while basso < alto:
+            medio = (basso + alto) // 2
+            if self.grezzo(medio) < cercato:
+                basso = medio + 1
+            else:
+                alto = medio
+        return basso if basso < len(self) and self.grezzo(basso) == cercato else None
+
+
+class ListeCompatte(_Piatto):
+    """
+    Liste di id in un unico array, una dopo l'altra, con l'offset di inizio di ognuna
+    (più la fine): liste[i] è una vista sulla lista i, senza copia.
+    """
+
+    VETTORI = ("valori", "offset")
+
+    def __init__(self, liste):
+        valori = array("I")
+        offset = array("I", [0])
+        for lista in liste:
+            valori.extend(lista)
+            offset.append(len(valori))
+        self.valori = memoryview(valori)
+        self.offset = memoryview(offset)
+
+    def __len__(self):
+        return len(self.offset) - 1
+
+    def __getitem__(self, i):
+        return self.valori[self.offset[i]:self.offset[i + 1]]
+
+
+class ElencoFile(_Piatto):
+    """
+    I file dell'archivio nell'ordine dell'indice, in forma piatta:
+      - titoli: il titolo di ogni file
+      - collegamenti: l'ID Drive di ogni file, o il link intero se non è quello standard (esterni[i] = 1)
+      - gruppi: il numero della tupla di tag del file; testi_tag[gruppo] sono i tag uniti da SEPARATORE_TAG
+      - aggiunti: data di creazione (NESSUNA_DATA se non nota)
+    files[i] ricostruisce al momento il RecordFile del file i e files[a:b] quelli di una fetta;
+    titolo(i) e tag(i) leggono solo quel campo.
+    """
+
+    VETTORI = ("esterni", "gruppi", "aggiunti")
+    SEPARATORE_TAG = "\x1f"
+
+    def __init__(self, files):
+        gruppi_tag = {}
+        esterni = array("B")
+        gruppi = array("I")
+        aggiunti = array("q")
+        for file in files:
+            esterni.append(file.drive_id is None)
+            gruppi.append(gruppi_tag.setdefault(file.tag, len(gruppi_tag)))
+            aggiunti.append(NESSUNA_DATA if file.aggiunto is None else int(file.aggiunto))
+        self.titoli = TestiCompatti(file.titolo for file in files)
+        self.collegamenti = TestiCompatti(
+            file.link_esterno if file.drive_id is None else file.drive_id for file in files
+        )
+        self.testi_tag = TestiCompatti(self.SEPARATORE_TAG.join(tag) for tag in gruppi_tag)
+        self.esterni = memoryview(esterni)
+        self.gruppi = memoryview(gruppi)
+        self.aggiunti = memoryview(aggiunti)
+
+    def __len__(self):
+        return len(self.gruppi)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        gruppo = self.gruppi[i]
+        collegamento = self.collegamenti[i]
+        aggiunto = self.aggiunti[i]
+        return RecordFile.da_campi(
+            self.titoli[i],
+            self.tag_gruppo(gruppo),
+            None if self.esterni[i] else collegamento,
+            collegamento if self.esterni[i] else None,
+            None if aggiunto == NESSUNA_DATA else aggiunto,
+        )
+
+    def titolo(self, i):
+        return self.titoli[i]
+
+    def tag(self, i):
+        return self.tag_gruppo(self.gruppi[i])
+
+    def tag_gruppo(self, gruppo):
+        testo = self.testi_tag[gruppo]
+        return tuple(testo.split(self.SEPARATORE_TAG)) if testo else ()
+
+
+class Sottoalberi(_Piatto):
+    """
+    Percorso della cartella -> (inizio, fine, ultimo_aggiunto), in sola lettura come un dict.
+    Per ogni cartella resta in posizioni solo il suo numero: i tre valori stanno negli array
+    intervalli (inizio e fine) e ultimi (NESSUNA_DATA se non nota, restituita come None).
+    """
+
+    VETTORI = ("intervalli", "ultimi")
+
+    def __init__(self, sottoalberi):
+        self.posizioni = {}
+        intervalli = array("I")
+        ultimi = array("q")
+        for percorso, (inizio, fine, ultimo) in sottoalberi.items():
+            self.posizioni[percorso] = len(self.posizioni)
+            intervalli.extend((inizio, fine))
+            ultimi.append(NESSUNA_DATA if ultimo is None else ultimo)
+        self.intervalli = memoryview(intervalli)
+        self.ultimi = memoryview(ultimi)
+
+    def __getitem__(self, percorso):
+        posizione = self.posizioni[percorso]
+        ultimo = self.ultimi[posizione]
+        return (
+            self.intervalli[2 * posizione],
+            self.intervalli[2 * posizione + 1],
+            None if ultimo == NESSUNA_DATA else ultimo,
+        )
+
+    def get(self, percorso, predefinito=None):
+        return self[percorso] if percorso in self.posizioni else predefinito
+
+    def __contains__(self, percorso):
+        return percorso in self.posizioni
+
+    def __len__(self):
+        return len(self.posizioni)
+
+
+# Lunghezza massima degli n-grammi usati per le ricerche per sottostringa
+NGRAM = 3
+# Un token è una sequenza massimale di caratteri alfanumerici
+RE_TOKEN = re.compile(r"\w+")
+
+
+def ngrammi(testo, n=NGRAM):
+    return {testo[i:i + n] for i in range(len(testo) - n + 1)}
+
+
+# Tutte le sottostringhe del testo lunghe da 1 a n caratteri
+def ngrammi_fino_a(testo, n=NGRAM):
+    return {testo[i:i + lunghezza] for lunghezza in range(1, n + 1) for i in range(len(testo) - lunghezza + 1)}
+
+
+# Pesi della ricerca per rilevanza: il titolo conta più dei tag,
+# un token uguale al termine conta più di una semplice sottostringa
+PESO_TITOLO_ESATTO = 3.0
+PESO_TITOLO_SOTTOSTRINGA = 2.0
+PESO_TAG_ESATTO = 1.5
+PESO_TAG_SOTTOSTRINGA = 1.0
+# Parametri BM25: saturazione del peso (k1) e normalizzazione sulla lunghezza (b)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Cache dei file per termine: limite sul numero totale di id tenuti, perché i termini corti
+# corrispondono a quasi tutto l'archivio. Un id costa circa 75 byte in un frozenset (la voce e
+# l'intero, che i postings piatti non hanno già pronto), quindi ~75 MB per processo;
+# un solo termine ne occupa al massimo TERMINI_CACHE_VOCE_MAX, quelli più grandi si ricalcolano ogni volta
+TERMINI_CACHE_ID = 1_000_000
+TERMINI_CACHE_VOCE_MAX = TERMINI_CACHE_ID // 10
+
+
+class IndiceRicerca(_Piatto):
+    """
+    Indice invertito costruito una sola volta sull'archivio caricato, in forma piatta.
+      - files: i file (ElencoFile) in ordine di visita (prima i file di una cartella, poi le
+        sottocartelle, entrambi nell'ordine degli elenchi): i file sotto una cartella sono consecutivi
+      - sottoalberi: percorso della cartella -> (inizio, fine, ultimo_aggiunto): i file del
+        sottoalbero sono files[inizio:fine]; ultimo_aggiunto è la data del più recente (o None)
+      - rango: posizione di ogni file nell'ordinamento per sort_key del titolo
+      - vocabolario: i token, in ordine (TestiCompatti): l'id di un token è la sua posizione
+      - postings: id del token -> lista ordinata degli id dei file che lo contengono (titolo o tag)
+      - postings_titolo: come postings, ma solo per i token del titolo (serve alla rilevanza)
+      - lunghezze: numero di token di titolo + tag di ogni file
+      - ngrammi, token_ngramma: le sottostringhe dei token lunghe fino a NGRAM caratteri, in ordine,
+        e per ognuna gli id dei token che la contengono
+
+    Mantiene la semantica di cerca_in_cartelle: ogni termine della query deve essere
+    sottostringa del titolo o di almeno un tag, e tutti i termini devono comparire.
+    I risultati si possono avere tutti in ordine di titolo (ids_ordinati) oppure
+    solo i primi k per rilevanza (ids_classificati), anche solo sotto una cartella
+    (intervallo = (inizio, fine) del suo sottoalbero): in quel caso di ogni lista dei postings
+    si prende con bisect solo il tratto [inizio, fine), e il costo dipende dai file trovati
+    nel sottoalbero invece che da quelli di tutto l'archivio.
+    """
+
+    VETTORI = ("lunghezze", "rango")
+
+    def __init__(self, archivio, elenchi=None):
+        if elenchi is None:
+            elenchi = elenchi_ordinati(archivio)
+        # strutture di costruzione, rese piatte alla fine
+        files = []
+        sottoalberi = {}
+        postings = []
+        postings_titolo = []
+        lunghezze = array("H")
+        id_token = {}
+        # i tag sono tuple condivise tra i file della stessa cartella: li spezzo in token una volta sola
+        token_tag = {}
+        totale_token = 0
+
+        def token_campo(campo):
+            return RE_TOKEN.findall(campo.lower())
+
+        def visita(percorso):
+            nonlocal totale_token
+            sottocartelle, files_cartella = elenchi[percorso]
+            inizio = len(files)
+            ultimo = None
+            for file in files_cartella:
+                file_id = len(files)
+                if file.aggiunto is not None and (ultimo is None or file.aggiunto > ultimo):
+                    ultimo = file.aggiunto
+                files.append(file)
+                tokens = token_tag.get(file.tag)
+                if tokens is None:
+                    tokens = token_tag[file.tag] = [t for tag in file.tag for t in token_campo(tag)]
+                token_titolo = token_campo(file.titolo)
+                lunghezza = len(token_titolo) + len(tokens)
+                lunghezze.append(min(lunghezza, 65535))
+                totale_token += lunghezza
+                for posizione, token in enumerate(token_titolo + tokens):
+                    tid = id_token.get(token)
+                    if tid is None:
+                        tid = id_token[token] = len(postings)
+                        postings.append([])
+                        postings_titolo.append([])
+                    lista = postings[tid]
+                    if not lista or lista[-1] != file_id:
+                        lista.append(file_id)
+                    if posizione < len(token_titolo):
+                        lista = postings_titolo[tid]
+                        if not lista or lista[-1] != file_id:
+                            lista.append(file_id)
+            for nome in sottocartelle:
+                ultimo_sotto = visita(percorso + (nome,))
+                if ultimo_sotto is not None and (ultimo is None or ultimo_sotto > ultimo):
+                    ultimo = ultimo_sotto
+            sottoalberi[percorso] = (inizio, len(files), ultimo)
+            return ultimo
+
+        visita(())
+        # lunghezza media (in token) di titolo + tag, per la normalizzazione BM25
+        self.lunghezza_media = totale_token / len(files) if files else 1.0
+
+        # ordine stabile: a parità di sort_key vale l'ordine di visita, come con sorted()
+        ordinati = sorted(range(len(files)), key=lambda i: sort_key(files[i].titolo))
+        rango = array("I", bytes(4 * len(files)))
+        for posizione, file_id in enumerate(ordinati):
+            rango[file_id] = posizione
+
+        # token in ordine, così un token si trova con la ricerca binaria; le liste seguono lo stesso ordine
+        vocabolario = sorted(id_token)
+        self.vocabolario = TestiCompatti(vocabolario)
+        self.postings = ListeCompatte(postings[id_token[token]] for token in vocabolario)
+        self.postings_titolo = ListeCompatte(postings_titolo[id_token[token]] for token in vocabolario)
+        token_ngramma = {}
+        for tid, token in enumerate(vocabolario):
+            for g in ngrammi_fino_a(token):
+                token_ngramma.setdefault(g, []).append(tid)
+        ngrammi_ordinati = sorted(token_ngramma)
+        self.ngrammi = TestiCompatti(ngrammi_ordinati)
+        self.token_ngramma = ListeCompatte(token_ngramma[g] for g in ngrammi_ordinati)
+
+        self.files = ElencoFile(files)
+        self.sottoalberi = Sottoalberi(sottoalberi)
+        self.lunghezze = memoryview(lunghezze)
+        self.rango = memoryview(rango)
+        self._crea_cache_termini()
+
+    # La cache è condivisa dai thread dell'esecutore: CacheLRU non è thread-safe, quindi ha un lock
+    def _crea_cache_termini(self):
+        self._cache_termini = CacheLRU(TERMINI_CACHE_ID, peso=len)
+        self._lock_termini = threading.Lock()
+
+    def _file_per_termine(self, termine):
+        with self._lock_termini:
+            risultato = self._cache_termini.get(termine)
+        if risultato is None:
+            risultato = self._calcola_file_per_termine(termine)
+            if len(risultato) <= TERMINI_CACHE_VOCE_MAX:
+                with self._lock_termini:
+                    self._cache_termini[termine] = risultato
+        return risultato
+
+    # Token del vocabolario che contengono il termine (solo caratteri alfanumerici): un termine
+    # corto è esso stesso un n-gramma, per quelli più lunghi verifico i token che hanno tutti i trigrammi
+    def _token_con(self, termine):
+        if len(termine) <= NGRAM:
+            posizione = self.ngrammi.posizione(termine)
+            return self.token_ngramma[posizione] if posizione is not None else []
+        liste = []
+        for g in ngrammi(termine):
+            posizione = self.ngrammi.posizione(g)
+            if posizione is None:
+                return []
+            liste.append(self.token_ngramma[posizione])
+        liste.sort(key=len)
+        candidati = set(liste[0]).intersection(*liste[1:])
+        return [tid for tid in candidati if termine in self.vocabolario[tid]]
+
+    # Tratto di una lista ordinata di id compreso in intervallo = (inizio, fine), o tutta la lista
+    @staticmethod
+    def _nell_intervallo(lista, intervallo):
+        if intervallo is None:
+            return lista
+        inizio, fine = intervallo
+        return lista[bisect_left(lista, inizio):bisect_left(lista, fine)]
+
+    # Senza intervallo il risultato va nella cache (_file_per_termine); con l'intervallo
+    # di un sottoalbero si calcola ogni volta, ma solo sui file del sottoalbero
+    def _calcola_file_per_termine(self, termine, intervallo=None):
+        pezzi = RE_TOKEN.findall(termine)
+
+        # Termine "semplice": ogni occorrenza sta dentro un singolo token
+        if len(pezzi) == 1 and pezzi[0] == termine:
+            risultato = set()
+            for tid in self._token_con(termine):
+                risultato.update(self._nell_intervallo(self.postings[tid], intervallo))
+            return frozenset(risultato)
+
+        # Termine con punteggiatura (es. "file1.pdf"): i pezzi restringono i candidati,
+        # poi verifico la sottostringa sul titolo e sui tag
+        if pezzi and intervallo is None:
+            candidati = set.intersection(*(set(self._file_per_termine(p)) for p in pezzi))
+        elif pezzi:
+            candidati = set.intersection(*(set(self._calcola_file_per_termine(p, intervallo)) for p in pezzi))
+        else:
+            candidati = range(*intervallo) if intervallo else range(len(self.files))
+        # i tag si verificano una volta per tupla (gruppo), i titoli file per file
+        nei_tag = {}
+        risultato = set()
+        for file_id in candidati:
+            gruppo = self.files.gruppi[file_id]
+            trovato = nei_tag.get(gruppo)
+            if trovato is None:
+                trovato = nei_tag[gruppo] = any(termine in tag.lower() for tag in self.files.tag_gruppo(gruppo))
+            if trovato or termine in self.files.titolo(file_id).lower():
+                risultato.add(file_id)
+        return frozenset(risultato)
+
+    # Termine -> file che lo contengono (in intervallo, se indicato)
+    def _file_per_termini(self, termini, intervallo=None):
+        if intervallo is None:
+            return {t: self._file_per_termine(t) for t in termini}
+        return {t: self._calcola_file_per_termine(t, intervallo) for t in termini}
+
+    # Id dei file che contengono tutti i termini della query (non ordinati),
+    # solo quelli in intervallo = (inizio, fine) se indicato
+    def id_corrispondenti(self, query, intervallo=None, per_termine=None):
+        termini = set(query.lower().split())
+        if not termini:
+            return set(range(*(intervallo or (0, len(self.files)))))
+        if per_termine is None:
+            per_termine = self._file_per_termini(termini, intervallo)
+        insiemi = sorted(per_termine.values(), key=len)
+        risultato = set(insiemi[0])
+        for insieme in insiemi[1:]:
+            if not risultato:
+                break
+            risultato &= insieme
+        return risultato
+
+    # Vero se il file contiene tutti i termini (già in minuscolo), come in id_corrispondenti
+    def corrisponde(self, file_id, termini):
+        titolo = self.files.titolo(file_id).lower()
+        tag = [t.lower() for t in self.files.tag(file_id)]
+        return all(termine in titolo or any(termine in t for t in tag) for termine in termini)
+
+    # Id dei file che corrispondono alla query, ordinati numericamente e alfabeticamente
+    def ids_ordinati(self, query, intervallo=None):
+        return sorted(self.id_corrispondenti(query, intervallo), key=self.rango.__getitem__)
+
+    # File che corrispondono alla query, ordinati numericamente e alfabeticamente
+    def cerca(self, query):
+        return [self.files[i] for i in self.ids_ordinati(query)]
+
+    # File il cui titolo contiene il termine come token intero e come sottostringa
+    # (None per i termini con punteggiatura, che verifico file per file)
+    def _titoli_con(self, termine, intervallo=None):
+        pezzi = RE_TOKEN.findall(termine)
+        if len(pezzi) != 1 or pezzi[0] != termine:
+            return None
+        tid = self.vocabolario.posizione(termine)
+        esatti = set(self._nell_intervallo(self.postings_titolo[tid], intervallo)) if tid is not None else set()
+        sottostringa = set()
+        for tid in self._token_con(termine):
+            sottostringa.update(self._nell_intervallo(self.postings_titolo[tid], intervallo))
+        return esatti, sottostringa
+
+    # Peso (tf) di ogni termine nei tag, calcolato una volta per tupla di tag
+    def _tf_tag(self, tag, termini):
+        tf = []
+        campi = [(t.lower(), RE_TOKEN.findall(t.lower())) for t in tag]
+        for termine in termini:
+            peso = 0.0
+            for testo, tokens in campi:
+                if termine in tokens:
+                    peso += PESO_TAG_ESATTO
+                elif termine in testo:
+                    peso += PESO_TAG_SOTTOSTRINGA
+            tf.append(peso)
+        return tf
+
+    def ids_classificati(self, query, k, intervallo=None):
+        """
+        I primi k file per rilevanza e il numero totale di file trovati (sotto intervallo, se indicato).
+        Punteggio BM25: per ogni termine il peso (tf) viene dai campi in cui compare
+        (titolo più dei tag, token intero più della sottostringa), pesato con l'idf del
+        termine e normalizzato sulla lunghezza del file. A parità di punteggio vale
+        l'ordine per titolo. Usa un heap di dimensione k: O(risultati · log k).
+        Sotto una cartella l'idf si calcola sui file del sottoalbero.
+        """
+        termini = list(dict.fromkeys(query.lower().split()))
+        if not termini:
+            ids = self.id_corrispondenti(query, intervallo)
+            return heapq.nsmallest(k, ids, key=self.rango.__getitem__), len(ids)
+        per_termine = self._file_per_termini(termini, intervallo)
+        ids = self.id_corrispondenti(query, intervallo, per_termine)
+
+        n = intervallo[1] - intervallo[0] if intervallo else len(self.files)
+        idf = []
+        titoli = []
+        for termine in termini:
+            df = len(per_termine[termine])
+            idf.append(math.log(1 + (n - df + 0.5) / (df + 0.5)))
+            titoli.append(self._titoli_con(termine, intervallo))
+        # il titolo serve solo per i termini con punteggiatura
+        serve_titolo = any(insiemi is None for insiemi in titoli)
+        tf_tag = {}
+
+        def punteggio(file_id):
+            gruppo = self.files.gruppi[file_id]
+            tf_tag_file = tf_tag.get(gruppo)
+            if tf_tag_file is None:
+                tf_tag_file = tf_tag[gruppo] = self._tf_tag(self.files.tag_gruppo(gruppo), termini)
+            titolo = self.files.titolo(file_id).lower() if serve_titolo else None
+            norma = BM25_K1 * (1 - BM25_B + BM25_B * self.lunghezze[file_id] / self.lunghezza_media)
+            totale = 0.0
+            for j, termine in enumerate(termini):
+                insiemi = titoli[j]
+                if insiemi is None:
+                    tf = PESO_TITOLO_SOTTOSTRINGA if termine in titolo else 0.0
+                elif file_id in insiemi[0]:
+                    tf = PESO_TITOLO_ESATTO
+                elif file_id in insiemi[1]:
+                    tf = PESO_TITOLO_SOTTOSTRINGA
+                else:
+                    tf = 0.0
+                tf += tf_tag_file[j]
+                totale += idf[j] * tf * (BM25_K1 + 1) / (tf + norma)
+            return (totale, -self.rango[file_id])
+
+        return heapq.nlargest(k, ids, key=punteggio), len(ids)
+
+    # la cache dei termini non va nello snapshot: la ricreo vuota
+    def __getstate__(self):
+        stato = super().__getstate__()
+        del stato["_cache_termini"], stato["_lock_termini"]
+        return stato
+
+    def __setstate__(self, stato):
+        super().__setstate__(stato)
+        self._crea_cache_termini()
+
+
+# Testo in minuscolo e senza accenti: "Università" e "universita" diventano uguali
+def normalizza(testo):
+    scomposto = unicodedata.normalize("NFKD", testo.casefold())
+    return "".join(c for c in scomposto if not unicodedata.combining(c))
+
+
+# Prefissi indicizzati della rubrica: i termini più lunghi si cercano col prefisso e poi si verificano
+PREFISSO_MAX = 12
+
+
+class IndiceRubrica:
+    """
+    Indice per prefisso della rubrica, costruito una sola volta al caricamento.
+      - voci: (anno, materia, professore, email), una per docente di ogni materia, in ordine di rubrica
+      - token: per ogni voce i token normalizzati di professore, materia ed email
+      - prefissi: prefisso (fino a PREFISSO_MAX caratteri) -> insieme degli id delle voci
+        con almeno un token che inizia così
+
+    Una voce corrisponde se ogni termine della query è l'inizio di un suo token ("ross", "anal mat",
+    "mario.rossi@univpm"): basta una lettura del dizionario per termine, qualunque sia la dimensione
+    della rubrica, e le maiuscole e gli accenti non contano.
+    """
+
+    def __init__(self, rubrica):
+        self.voci = []
+        self.token = []
+        prefissi = {}
+        for anno, materie in rubrica.items():
+            for materia, professori in materie.items():
+                for professore, email in professori.items():
+                    voce_id = len(self.voci)
+                    self.voci.append((anno, materia, professore, email))
+                    token = frozenset(RE_TOKEN.findall(normalizza(f"{professore} {materia} {email}")))
+                    self.token.append(token)
+                    for t in token:
+                        for fine in range(1, min(len(t), PREFISSO_MAX) + 1):
+                            prefissi.setdefault(t[:fine], []).append(voce_id)
+        self.prefissi = {prefisso: frozenset(ids) for prefisso, ids in prefissi.items()}
+
+    def _voci_con(self, termine):
+        voci = self.prefissi.get(termine[:PREFISSO_MAX], frozenset())
+        if len(termine) > PREFISSO_MAX:
+            voci = {v for v in voci if any(t.startswith(termine) for t in self.token[v])}
+        return voci
+
+    # Id delle voci che corrispondono a tutti i termini, in ordine di rubrica
+    def cerca(self, query):
+        termini = set(RE_TOKEN.findall(normalizza(query)))
+        if not termini:
+            return []
+        insiemi = sorted((self._voci_con(t) for t in termini), key=len)
+        # l'intersezione scorre l'insieme più piccolo: il costo dipende dai risultati, non dalla rubrica
+        return sorted(insiemi[0].intersection(*insiemi[1:]))
+
+
+# Strutture derivate dall'archivio, costruite al caricamento (o lette dallo snapshot).
+# Negli elenchi i file di ogni cartella diventano l'intervallo (range) delle loro posizioni
+# nell'indice, i primi del sottoalbero: i RecordFile letti dal JSON non servono più
+def costruisci_derivati(archivio):
+    elenchi = elenchi_ordinati(archivio)
+    indice = IndiceRicerca(archivio, elenchi)
+    elenchi = {
+        percorso: (sottocartelle, range(indice.sottoalberi[percorso][0], indice.sottoalberi[percorso][0] + len(files)))
+        for percorso, (sottocartelle, files) in elenchi.items()
+    }
+    return {
+        "root_name": list(archivio.keys())[0],
+        "indice": indice,
+        "elenchi": elenchi,
+        "registro": RegistroPercorsi(elenchi),
+    }
+
+
+class StatoArchivio:
+    """
+    Rubrica e tutte le strutture derivate dall'archivio (indice, elenchi, registri, cache),
+    costruiti insieme e mai modificati dopo: per aggiornarli se ne crea uno nuovo
+    e lo si sostituisce in blocco, così nessuno vede un archivio costruito a metà.
+    L'archivio letto dal JSON serve solo a costruire le strutture derivate (se non sono già
+    pronte, dallo snapshot) e non viene tenuto: i file si leggono da indice.files.
+    """
+
+    def __init__(self, archivio, rubrica, cache_risultati=None, cache_tastiere=None, cache_inline=None,
+                 derivati=None):
+        if derivati is None:
+            derivati = costruisci_derivati(archivio)
+        self.root_name = derivati["root_name"]
+        self.rubrica = rubrica
+        self.indice = derivati["indice"]
+        self.elenchi = derivati["elenchi"]
+        self.registro = derivati["registro"]
+        self.registro_mail = RegistroPercorsi(percorsi_rubrica(rubrica))
+        self.indice_mail = IndiceRubrica(rubrica)
+        self.cache_risultati = cache_risultati if cache_risultati is not None else CacheLRU()
+        self.cache_tastiere = cache_tastiere if cache_tastiere is not None else CacheLRU()
+        self.cache_inline = cache_inline if cache_inline is not None else CacheLRU()
+
+
+def carica_json(percorso):
+    with open(percorso, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# SNAPSHOT BINARIO: indice (file compresi), elenchi e registro, pronti da usare
+
+SNAPSHOT_MAGIC = b"FCPSNAP"
+# Da incrementare a ogni modifica delle strutture salvate nello snapshot
+SNAPSHOT_VERSIONE = 4
+# Ogni vettore dell'immagine piatta inizia a un multiplo di 8 byte del file
+SNAPSHOT_ALLINEAMENTO = 8
+
+
+# Identifica la versione di archivio.json da cui è stato costruito lo snapshot
+def firma_sorgente(percorso_json):
+    info = os.stat(percorso_json)
+    return (info.st_size, info.st_mtime_ns)
+
+
+def _allinea(posizione):
+    return -(-posizione // SNAPSHOT_ALLINEAMENTO) * SNAPSHOT_ALLINEAMENTO
+
+
+def scrivi_snapshot(percorso_snapshot, percorso_json):
+    """
+    Costruisce le strutture derivate da archivio.json e le salva in un pickle (protocollo 5)
+    i cui vettori (testi e array di interi delle strutture piatte) stanno fuori dal pickle,
+    ognuno allineato, così alla lettura si usano sul posto. Formato, dopo magic e versione:
+    numero di pezzi, lunghezza di ogni pezzo (array "Q"), il pickle, poi i vettori; i numeri
+    sono nel formato della macchina, come gli array. La scrittura passa da un file
+    temporaneo, quindi chi legge non vede mai uno snapshot a metà.
+    """
+    firma = firma_sorgente(percorso_json)
+    derivati = costruisci_derivati(carica_archivio(percorso_json))
+    vettori = []
+    dati = pickle.dumps({"sorgente": firma, **derivati}, protocol=5, buffer_callback=vettori.append)
+    pezzi = [memoryview(dati)] + [vettore.raw() for vettore in vettori]
+    lunghezze = array("Q", [len(pezzi)] + [pezzo.nbytes for pezzo in pezzi])
+    with scrittura_atomica(percorso_snapshot, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSIONE]))
+        f.write(lunghezze)
+        for pezzo in pezzi:
+            f.write(bytes(_allinea(f.tell()) - f.tell()))
+            f.write(pezzo)
+
+
+def leggi_snapshot(percorso_snapshot, percorso_json):
+    """
+    Legge lo snapshot mappandolo in memoria: si deserializzano solo le strutture per cartella,
+    i vettori dell'immagine piatta restano viste sulla mappa (nessuna copia, pagine condivise
+    con gli altri processi che la leggono). La mappa resta aperta finché lo stato è in uso.
+    Restituisce le strutture derivate, oppure None se lo snapshot manca, è di un'altra
+    versione o non corrisponde più ad archivio.json: in quel caso si ricarica il JSON.
+    """
+    try:
+        with open(percorso_snapshot, "rb") as f:
+            mappa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        vista = memoryview(mappa)
+        posizione = len(SNAPSHOT_MAGIC) + 1
+        if vista[:posizione] != SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSIONE]):
+            return None
+        numero = vista[posizione:posizione + 8].cast("Q")[0]
+        lunghezze = vista[posizione + 8:posizione + 8 * (numero + 1)].cast("Q")
+        posizione += 8 * (numero + 1)
+        pezzi = []
+        for lunghezza in lunghezze:
+            posizione = _allinea(posizione)
+            if posizione + lunghezza > len(vista):
+                return None
+            pezzi.append(vista[posizione:posizione + lunghezza])
+            posizione += lunghezza
+        dati = pickle.loads(pezzi[0], buffers=pezzi[1:])
+    except (OSError, ValueError, EOFError, TypeError, pickle.UnpicklingError):
+        return None
+    if dati["sorgente"] != firma_sorgente(percorso_json):
+        return None
+    del dati["sorgente"]
+    return dati
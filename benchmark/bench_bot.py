@@ -0,0 +1,264 @@
+"""
+Benchmark del bot su un archivio sintetico (o su uno esistente): caricamento, memoria,
+ricerca (cerca_in_cartelle) e tastiere (costruisci_keyboard / genera_keyboard).
+I risultati vengono salvati in JSON; con --confronta si confrontano con quelli di una versione precedente.
+
+Uso: python benchmark/bench_bot.py [--file 100000] [--profondita 4] [--ramificazione 6] [--seed 0]
+                                   [--archivio archivio.json --rubrica emails.json]
+                                   [--output risultati.json] [--confronta risultati_vecchi.json]
+                                   [--soglia 1.2]
+
+Senza --archivio l'archivio viene generato con genera_archivio.py in una cartella temporanea.
+Con --confronta l'uscita è 1 se qualche misura è peggiorata oltre la soglia (rapporto sui tempi mediani).
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import random
+import asyncio
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+CARTELLA_BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+CARTELLA_PROGETTO = os.path.dirname(CARTELLA_BENCHMARK)
+sys.path.insert(0, CARTELLA_PROGETTO)
+sys.path.insert(0, CARTELLA_BENCHMARK)
+
+from genera_archivio import genera
+from archivio_indice import StatoArchivio, carica_archivio, carica_json, scrivi_snapshot, leggi_snapshot
+from cache_lru import CacheLRU
+
+
+# Memoria residente del processo in MB (Linux), altrimenti il picco
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for riga in f:
+                if riga.startswith("VmRSS:"):
+                    return int(riga.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco / 2**20 if sys.platform == "darwin" else picco / 1024
+
+
+# Tempi in ms di `ripetizioni` chiamate di funzione(argomento) su argomenti presi a giro
+def misura(funzione, argomenti, ripetizioni):
+    tempi = []
+    for i in range(ripetizioni):
+        argomento = argomenti[i % len(argomenti)]
+        inizio = time.perf_counter()
+        funzione(argomento)
+        tempi.append((time.perf_counter() - inizio) * 1000)
+    return riassunto(tempi)
+
+
+def riassunto(tempi):
+    tempi = sorted(tempi)
+    return {
+        "ripetizioni": len(tempi),
+        "min_ms": round(tempi[0], 4),
+        "mediana_ms": round(tempi[len(tempi) // 2], 4),
+        "p95_ms": round(tempi[min(len(tempi) - 1, int(len(tempi) * 0.95))], 4),
+        "max_ms": round(tempi[-1], 4),
+    }
+
+
+def misura_caricamento(percorso_archivio, percorso_rubrica, cartella):
+    risultati = {}
+
+    # tempi (e memoria residente) senza tracemalloc, che rallenta molto le allocazioni
+    gc.collect()
+    rss_prima = rss_mb()
+    inizio = time.perf_counter()
+    archivio = carica_archivio(percorso_archivio)
+    risultati["carica_archivio_s"] = round(time.perf_counter() - inizio, 4)
+    inizio = time.perf_counter()
+    stato = StatoArchivio(archivio, carica_json(percorso_rubrica))
+    risultati["costruisci_indice_s"] = round(time.perf_counter() - inizio, 4)
+    # l'archivio letto dal JSON serve solo a costruire lo stato: si libera prima di misurare
+    del archivio
+    gc.collect()
+    risultati["rss_stato_mb"] = round(rss_mb() - rss_prima, 2)
+
+    # memoria allocata da archivio e indice, con un secondo caricamento
+    tracemalloc.start()
+    copia = StatoArchivio(carica_archivio(percorso_archivio), {})
+    gc.collect()
+    residua, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del copia
+    risultati["memoria_stato_mb"] = round(residua / 2**20, 2)
+    risultati["memoria_picco_mb"] = round(picco / 2**20, 2)
+
+    snapshot = os.path.join(cartella, "archivio.snapshot")
+    inizio = time.perf_counter()
+    scrivi_snapshot(snapshot, percorso_archivio)
+    risultati["scrivi_snapshot_s"] = round(time.perf_counter() - inizio, 4)
+    inizio = time.perf_counter()
+    leggi_snapshot(snapshot, percorso_archivio)
+    risultati["leggi_snapshot_s"] = round(time.perf_counter() - inizio, 4)
+    os.remove(snapshot)
+    return stato, risultati
+
+
+# Query realistiche: parole di titoli e tag presi a caso (comuni e rare), coppie di parole,
+# prefissi brevi e parole che non ci sono
+def genera_query(stato, rnd, quante=200):
+    files = stato.indice.files
+    query = []
+    for _ in range(quante):
+        file = files[rnd.randrange(len(files))]
+        parole = [p for p in (file.titolo + " " + " ".join(file.tag)).split() if len(p) > 2]
+        tipo = rnd.random()
+        if tipo < 0.5:
+            query.append(rnd.choice(parole))
+        elif tipo < 0.8:
+            query.append(" ".join(rnd.sample(parole, min(2, len(parole)))))
+        elif tipo < 0.95:
+            query.append(rnd.choice(parole)[:3])
+        else:
+            query.append("zxqwv")
+    return query
+
+
+def bench_bot(stato, rnd, ripetizioni):
+    # FCP_bot carica l'archivio della cartella corrente all'import: la cartella è quella dei dati
+    import FCP_bot as bot
+
+    stato.cache_tastiere = CacheLRU(bot.TASTIERE_CACHE_MAX)
+    risultati = {}
+
+    query = genera_query(stato, rnd)
+    risultati["cerca_in_cartelle_alfabetico"] = misura(lambda q: bot.cerca_in_cartelle(stato, q), query, ripetizioni)
+    k = bot.PAGINE_PER_RICERCA * bot.RISULTATI_PER_PAGINA
+    risultati["cerca_in_cartelle_rilevanza"] = misura(lambda q: bot.cerca_in_cartelle(stato, q, k), query, ripetizioni)
+
+    # cartelle e pagine a caso: tastiera costruita da zero e poi presa dalla cache
+    cartelle = list(stato.elenchi)
+    pagine = []
+    for percorso in rnd.sample(cartelle, min(len(cartelle), 500)):
+        sottocartelle, files = stato.elenchi[percorso]
+        num_pagine = max(1, (len(sottocartelle) + len(files) - 1) // bot.ELEMENTI_PER_PAGINA + 1)
+        pagine.append((list(percorso), rnd.randrange(num_pagine)))
+    risultati["costruisci_keyboard"] = misura(lambda pp: bot.costruisci_keyboard(stato, *pp), pagine, ripetizioni)
+
+    async def genera_tutte():
+        tempi_freddi, tempi_caldi = [], []
+        for tempi in (tempi_freddi, tempi_caldi):
+            for percorso, pagina in pagine:
+                inizio = time.perf_counter()
+                await bot.genera_keyboard(stato, percorso, pagina)
+                tempi.append((time.perf_counter() - inizio) * 1000)
+        return riassunto(tempi_freddi), riassunto(tempi_caldi)
+
+    stato.cache_tastiere.clear()
+    risultati["genera_keyboard_nuova"], risultati["genera_keyboard_in_cache"] = asyncio.run(genera_tutte())
+    bot.esecutore.chiudi()
+    return risultati
+
+
+def versione_git():
+    try:
+        return subprocess.run(
+            ["git", "-C", CARTELLA_PROGETTO, "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Rapporti nuovo/vecchio dei tempi (mediane per le misure ripetute, secondi per il caricamento)
+def confronta(nuovi, vecchi, soglia):
+    peggiorati = []
+    print(f"{'misura':<40}{'prima':>12}{'ora':>12}{'rapporto':>10}")
+    for sezione in ("caricamento", "operazioni"):
+        for nome, valore in nuovi[sezione].items():
+            precedente = vecchi.get(sezione, {}).get(nome)
+            if precedente is None:
+                continue
+            if isinstance(valore, dict):
+                valore, precedente = valore["mediana_ms"], precedente["mediana_ms"]
+            if not precedente:
+                continue
+            rapporto = valore / precedente
+            segno = " ⚠️" if rapporto > soglia else ""
+            print(f"{nome:<40}{precedente:>12.4f}{valore:>12.4f}{rapporto:>10.2f}{segno}")
+            if rapporto > soglia:
+                peggiorati.append(nome)
+    return peggiorati
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del bot su un archivio sintetico")
+    parser.add_argument("--file", type=int, default=100000)
+    parser.add_argument("--profondita", type=int, default=4)
+    parser.add_argument("--ramificazione", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--archivio", help="archivio esistente da usare invece di generarlo")
+    parser.add_argument("--rubrica", help="rubrica da usare con --archivio")
+    parser.add_argument("--ripetizioni", type=int, default=1000)
+    parser.add_argument("--output", default="risultati_benchmark.json")
+    parser.add_argument("--confronta", help="risultati di una versione precedente")
+    parser.add_argument("--soglia", type=float, default=1.2, help="rapporto oltre il quale una misura è peggiorata")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory() as cartella:
+        percorso_archivio = os.path.join(cartella, "archivio.json")
+        percorso_rubrica = os.path.join(cartella, "emails.json")
+        if args.archivio:
+            os.symlink(os.path.abspath(args.archivio), percorso_archivio)
+            with open(percorso_rubrica, "w", encoding="utf-8") as f:
+                json.dump(carica_json(args.rubrica) if args.rubrica else {}, f)
+            archivio_info = {"sorgente": args.archivio}
+        else:
+            inizio = time.perf_counter()
+            archivio_info = genera(percorso_archivio, percorso_rubrica, args.file, args.profondita,
+                                   args.ramificazione, args.seed)
+            print(f"📦 Archivio sintetico: {archivio_info['file']} file, {archivio_info['cartelle']} cartelle "
+                  f"({time.perf_counter() - inizio:.1f} s)")
+        archivio_info["dimensione_mb"] = round(os.path.getsize(percorso_archivio) / 2**20, 2)
+
+        stato, caricamento = misura_caricamento(percorso_archivio, percorso_rubrica, cartella)
+        print(f"⏱️ Caricamento: {json.dumps(caricamento)}")
+
+        os.chdir(cartella)
+        operazioni = bench_bot(stato, random.Random(args.seed), args.ripetizioni)
+
+    risultati = {
+        "meta": {
+            "versione": versione_git(),
+            "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "piattaforma": platform.platform(),
+            "archivio": archivio_info,
+            "ripetizioni": args.ripetizioni,
+        },
+        "caricamento": caricamento,
+        "operazioni": operazioni,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(risultati, f, ensure_ascii=False, indent=2)
+    for nome, valori in operazioni.items():
+        print(f"{nome:<40} mediana {valori['mediana_ms']:.4f} ms  p95 {valori['p95_ms']:.4f} ms")
+    print(f"✅ Risultati in '{output}'")
+
+    if args.confronta:
+        with open(args.confronta, "r", encoding="utf-8") as f:
+            peggiorati = confronta(risultati, json.load(f), args.soglia)
+        if peggiorati:
+            print(f"❌ Peggiorati oltre {args.soglia}x: {', '.join(peggiorati)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
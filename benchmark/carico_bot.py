@@ -0,0 +1,374 @@
+"""
+Test di carico: l'Application vera del bot (FCP_bot.crea_app) riceve update sintetici a un ritmo
+fissato e risponde a una Bot API finta locale (un processo a parte, con latenza configurabile).
+Misura la latenza end-to-end di ogni update (dalla consegna al bot alla fine dei suoi handler,
+chiamate alla Bot API comprese), il throughput e gli errori.
+
+Uso: python benchmark/carico_bot.py [--ritmo 200] [--durata 30] [--chat 500] [--gruppo]
+                                    [--mix start=1,cerca=3,pagina=1,nav=5,mail=2,docente=1]
+                                    [--latenza-api 0.05] [--errori-api 0] [--senza-limiti]
+                                    [--file 100000 | --archivio archivio.json --rubrica emails.json]
+                                    [--output carico.json] [--popolari popolari.json]
+
+--gruppo: tutti gli update arrivano dalla stessa chat di gruppo (il caso del gruppo di un corso
+che inonda il bot), da --chat utenti diversi. --senza-limiti toglie i limiti di invio verso
+Telegram, per misurare solo il bot. Con i limiti attivi il throughput non supera INVII_AL_SECONDO,
+e con --gruppo INVII_GRUPPO_AL_MINUTO: gli update rimasti in attesa alla fine sono "non_completati",
+quelli mai gestiti sono "saltati": arrivati con la fila della chat già piena (UPDATE_IN_ATTESA_CHAT),
+oppure click superati da un click più recente sullo stesso messaggio (update_in_fila li distingue).
+--popolari: le cache partono riscaldate con i conteggi del file, aggiornati alla fine del giro;
+due giri di fila con lo stesso file confrontano l'avvio a freddo con quello a caldo (cache_hit).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CARTELLA_BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CARTELLA_BENCHMARK))
+sys.path.insert(0, CARTELLA_BENCHMARK)
+
+from genera_archivio import genera
+from bench_bot import genera_query
+
+TOKEN_FINTO = "123456:FINTO"
+
+
+# --- Bot API finta ----------------------
+
+class GestoreBotAPI(BaseHTTPRequestHandler):
+    """Risponde come la Bot API: getMe, messaggi inviati o modificati, tutto il resto True."""
+
+    protocol_version = "HTTP/1.1"
+    latenza = 0.0
+    errori = 0.0
+    chiamate = {}
+    lock = threading.Lock()
+    contatore_messaggi = iter(range(1, 10**12))
+
+    def log_message(self, *args):
+        pass
+
+    def rispondi(self, codice, dati):
+        corpo = json.dumps(dati).encode("utf-8")
+        self.send_response(codice)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        if self.path == "/statistiche":
+            with self.lock:
+                return self.rispondi(200, dict(self.chiamate))
+        self.rispondi(404, {"ok": False})
+
+    def do_POST(self):
+        corpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        metodo = self.path.rsplit("/", 1)[-1]
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            dati = json.loads(corpo or b"{}")
+        else:
+            dati = {k: v[0] for k, v in urllib.parse.parse_qs(corpo.decode("utf-8")).items()}
+        with self.lock:
+            self.chiamate[metodo] = self.chiamate.get(metodo, 0) + 1
+        if self.latenza:
+            time.sleep(self.latenza)
+        if self.errori and metodo != "getMe" and random.random() < self.errori:
+            return self.rispondi(429, {
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        self.rispondi(200, {"ok": True, "result": self.risultato(metodo, dati)})
+
+    def risultato(self, metodo, dati):
+        if metodo == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "FCP", "username": "fcp_carico_bot"}
+        if metodo in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(dati.get("chat_id", 0))
+            return {
+                "message_id": int(dati.get("message_id") or next(self.contatore_messaggi)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "text": dati.get("text", ""),
+            }
+        return True
+
+
+def servi_bot_api(porta, latenza, errori, pronto):
+    GestoreBotAPI.latenza = latenza
+    GestoreBotAPI.errori = errori
+    server = ThreadingHTTPServer(("127.0.0.1", porta), GestoreBotAPI)
+    server.daemon_threads = True
+    pronto.set()
+    server.serve_forever()
+
+
+def avvia_bot_api(porta, latenza, errori):
+    pronto = multiprocessing.Event()
+    processo = multiprocessing.Process(target=servi_bot_api, args=(porta, latenza, errori, pronto), daemon=True)
+    processo.start()
+    pronto.wait(10)
+    return processo
+
+
+def statistiche_bot_api(porta):
+    import urllib.request
+    with urllib.request.urlopen(f"http://127.0.0.1:{porta}/statistiche", timeout=10) as risposta:
+        return json.load(risposta)
+
+
+# --- Update sintetici ----------------------
+
+class GeneratoreUpdate:
+    """
+    Update in formato Bot API per i flussi: start, cerca (/cerca <query>), pagina (search:<id>:1),
+    nav (nav:<cartella>:<pagina>), mail (mail:back, mail:<anno>, mail:<anno>:<materia>)
+    e docente (/mail <parola di un nome, una materia o un'email>).
+    """
+
+    def __init__(self, bot, stato, rnd, num_chat, gruppo):
+        self.rnd = rnd
+        self.num_chat = num_chat
+        self.gruppo = gruppo
+        self.numero = 0
+        self.query = genera_query(stato, rnd, 300)
+        # ricerche già fatte, come dopo un /cerca: il pulsante "Successivo" porta alla pagina 1
+        self.ricerche = []
+        for q in self.query:
+            rid = bot.id_ricerca(q)
+            bot.query_per_id[rid] = (q, None)
+            self.ricerche.append(rid)
+        self.nav = []
+        for percorso, (sottocartelle, files) in stato.elenchi.items():
+            pagine = max(1, (len(sottocartelle) + len(files) - 1) // bot.ELEMENTI_PER_PAGINA + 1)
+            self.nav.append((stato.registro.id(list(percorso)), pagine))
+        self.mail = ["mail:back"]
+        for anno, materie in stato.rubrica.items():
+            mid1 = stato.registro_mail.id([anno])
+            self.mail.append(f"mail:{mid1}")
+            self.mail.extend(f"mail:{mid1}:{stato.registro_mail.id([anno, m])}" for m in materie)
+        self.docenti = sorted({
+            parola for voce in stato.indice_mail.voci for parola in " ".join(voce[1:]).split() if len(parola) > 2
+        }) or ["rossi"]
+
+    def _mittente(self):
+        utente = self.rnd.randint(1, self.num_chat)
+        chat = {"id": -1001234567890, "type": "supergroup", "title": "Corso"} if self.gruppo else \
+            {"id": utente, "type": "private"}
+        return {"id": utente, "is_bot": False, "first_name": f"Utente{utente}", "username": f"utente{utente}"}, chat
+
+    def messaggio(self, testo):
+        self.numero += 1
+        utente, chat = self._mittente()
+        comando = testo.split()[0]
+        return {"update_id": self.numero, "message": {
+            "message_id": self.numero, "date": int(time.time()), "chat": chat, "from": utente, "text": testo,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(comando)}],
+        }}
+
+    def callback(self, dati):
+        self.numero += 1
+        utente, chat = self._mittente()
+        return {"update_id": self.numero, "callback_query": {
+            "id": str(self.numero), "from": utente, "chat_instance": str(chat["id"]), "data": dati,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "menu"},
+        }}
+
+    def crea(self, flusso):
+        if flusso == "start":
+            return self.messaggio("/start")
+        if flusso == "cerca":
+            return self.messaggio(f"/cerca {self.rnd.choice(self.query)}")
+        if flusso == "pagina":
+            return self.callback(f"search:{self.rnd.choice(self.ricerche)}:1")
+        if flusso == "nav":
+            short_id, pagine = self.rnd.choice(self.nav)
+            return self.callback(f"nav:{short_id}:{self.rnd.randrange(pagine)}")
+        if flusso == "mail":
+            return self.callback(self.rnd.choice(self.mail))
+        if flusso == "docente":
+            return self.messaggio(f"/mail {self.rnd.choice(self.docenti)}")
+        raise ValueError(f"flusso sconosciuto: {flusso}")
+
+
+# --- Misura ----------------------
+
+def percentili(tempi):
+    if not tempi:
+        return {}
+    tempi = sorted(tempi)
+
+    def p(q):
+        return round(tempi[min(len(tempi) - 1, int(len(tempi) * q))] * 1000, 2)
+
+    return {"n": len(tempi), "p50_ms": p(0.50), "p95_ms": p(0.95), "p99_ms": p(0.99), "max_ms": p(1.0)}
+
+
+async def esegui_carico(bot, args, porta):
+    from telegram import Update
+    from limitatore_invii import LimitatoreInvii
+
+    if args.senza_limiti:
+        bot.limitatore_invii = LimitatoreInvii(10**6, 10**6, 10**6, 10**6, 0)
+    bot.METRICHE_PORTA = 0
+    app = bot.crea_app(TOKEN_FINTO, base_url=f"http://127.0.0.1:{porta}")
+
+    errori = {}
+
+    async def conta_errore(update, context):
+        nome = type(context.error).__name__
+        errori[nome] = errori.get(nome, 0) + 1
+
+    app.add_error_handler(conta_errore)
+
+    rnd = random.Random(args.seed)
+    generatore = GeneratoreUpdate(bot, bot.stato_corrente, rnd, args.chat, args.gruppo)
+    flussi, pesi = zip(*args.mix.items())
+    latenze = {flusso: [] for flusso in flussi}
+
+    saltati = {flusso: 0 for flusso in flussi}
+
+    # come fa l'Application con ogni update ricevuto: passa dal processore (concorrenza e ordine per chat)
+    async def consegna(flusso, update):
+        inizio = time.perf_counter()
+        avviata = False
+
+        async def gestisci():
+            nonlocal avviata
+            avviata = True
+            await app.process_update(update)
+
+        gestione = gestisci()
+        try:
+            await app.update_processor.process_update(update, gestione)
+        finally:
+            # se l'update è stato annullato mentre era in attesa, la coroutine non è mai partita
+            gestione.close()
+        if avviata:
+            latenze[flusso].append(time.perf_counter() - inizio)
+        else:
+            saltati[flusso] += 1  # fila della chat piena o click superato
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    try:
+        totale = int(args.ritmo * args.durata)
+        compiti = set()
+        inizio = time.perf_counter()
+        for i in range(totale):
+            ritardo = inizio + i / args.ritmo - time.perf_counter()
+            if ritardo > 0:
+                await asyncio.sleep(ritardo)
+            flusso = rnd.choices(flussi, pesi)[0]
+            update = Update.de_json(generatore.crea(flusso), app.bot)
+            compito = asyncio.create_task(consegna(flusso, update))
+            compiti.add(compito)
+            compito.add_done_callback(compiti.discard)
+        invio_s = time.perf_counter() - inizio
+        if compiti:
+            await asyncio.wait(set(compiti), timeout=args.attesa_finale)
+        durata = time.perf_counter() - inizio
+        non_completati = len(compiti)
+        for compito in list(compiti):
+            compito.cancel()
+        await asyncio.gather(*compiti, return_exceptions=True)
+    finally:
+        await app.stop()
+        await app.post_shutdown(app)
+        await app.shutdown()
+
+    completati = sum(len(t) for t in latenze.values())
+    return {
+        "inviati": totale,
+        "completati": completati,
+        "saltati": sum(saltati.values()),
+        "non_completati": non_completati,
+        "errori": errori,
+        "ritmo_richiesto": args.ritmo,
+        "ritmo_ottenuto": round(totale / invio_s, 1),
+        "throughput": round(completati / durata, 1),
+        "durata_s": round(durata, 2),
+        "latenza": percentili([t for tempi in latenze.values() for t in tempi]),
+        "latenza_per_flusso": {flusso: percentili(tempi) for flusso, tempi in latenze.items()},
+        "update_in_fila": bot.processore_chat.statistiche(),
+        "invii_telegram": bot.limitatore_invii.statistiche(),
+        "cache_hit": {n: round(p, 3) if p is not None else None for n, p in bot.percentuali_hit().items()},
+    }
+
+
+def leggi_mix(testo):
+    mix = {}
+    for parte in testo.split(","):
+        nome, peso = parte.split("=")
+        mix[nome.strip()] = float(peso)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico del bot con una Bot API finta")
+    parser.add_argument("--ritmo", type=float, default=200, help="update al secondo")
+    parser.add_argument("--durata", type=float, default=30, help="secondi di invio")
+    parser.add_argument("--chat", type=int, default=500, help="utenti (e chat private) diversi")
+    parser.add_argument("--gruppo", action="store_true", help="tutti gli update dalla stessa chat di gruppo")
+    parser.add_argument("--mix", type=leggi_mix, default=leggi_mix("start=1,cerca=3,pagina=1,nav=5,mail=2,docente=1"))
+    parser.add_argument("--latenza-api", type=float, default=0.05, help="secondi di risposta della Bot API finta")
+    parser.add_argument("--errori-api", type=float, default=0.0, help="frazione di risposte 429 della Bot API")
+    parser.add_argument("--senza-limiti", action="store_true", help="niente limiti di invio verso Telegram")
+    parser.add_argument("--attesa-finale", type=float, default=60, help="secondi per finire gli update in corso")
+    parser.add_argument("--porta", type=int, default=8981)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--file", type=int, default=100000, help="file dell'archivio sintetico")
+    parser.add_argument("--archivio", help="archivio esistente da usare invece di generarlo")
+    parser.add_argument("--rubrica", help="rubrica da usare con --archivio")
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--popolari", help="conteggi delle ricerche (popolari.json) con cui riscaldare le cache "
+                                           "all'avvio; vengono aggiornati alla fine, così un secondo giro parte caldo")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    popolari = os.path.abspath(args.popolari) if args.popolari else None
+
+    processo_api = avvia_bot_api(args.porta, args.latenza_api, args.errori_api)
+    try:
+        with tempfile.TemporaryDirectory() as cartella:
+            archivio = os.path.join(cartella, "archivio.json")
+            rubrica = os.path.join(cartella, "emails.json")
+            if args.archivio:
+                os.symlink(os.path.abspath(args.archivio), archivio)
+                if args.rubrica:
+                    os.symlink(os.path.abspath(args.rubrica), rubrica)
+            else:
+                genera(archivio, rubrica, args.file, seed=args.seed)
+            if popolari and os.path.exists(popolari):
+                shutil.copyfile(popolari, os.path.join(cartella, "popolari.json"))
+            # FCP_bot carica archivio, emails e conteggi delle ricerche della cartella corrente all'import
+            os.chdir(cartella)
+            import FCP_bot as bot
+            risultati = asyncio.run(esegui_carico(bot, args, args.porta))
+            if popolari:
+                shutil.copyfile(bot.POPOLARI_FILE, popolari)
+        risultati["chiamate_bot_api"] = statistiche_bot_api(args.porta)
+    finally:
+        processo_api.terminate()
+
+    testo = json.dumps(risultati, ensure_ascii=False, indent=2)
+    print(testo)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(testo)
+    return 1 if risultati["non_completati"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+"""
+Drive finto in memoria per provare crea_archivio_conTag.py senza un account Google: risponde come
+il service di googleapiclient a files().list (i figli di una cartella, a pagine) e al feed changes,
+con latenza ed errori 429 configurabili. Genera un albero sintetico (nomi come
+benchmark/genera_archivio.py) e verifica che:
+  - il crawl sequenziale (build_and_tag_tree) e quello parallelo (build_and_tag_tree_parallelo)
+    diano lo stesso albero, anche con le risposte divise in tante pagine
+  - dopo ogni giro di modifiche casuali (file nuovi, rinominati, spostati, cestinati o eliminati,
+    cartelle nuove, spostate dentro o fuori dall'archivio, root rinominata) la sincronizzazione
+    incrementale (sincronizza) dia lo stesso archivio di un crawl completo
+Riporta tempi e chiamate di ogni passo.
+
+Uso: python benchmark/drive_finto.py [--cartelle 300] [--file 3000] [--pagina 7] [--worker 8]
+                                     [--giri 5] [--modifiche 60] [--latenza 0.002] [--errori 0] [--seed 0]
+
+--pagina: elementi al massimo per risposta (il crawler ne chiede 1000, qui si forza la paginazione).
+--errori: frazione delle richieste che falliscono con 429; il crawler le ripete dopo 1-2 s.
+Termina con codice 1 se una verifica fallisce.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import collections
+import threading
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+CARTELLA_BENCHMARK = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CARTELLA_BENCHMARK))
+sys.path.insert(0, CARTELLA_BENCHMARK)
+
+from genera_archivio import AGGIUNTO_DAL, AGGIUNTO_AL, nomi_livello, titolo_file
+from crea_archivio_conTag import (
+    FOLDER_MIME, albero_da_nodi, build_and_tag_tree, build_and_tag_tree_parallelo, esegui_con_retry, sincronizza,
+)
+
+RE_PARENT = re.compile(r"'([^']+)' in parents")
+
+
+class RichiestaFinta:
+    """Come una HttpRequest di googleapiclient: la chiamata parte con execute()."""
+
+    def __init__(self, drive, metodo, risposta):
+        self.drive = drive
+        self.methodId = metodo
+        self._risposta = risposta
+
+    def execute(self):
+        return self.drive.esegui(self._risposta)
+
+
+class FilesFinti:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def list(self, q, pageSize=100, pageToken=None, **opzioni):
+        parent = RE_PARENT.search(q).group(1)
+        return RichiestaFinta(self.drive, "drive.files.list",
+                              lambda: self.drive.pagina_figli(parent, pageSize, pageToken))
+
+
+class ChangesFinti:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def getStartPageToken(self, **opzioni):
+        return RichiestaFinta(self.drive, "drive.changes.getStartPageToken",
+                              lambda: {"startPageToken": str(len(self.drive.modifiche))})
+
+    def list(self, pageToken, pageSize=100, **opzioni):
+        return RichiestaFinta(self.drive, "drive.changes.list",
+                              lambda: self.drive.pagina_modifiche(pageToken, pageSize))
+
+
+class DriveFinto:
+    """
+    Albero di cartelle e file in memoria con la parte dell'API Drive v3 usata dal crawler:
+      - files().list(q="'<id>' in parents and trashed = false", pageSize, pageToken): i figli di una
+        cartella nell'ordine di inserimento, al massimo min(pageSize, pagina) per risposta
+      - changes().getStartPageToken() e changes().list(pageToken, pageSize): gli elementi modificati
+        dopo il token, una volta sola e nella posizione della loro ultima modifica, con lo stato
+        attuale (removed per quelli eliminati), poi newStartPageToken
+      - aggiungi, rinomina, sposta, cestina, elimina: modificano l'albero e finiscono nel feed changes.
+        "root" è la radice del Drive: ciò che sta lì o sotto altre cartelle è fuori dall'archivio
+      - latenza: secondi di attesa di ogni richiesta; errori: frazione di richieste che falliscono
+        con 429 (decise da un generatore con seed, quindi ripetibili)
+    Lo stesso oggetto può servire più thread, come un service per thread del crawler.
+    """
+
+    def __init__(self, nome_root="Appunti FreeCultureProject", pagina=1000, latenza=0.0, errori=0.0, seed=0):
+        self.pagina = pagina
+        self.latenza = latenza
+        self.errori = errori
+        self.chiamate = 0
+        self.elementi = {}  # id -> {id, name, mimeType, parents, createdTime}
+        self.figli = {"root": []}  # id della cartella -> id dei figli non cestinati, in ordine
+        self.modifiche = []  # id degli elementi modificati, in ordine (il page token è una posizione)
+        self._ultima_modifica = {}  # id -> posizione della sua ultima modifica
+        self._casuale = random.Random(seed)
+        self._contatore = itertools.count()
+        self._lock = threading.Lock()
+        self.root_id = self.aggiungi(nome_root, FOLDER_MIME, "root")
+
+    def files(self):
+        return FilesFinti(self)
+
+    def changes(self):
+        return ChangesFinti(self)
+
+    def aggiungi(self, nome, mime, parent, creato=None):
+        with self._lock:
+            elemento_id = f"id{next(self._contatore):06d}"
+            self.elementi[elemento_id] = {
+                "id": elemento_id, "name": nome, "mimeType": mime, "parents": [parent],
+                "createdTime": creato or "2024-01-01T00:00:00.000Z", "trashed": False,
+            }
+            self.figli[parent].append(elemento_id)
+            if mime == FOLDER_MIME:
+                self.figli[elemento_id] = []
+            self._registra(elemento_id)
+        return elemento_id
+
+    def _registra(self, elemento_id):
+        self._ultima_modifica[elemento_id] = len(self.modifiche)
+        self.modifiche.append(elemento_id)
+
+    def rinomina(self, elemento_id, nome):
+        with self._lock:
+            self.elementi[elemento_id]["name"] = nome
+            self._registra(elemento_id)
+
+    def sposta(self, elemento_id, parent):
+        with self._lock:
+            elemento = self.elementi[elemento_id]
+            self.figli[elemento["parents"][0]].remove(elemento_id)
+            elemento["parents"] = [parent]
+            self.figli[parent].append(elemento_id)
+            self._registra(elemento_id)
+
+    # Come in Drive, il contenuto di una cartella cestinata non compare più negli elenchi
+    # ma non ha modifiche proprie nel feed
+    def cestina(self, elemento_id):
+        with self._lock:
+            elemento = self.elementi[elemento_id]
+            self.figli[elemento["parents"][0]].remove(elemento_id)
+            elemento["trashed"] = True
+            self._registra(elemento_id)
+
+    def elimina(self, elemento_id):
+        with self._lock:
+            elemento = self.elementi.pop(elemento_id)
+            self.figli[elemento["parents"][0]].remove(elemento_id)
+            self._registra(elemento_id)
+
+    def esegui(self, risposta):
+        if self.latenza:
+            time.sleep(self.latenza)
+        with self._lock:
+            self.chiamate += 1
+            if self.errori and self._casuale.random() < self.errori:
+                raise HttpError(httplib2.Response({"status": 429}), b"rateLimitExceeded")
+            return risposta()
+
+    def pagina_figli(self, parent, quanti, token):
+        inizio = int(token or 0)
+        fine = inizio + min(quanti, self.pagina)
+        figli = self.figli.get(parent, [])
+        risposta = {"files": [
+            {chiave: self.elementi[i][chiave] for chiave in ("id", "name", "mimeType", "createdTime")}
+            for i in figli[inizio:fine]
+        ]}
+        if fine < len(figli):
+            risposta["nextPageToken"] = str(fine)
+        return risposta
+
+    def pagina_modifiche(self, token, quanti):
+        inizio = int(token)
+        fine = inizio + min(quanti, self.pagina)
+        modifiche = []
+        for posizione in range(inizio, min(fine, len(self.modifiche))):
+            elemento_id = self.modifiche[posizione]
+            if self._ultima_modifica[elemento_id] != posizione:
+                continue  # modificato di nuovo più avanti: Drive lo riporta solo lì
+            elemento = self.elementi.get(elemento_id)
+            if elemento is None:
+                modifiche.append({"fileId": elemento_id, "removed": True})
+            else:
+                modifiche.append({"fileId": elemento_id, "removed": False, "file": dict(elemento)})
+        risposta = {"changes": modifiche}
+        if fine < len(self.modifiche):
+            risposta["nextPageToken"] = str(fine)
+        else:
+            risposta["newStartPageToken"] = str(len(self.modifiche))
+        return risposta
+
+
+def data_drive(secondi):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(secondi))
+
+
+# Albero sintetico: num_cartelle cartelle (anni, materie, tipi, argomenti) e num_file file
+# sparsi tra tutte le cartelle, root compresa
+def popola(drive, num_cartelle, num_file, rnd):
+    cartelle = [(drive.root_id, 0)]
+    while len(cartelle) <= num_cartelle:
+        parent, livello = rnd.choice(cartelle)
+        nomi_usati = {drive.elementi[i]["name"] for i in drive.figli[parent]}
+        nome = next(n for n in nomi_livello(livello, len(nomi_usati) + 1, rnd) if n not in nomi_usati)
+        cartelle.append((drive.aggiungi(nome, FOLDER_MIME, parent), livello + 1))
+    for _ in range(num_file):
+        parent, _ = rnd.choice(cartelle)
+        creato = data_drive(rnd.randint(AGGIUNTO_DAL, AGGIUNTO_AL))
+        drive.aggiungi(titolo_file(rnd), "application/pdf", parent, creato)
+    return [cartella for cartella, _ in cartelle]
+
+
+# Cartelle (root compresa) e file dell'archivio, cioè raggiungibili dalla root
+def contenuto_archivio(drive, cartella=None):
+    cartelle, file = [], []
+    da_visitare = [cartella or drive.root_id]
+    while da_visitare:
+        cartella = da_visitare.pop()
+        cartelle.append(cartella)
+        for figlio in drive.figli[cartella]:
+            if drive.elementi[figlio]["mimeType"] == FOLDER_MIME:
+                da_visitare.append(figlio)
+            else:
+                file.append(figlio)
+    return cartelle, file
+
+
+# L'archivio identifica le sottocartelle per nome: prima di portare una cartella in parent
+# la rinomino se lì ce n'è già una con lo stesso nome
+def nome_libero(drive, cartella, parent, rnd):
+    usati = {drive.elementi[i]["name"] for i in drive.figli[parent] if i != cartella}
+    nome = drive.elementi[cartella]["name"]
+    while nome in usati:
+        nome = f"{rnd.choice(nomi_livello(3, 1, rnd))} {rnd.randint(2, 999)}"
+    if nome != drive.elementi[cartella]["name"]:
+        drive.rinomina(cartella, nome)
+
+
+# Cartella fuori dall'archivio con un po' di file (e una sottocartella), da spostare dentro
+def cartella_esterna(drive, rnd):
+    esterne = [i for i in drive.figli["root"] if i != drive.root_id]
+    if esterne and rnd.random() < 0.5:
+        return rnd.choice(esterne)
+    cartella = drive.aggiungi(rnd.choice(nomi_livello(2, 1, rnd)), FOLDER_MIME, "root")
+    sottocartella = drive.aggiungi(rnd.choice(nomi_livello(3, 1, rnd)), FOLDER_MIME, cartella)
+    for _ in range(rnd.randint(1, 5)):
+        drive.aggiungi(titolo_file(rnd), "application/pdf", rnd.choice((cartella, sottocartella)))
+    return cartella
+
+
+MODIFICHE = (
+    "file_nuovo", "file_rinominato", "file_spostato", "file_cestinato", "file_eliminato",
+    "cartella_nuova", "cartella_rinominata", "cartella_spostata", "cartella_cestinata",
+    "cartella_entrata", "cartella_uscita", "root_rinominata",
+)
+
+
+# Una modifica casuale al Drive; restituisce il suo tipo (uno di MODIFICHE)
+def modifica_a_caso(drive, rnd):
+    cartelle, file = contenuto_archivio(drive)
+    sottocartelle = cartelle[1:]
+    tipo = rnd.choice(MODIFICHE)
+    if tipo.startswith("file_") and tipo != "file_nuovo" and not file:
+        tipo = "file_nuovo"
+    if tipo.startswith("cartella_") and tipo not in ("cartella_nuova", "cartella_entrata") and not sottocartelle:
+        tipo = "cartella_nuova"
+
+    if tipo == "file_nuovo":
+        drive.aggiungi(titolo_file(rnd), "application/pdf", rnd.choice(cartelle))
+    elif tipo == "file_rinominato":
+        drive.rinomina(rnd.choice(file), titolo_file(rnd))
+    elif tipo == "file_spostato":
+        drive.sposta(rnd.choice(file), rnd.choice(cartelle))
+    elif tipo == "file_cestinato":
+        drive.cestina(rnd.choice(file))
+    elif tipo == "file_eliminato":
+        drive.elimina(rnd.choice(file))
+    elif tipo == "cartella_nuova":
+        parent = rnd.choice(cartelle)
+        cartella = drive.aggiungi(rnd.choice(nomi_livello(2, 1, rnd)), FOLDER_MIME, parent)
+        nome_libero(drive, cartella, parent, rnd)
+        for _ in range(rnd.randint(0, 4)):
+            drive.aggiungi(titolo_file(rnd), "application/pdf", cartella)
+    elif tipo == "cartella_rinominata":
+        cartella = rnd.choice(sottocartelle)
+        drive.rinomina(cartella, f"{rnd.choice(nomi_livello(3, 1, rnd))} {rnd.randint(2, 999)}")
+        nome_libero(drive, cartella, drive.elementi[cartella]["parents"][0], rnd)
+    elif tipo == "cartella_spostata":
+        cartella = rnd.choice(sottocartelle)
+        dentro = set(contenuto_archivio(drive, cartella)[0])
+        parent = rnd.choice([c for c in cartelle if c not in dentro])
+        nome_libero(drive, cartella, parent, rnd)
+        drive.sposta(cartella, parent)
+    elif tipo == "cartella_cestinata":
+        drive.cestina(rnd.choice(sottocartelle))
+    elif tipo == "cartella_entrata":
+        cartella, parent = cartella_esterna(drive, rnd), rnd.choice(cartelle)
+        nome_libero(drive, cartella, parent, rnd)
+        drive.sposta(cartella, parent)
+    elif tipo == "cartella_uscita":
+        drive.sposta(rnd.choice(sottocartelle), "root")
+    else:
+        drive.rinomina(drive.root_id, f"Appunti FreeCultureProject {rnd.randint(2, 99)}")
+    return tipo
+
+
+# Archivio senza l'ordine dei file: la sincronizzazione tiene i nodi nell'ordine in cui li ha visti,
+# il crawl in quello di Drive
+def forma_canonica(tree):
+    return {
+        "files": sorted(tree["files"], key=lambda f: (f["link"], f["titolo"])),
+        "subfolders": {nome: forma_canonica(sotto) for nome, sotto in tree["subfolders"].items()},
+    }
+
+
+def verifica(nome, ok):
+    print(f"{'✅' if ok else '❌'} {nome}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawler di crea_archivio_conTag.py su un Drive finto")
+    parser.add_argument("--cartelle", type=int, default=300)
+    parser.add_argument("--file", type=int, default=3000)
+    parser.add_argument("--pagina", type=int, default=7, help="elementi al massimo per risposta")
+    parser.add_argument("--worker", type=int, default=8, help="thread del crawl parallelo")
+    parser.add_argument("--giri", type=int, default=5, help="giri di modifiche e sincronizzazione")
+    parser.add_argument("--modifiche", type=int, default=60, help="modifiche casuali per giro")
+    parser.add_argument("--latenza", type=float, default=0.002, help="secondi per richiesta")
+    parser.add_argument("--errori", type=float, default=0.0, help="frazione di richieste con errore 429")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    drive = DriveFinto(pagina=args.pagina, latenza=args.latenza, errori=args.errori, seed=args.seed)
+    popola(drive, args.cartelle, args.file, rnd)
+    print(f"📁 Drive finto: {args.cartelle} cartelle, {args.file} file, {args.pagina} elementi per pagina")
+
+    inizio = time.perf_counter()
+    sequenziale = build_and_tag_tree(drive, drive.root_id)
+    durata, chiamate = time.perf_counter() - inizio, drive.chiamate
+    print(f"   sequenziale: {durata:.2f} s, {chiamate} chiamate")
+
+    # come crawl_completo: il page token si prende prima del crawl
+    page_token = esegui_con_retry(drive.changes().getStartPageToken())["startPageToken"]
+    nodi = {}
+    inizio = time.perf_counter()
+    parallelo = build_and_tag_tree_parallelo(lambda: drive, drive.root_id, args.worker, nodi=nodi)
+    durata = time.perf_counter() - inizio
+    print(f"   parallelo ({args.worker} worker): {durata:.2f} s, {drive.chiamate - chiamate} chiamate")
+
+    albero = json.dumps(sequenziale)
+    esiti = [
+        verifica("crawl parallelo identico al sequenziale", json.dumps(parallelo) == albero),
+        verifica("albero dai nodi identico al crawl", json.dumps(albero_da_nodi(nodi, drive.root_id)) == albero),
+        verifica("tutti gli elementi visitati", len(nodi) == len(drive.elementi) - 1),
+    ]
+
+    stato_sync = {"root_id": drive.root_id, "root_name": drive.elementi[drive.root_id]["name"],
+                  "page_token": page_token, "nodi": nodi}
+    for giro in range(1, args.giri + 1):
+        tipi = collections.Counter(modifica_a_caso(drive, rnd) for _ in range(args.modifiche))
+        # tra un'esecuzione e l'altra lo stato passa da archivio_sync.json
+        stato_sync = json.loads(json.dumps(stato_sync))
+        chiamate = drive.chiamate
+        num_modifiche = sincronizza(drive, stato_sync)
+        incrementale = {stato_sync["root_name"]: albero_da_nodi(stato_sync["nodi"], stato_sync["root_id"])}
+        chiamate, inizio = drive.chiamate - chiamate, drive.chiamate
+        completo = {drive.elementi[drive.root_id]["name"]: build_and_tag_tree(drive, drive.root_id)}
+        cartelle, file = contenuto_archivio(drive)
+        print(f"   giro {giro}: " + ", ".join(f"{n} {t}" for t, n in sorted(tipi.items())))
+        esiti.append(verifica(
+            f"giro {giro}: sincronizzazione ({num_modifiche} modifiche, {chiamate} chiamate; crawl completo "
+            f"{drive.chiamate - inizio}) uguale al crawl completo",
+            forma_canonica(next(iter(incrementale.values()))) == forma_canonica(next(iter(completo.values())))
+            and list(incrementale) == list(completo),
+        ))
+        esiti.append(verifica(
+            f"giro {giro}: nello stato solo gli elementi dell'archivio",
+            set(stato_sync["nodi"]) == set(cartelle[1:] + file),
+        ))
+    return 0 if all(esiti) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
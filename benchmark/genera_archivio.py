@@ -0,0 +1,169 @@
+"""
+Genera un archivio sintetico (stesso formato di archivio.json) e una rubrica (formato di emails.json)
+per misurare il bot su archivi grandi: cartelle con nomi di anni, materie e tipi di materiale,
+file con titoli realistici, tag uguali al percorso della cartella e data di creazione, come li crea
+crea_archivio_conTag.py.
+
+Uso: python benchmark/genera_archivio.py [--file 100000] [--profondita 4] [--ramificazione 6]
+                                         [--seed 0] [--archivio archivio_sintetico.json]
+                                         [--rubrica emails_sintetico.json]
+"""
+
+import sys
+import json
+import random
+import string
+import argparse
+
+ANNI = ["1° Anno", "2° Anno", "3° Anno", "Magistrale 1° Anno", "Magistrale 2° Anno"]
+MATERIE = [
+    "Analisi Matematica 1", "Analisi Matematica 2", "Geometria e Algebra Lineare", "Fisica Generale",
+    "Fisica 2", "Chimica", "Fondamenti di Informatica", "Programmazione ad Oggetti", "Basi di Dati",
+    "Reti di Calcolatori", "Sistemi Operativi", "Elettrotecnica", "Elettronica", "Controlli Automatici",
+    "Scienza delle Costruzioni", "Meccanica Razionale", "Termodinamica", "Economia Aziendale",
+    "Statistica", "Ricerca Operativa", "Calcolatori Elettronici", "Ingegneria del Software",
+    "Teoria dei Segnali", "Fondamenti di Automatica", "Diritto dell'Informatica", "Lingua Inglese",
+]
+TIPI = ["Appunti", "Esercizi", "Esami passati", "Dispense", "Formulari", "Laboratorio", "Slide", "Progetti"]
+ARGOMENTI = [
+    "Limiti e continuità", "Derivate", "Integrali definiti", "Integrali doppi", "Serie numeriche",
+    "Serie di Fourier", "Equazioni differenziali", "Matrici e determinanti", "Spazi vettoriali",
+    "Autovalori", "Cinematica", "Dinamica del punto", "Lavoro ed energia", "Elettrostatica",
+    "Campo magnetico", "Onde", "Termochimica", "Stechiometria", "Puntatori", "Ricorsione",
+    "Algoritmi di ordinamento", "Alberi binari", "Grafi", "Normalizzazione", "SQL", "Transazioni",
+    "Protocollo TCP", "Routing", "Scheduling", "Memoria virtuale", "Circuiti in regime sinusoidale",
+    "Transistor", "Amplificatori operazionali", "Trasformata di Laplace", "Diagrammi di Bode",
+    "Stabilità", "Travi", "Tensioni e deformazioni", "Cicli termodinamici", "Bilancio d'esercizio",
+    "Probabilità", "Variabili aleatorie", "Test d'ipotesi", "Programmazione lineare", "Metodo del simplesso",
+]
+FORMATI = [
+    "{tipo} - {argomento}.pdf",
+    "{tipo} {argomento} ({anno_accademico}).pdf",
+    "Lezione {n} - {argomento}.pdf",
+    "Esercitazione {n} {argomento}.pdf",
+    "Esame {giorno} {mese} {anno} - {argomento}.pdf",
+    "Riassunto {argomento}.docx",
+    "{argomento} - esercizi svolti.pdf",
+]
+MESI = ["gennaio", "febbraio", "giugno", "luglio", "settembre"]
+# Date di creazione dei file (secondi dal 1970): dal 2015 al 2025
+AGGIUNTO_DAL, AGGIUNTO_AL = 1420070400, 1767225600
+NOMI = ["Marco", "Giulia", "Luca", "Francesca", "Paolo", "Chiara", "Andrea", "Sara", "Giovanni", "Elena"]
+COGNOMI = ["Rossi", "Bianchi", "Ferrari", "Esposito", "Romano", "Colombo", "Ricci", "Marino", "Greco", "Conti"]
+
+
+# Nomi delle sottocartelle a un certo livello: anni, materie, tipi di materiale, poi argomenti
+def nomi_livello(livello, quanti, rnd):
+    bacino = [ANNI, MATERIE, TIPI, ARGOMENTI][min(livello, 3)]
+    nomi = rnd.sample(bacino, min(quanti, len(bacino)))
+    while len(nomi) < quanti:
+        nomi.append(f"{rnd.choice(bacino)} {len(nomi) + 1}")
+    return nomi
+
+
+def titolo_file(rnd):
+    anno = rnd.randint(2015, 2025)
+    return rnd.choice(FORMATI).format(
+        tipo=rnd.choice(TIPI),
+        argomento=rnd.choice(ARGOMENTI),
+        anno_accademico=f"{anno}-{(anno + 1) % 100:02d}",
+        n=rnd.randint(1, 30),
+        giorno=rnd.randint(1, 28),
+        mese=rnd.choice(MESI),
+        anno=anno,
+    )
+
+
+def link_drive(rnd):
+    caratteri = string.ascii_letters + string.digits + "-_"
+    return "https://drive.google.com/file/d/" + "".join(rnd.choices(caratteri, k=33)) + "/view?usp=sharing"
+
+
+# Struttura delle cartelle: percorso (tupla) -> nomi delle sottocartelle; i livelli intermedi
+# hanno un numero variabile di figli intorno a `ramificazione`
+def genera_cartelle(profondita, ramificazione, rnd):
+    cartelle = {(): []}
+    da_visitare = [()]
+    while da_visitare:
+        percorso = da_visitare.pop()
+        if len(percorso) >= profondita:
+            continue
+        quanti = max(1, int(rnd.gauss(ramificazione, ramificazione / 3)))
+        for nome in nomi_livello(len(percorso), quanti, rnd):
+            figlio = percorso + (nome,)
+            cartelle[percorso].append(nome)
+            cartelle[figlio] = []
+            da_visitare.append(figlio)
+    return cartelle
+
+
+# Scrive l'archivio in streaming (con 500k file non serve tenerlo tutto in memoria)
+def scrivi_archivio(f, cartelle, num_file, rnd, radice):
+    percorsi = list(cartelle)
+    # più file nelle cartelle profonde, come negli archivi reali
+    pesi = [1 + len(p) ** 2 for p in percorsi]
+    file_per_cartella = dict.fromkeys(percorsi, 0)
+    for percorso in rnd.choices(percorsi, weights=pesi, k=num_file):
+        file_per_cartella[percorso] += 1
+
+    def scrivi_cartella(percorso):
+        f.write('{"files": [')
+        tag = json.dumps(list(percorso), ensure_ascii=False)
+        for i in range(file_per_cartella[percorso]):
+            if i:
+                f.write(", ")
+            titolo = json.dumps(titolo_file(rnd), ensure_ascii=False)
+            aggiunto = rnd.randint(AGGIUNTO_DAL, AGGIUNTO_AL)
+            f.write(f'{{"titolo": {titolo}, "link": "{link_drive(rnd)}", "tag": {tag}, "aggiunto": {aggiunto}}}')
+        f.write('], "subfolders": {')
+        for i, nome in enumerate(cartelle[percorso]):
+            if i:
+                f.write(", ")
+            f.write(json.dumps(nome, ensure_ascii=False) + ": ")
+            scrivi_cartella(percorso + (nome,))
+        f.write("}}")
+
+    f.write("{" + json.dumps(radice, ensure_ascii=False) + ": ")
+    scrivi_cartella(())
+    f.write("}")
+
+
+# Rubrica: anno -> materia -> {professore: email}
+def genera_rubrica(rnd, materie_per_anno=8):
+    rubrica = {}
+    for anno in ANNI:
+        rubrica[anno] = {}
+        for materia in rnd.sample(MATERIE, materie_per_anno):
+            nome, cognome = rnd.choice(NOMI), rnd.choice(COGNOMI)
+            rubrica[anno][materia] = {f"Prof. {nome} {cognome}": f"{nome.lower()}.{cognome.lower()}@univpm.it"}
+    return rubrica
+
+
+def genera(percorso_archivio, percorso_rubrica=None, num_file=100000, profondita=4, ramificazione=6, seed=0,
+           radice="Appunti FreeCultureProject"):
+    rnd = random.Random(seed)
+    cartelle = genera_cartelle(profondita, ramificazione, rnd)
+    with open(percorso_archivio, "w", encoding="utf-8") as f:
+        scrivi_archivio(f, cartelle, num_file, rnd, radice)
+    if percorso_rubrica:
+        with open(percorso_rubrica, "w", encoding="utf-8") as f:
+            json.dump(genera_rubrica(rnd), f, ensure_ascii=False, indent=2)
+    return {"file": num_file, "cartelle": len(cartelle), "profondita": profondita, "ramificazione": ramificazione,
+            "seed": seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera un archivio e una rubrica sintetici")
+    parser.add_argument("--file", type=int, default=100000, help="numero di file (fino a 500000 e oltre)")
+    parser.add_argument("--profondita", type=int, default=4, help="livelli di cartelle sotto la root")
+    parser.add_argument("--ramificazione", type=int, default=6, help="sottocartelle medie per cartella")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--archivio", default="archivio_sintetico.json")
+    parser.add_argument("--rubrica", default="emails_sintetico.json")
+    args = parser.parse_args()
+    info = genera(args.archivio, args.rubrica, args.file, args.profondita, args.ramificazione, args.seed)
+    print(f"✅ '{args.archivio}': {info['file']} file in {info['cartelle']} cartelle; rubrica in '{args.rubrica}'")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
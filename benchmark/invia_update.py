@@ -0,0 +1,98 @@
+"""
+Invia update sintetici al webhook del bot in esecuzione (MODALITA_UPDATE = "webhook"),
+come farebbe Telegram, e misura quanto il server impiega ad accettarli.
+
+Uso: python benchmark/invia_update.py [--url http://127.0.0.1:8443/telegram] [--segreto S]
+                                      [--chat 123456] [--utenti 50] [--update 10] [--query algebra]
+
+Ogni "utente" è una chat distinta (id di partenza --chat) che manda --update messaggi di fila;
+gli utenti inviano in parallelo. Le risposte del bot vanno alle chat indicate: per vederle
+usa come --chat l'id della tua chat con il bot e --utenti 1.
+"""
+
+import sys
+import json
+import time
+import argparse
+import itertools
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+contatore_update = itertools.count(1)
+
+
+# Update di un messaggio di testo, nel formato JSON della Bot API
+def update_messaggio(chat_id, testo):
+    update_id = next(contatore_update)
+    messaggio = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Prova", "username": f"prova{chat_id}"},
+        "text": testo,
+    }
+    comando = testo.split()[0]
+    if comando.startswith("/"):
+        messaggio["entities"] = [{"type": "bot_command", "offset": 0, "length": len(comando)}]
+    return {"update_id": update_id, "message": messaggio}
+
+
+def invia(url, segreto, update):
+    richiesta = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    if segreto:
+        richiesta.add_header("X-Telegram-Bot-Api-Secret-Token", segreto)
+    inizio = time.perf_counter()
+    try:
+        with urllib.request.urlopen(richiesta, timeout=30) as risposta:
+            stato = risposta.status
+    except urllib.error.HTTPError as e:
+        stato = e.code
+    return stato, time.perf_counter() - inizio
+
+
+# Un utente: i suoi update partono uno dopo l'altro, come i click di una persona
+def utente(url, segreto, chat_id, num_update, query):
+    testi = ["/start", f"/cerca {query}", "/libri"]
+    return [invia(url, segreto, update_messaggio(chat_id, testi[i % len(testi)])) for i in range(num_update)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--segreto", default=None)
+    parser.add_argument("--chat", type=int, default=1000)
+    parser.add_argument("--utenti", type=int, default=50)
+    parser.add_argument("--update", type=int, default=10)
+    parser.add_argument("--query", default="algebra")
+    args = parser.parse_args()
+
+    inizio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.utenti) as pool:
+        futuri = [
+            pool.submit(utente, args.url, args.segreto, args.chat + i, args.update, args.query)
+            for i in range(args.utenti)
+        ]
+        esiti = [esito for futuro in futuri for esito in futuro.result()]
+    durata = time.perf_counter() - inizio
+
+    tempi = sorted(t for _, t in esiti)
+    stati = {}
+    for stato, _ in esiti:
+        stati[stato] = stati.get(stato, 0) + 1
+    print(json.dumps({
+        "update": len(esiti),
+        "secondi": round(durata, 3),
+        "update_al_secondo": round(len(esiti) / durata, 1),
+        "stati_http": stati,
+        "latenza_ms_mediana": round(tempi[len(tempi) // 2] * 1000, 2),
+        "latenza_ms_p99": round(tempi[min(len(tempi) - 1, int(len(tempi) * 0.99))] * 1000, 2),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+Confronto della memoria occupata da archivio.json caricato con json.load
+e nella forma compatta usata dal bot (archivio_indice.carica_archivio).
+
+Uso: python benchmark/memoria_archivio.py [percorso/archivio.json]
+"""
+
+import os
+import sys
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from archivio_indice import carica_archivio
+
+
+def json_load(percorso):
+    with open(percorso, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Memoria rimasta allocata dopo il caricamento, picco durante il caricamento e tempo
+def misura(carica, percorso):
+    tracemalloc.start()
+    inizio = time.perf_counter()
+    archivio = carica(percorso)
+    durata = time.perf_counter() - inizio
+    residua, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del archivio
+    return {"residua_mb": residua / 2**20, "picco_mb": picco / 2**20, "secondi": durata}
+
+
+def confronta(percorso):
+    return {
+        "json.load": misura(json_load, percorso),
+        "compatto": misura(carica_archivio, percorso),
+    }
+
+
+def main():
+    percorso = sys.argv[1] if len(sys.argv) > 1 else "archivio.json"
+    print(f"📦 {percorso} ({os.path.getsize(percorso) / 2**20:.1f} MB su disco)")
+    for nome, risultato in confronta(percorso).items():
+        print(
+            f"{nome:>10}: {risultato['residua_mb']:8.1f} MB residui, "
+            f"{risultato['picco_mb']:8.1f} MB di picco, {risultato['secondi']:.2f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+
+
+class CacheLRU:
+    """
+    Dizionario di dimensione limitata:
+      - oltre maxsize scarta l'elemento usato meno di recente
+      - con ttl (secondi) gli elementi più vecchi scadono e non vengono più restituiti
+      - con peso (funzione del valore, es. len) maxsize limita la somma dei pesi invece del
+        numero di elementi, così valori molto grandi non possono riempire la memoria
+    Tiene il conto di hit e miss.
+    """
+
+    def __init__(self, maxsize=256, ttl=None, peso=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.peso = peso
+        self.hits = 0
+        self.misses = 0
+        self.totale = 0  # somma dei pesi (numero di elementi senza peso)
+        self._dati = OrderedDict()
+
+    def get(self, chiave, default=None):
+        voce = self._dati.get(chiave)
+        if voce is not None:
+            scadenza, valore = voce
+            if scadenza is None or scadenza > time.monotonic():
+                self._dati.move_to_end(chiave)
+                self.hits += 1
+                return valore
+            self._rimuovi(chiave)
+        self.misses += 1
+        return default
+
+    # Come get, ma senza contare hit/miss e senza aggiornare l'ordine di utilizzo
+    def peek(self, chiave, default=None):
+        voce = self._dati.get(chiave)
+        if voce is not None and (voce[0] is None or voce[0] > time.monotonic()):
+            return voce[1]
+        return default
+
+    # Coppie (chiave, valore) non scadute, dalla usata meno di recente, senza contare hit/miss
+    def items(self):
+        adesso = time.monotonic()
+        return [(chiave, valore) for chiave, (scadenza, valore) in self._dati.items()
+                if scadenza is None or scadenza > adesso]
+
+    def _peso(self, valore):
+        return self.peso(valore) if self.peso is not None else 1
+
+    def _rimuovi(self, chiave):
+        self.totale -= self._peso(self._dati.pop(chiave)[1])
+
+    # Un valore che da solo supera maxsize non viene salvato (svuoterebbe la cache per nulla)
+    def __setitem__(self, chiave, valore):
+        if chiave in self._dati:
+            self._rimuovi(chiave)
+        peso = self._peso(valore)
+        if peso > self.maxsize:
+            return
+        scadenza = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._dati[chiave] = (scadenza, valore)
+        self.totale += peso
+        while self.totale > self.maxsize and self._dati:
+            self._rimuovi(next(iter(self._dati)))
+
+    def __len__(self):
+        return len(self._dati)
+
+    def clear(self):
+        self._dati.clear()
+        self.totale = 0
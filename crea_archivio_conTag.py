@@ -1,9 +1,19 @@
 import os
+import sys
+import time
 import pickle
 import json
+import random
+import calendar
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from archivio_indice import scrivi_snapshot
+from file_atomico import scrittura_atomica
+from metriche import registro
 
 
 # === CONFIGURAZIONE ===
@@ -13,6 +23,25 @@ SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 TARGET_FOLDER_NAME = "Appunti FreeCultureProject"
 # Nome del file output
 OUTPUT_FILE = "archivio.json"
+# Snapshot binario (archivio + indici) che il bot carica al posto del JSON
+SNAPSHOT_FILE = "archivio.snapshot"
+# Numero di cartelle elencate in parallelo
+NUM_WORKER = 8
+# Tentativi per ogni richiesta in caso di rate limit o errori temporanei di Drive
+MAX_TENTATIVI = 6
+# Motivi di errore 403 che indicano un rate limit (quindi da ripetere)
+MOTIVI_RATE_LIMIT = ("rateLimitExceeded", "userRateLimitExceeded")
+FOLDER_MIME = 'application/vnd.google-apps.folder'
+# Stato della sincronizzazione incrementale (page token dei changes + mappa id -> nodo)
+SYNC_FILE = "archivio_sync.json"
+# Metriche dell'ultima esecuzione (formato Prometheus): durata delle chiamate a Drive e delle fasi
+METRICHE_FILE = "metriche_crawler.prom"
+
+LATENZA_DRIVE = registro.istogramma("fcp_drive_secondi", "Durata delle chiamate all'API Drive", ("metodo",))
+ERRORI_DRIVE = registro.contatore("fcp_drive_errori_totale", "Errori dell'API Drive per codice HTTP", ("metodo", "codice"))
+LATENZA_FASE = registro.istogramma(
+    "fcp_crawler_fase_secondi", "Durata delle fasi del crawler", ("fase",), bucket=(1, 5, 15, 60, 300, 900, 3600)
+)
 
 
 def authenticate_drive():
@@ -46,12 +75,103 @@ def get_drive_service():
     return build('drive', 'v3', credentials=creds)
 
 
+def errore_temporaneo(errore):
+    """Vero se l'errore di Drive è un rate limit (429, 403 *RateLimitExceeded) o un 5xx."""
+    status = errore.resp.status
+    if status == 429 or status >= 500:
+        return True
+    contenuto = (errore.content or b"").decode("utf-8", errors="ignore")
+    return status == 403 and any(motivo in contenuto for motivo in MOTIVI_RATE_LIMIT)
+
+
+def esegui_con_retry(richiesta):
+    """
+    Esegue una richiesta dell'API Drive.
+    Sugli errori temporanei riprova con backoff esponenziale (1, 2, 4, ... secondi + jitter),
+    fino a MAX_TENTATIVI; gli altri errori vengono rilanciati subito.
+
+    """
+
+    metodo = getattr(richiesta, "methodId", None) or "sconosciuto"
+    for tentativo in range(MAX_TENTATIVI):
+        try:
+            with LATENZA_DRIVE.tempo(metodo=metodo):
+                return richiesta.execute()
+        except HttpError as e:
+            ERRORI_DRIVE.inc(metodo=metodo, codice=e.resp.status)
+            if not errore_temporaneo(e) or tentativo == MAX_TENTATIVI - 1:
+                raise
+            time.sleep(min(2 ** tentativo, 32) + random.random())
+
+
+def lista_cartella(service, folder_id):
+    """Restituisce tutti gli elementi (id, name, mimeType, createdTime) di una cartella, pagina dopo pagina."""
+    items = []
+    page_token = None
+    while True:
+        resp = esegui_con_retry(service.files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
+            spaces='drive',
+            fields="nextPageToken, files(id, name, mimeType, createdTime)",
+            pageSize=1000,
+            pageToken=page_token
+        ))
+        items.extend(resp.get('files', []))
+        page_token = resp.get('nextPageToken')
+        if not page_token:
+            break
+    return items
+
+
+def link_file(file_id):
+    return f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
+
+
+# createdTime di Drive ("2024-05-01T10:20:30.123Z") in secondi dal 1970, None se manca
+def data_creazione(item):
+    creato = item.get('createdTime')
+    if not creato:
+        return None
+    return calendar.timegm(time.strptime(creato[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def riempi_cartella(service, folder_id, percorso, tree, nodi=None):
+    """
+    Aggiunge a tree i file e le sottocartelle (ancora vuote) di folder_id.
+    Se nodi è un dict, ci registra ogni elemento come id -> {name, mimeType, parent, aggiunto}
+    (serve alla sincronizzazione incrementale).
+    Restituisce le sottocartelle da visitare come tuple (id, percorso, nodo).
+
+    """
+
+    da_visitare = []
+    for item in lista_cartella(service, folder_id):
+        if nodi is not None:
+            nodi[item['id']] = {"name": item['name'], "mimeType": item['mimeType'], "parent": folder_id,
+                                "aggiunto": data_creazione(item)}
+        if item['mimeType'] == FOLDER_MIME:
+            # cartella
+            nodo = {"files": [], "subfolders": {}}
+            tree['subfolders'][item['name']] = nodo
+            da_visitare.append((item['id'], percorso + [item['name']], nodo))
+        else:
+            # file (tag escludendo la root)
+            tree['files'].append({
+                "titolo": item['name'],
+                "link": link_file(item['id']),
+                "tag": percorso.copy(),
+                "aggiunto": data_creazione(item)
+            })
+    return da_visitare
+
+
 def build_and_tag_tree(service, folder_id, percorso=None):
     """
     Costruisce un albero ricorsivo di:
-      - files: lista di dict {titolo, link, tag}
+      - files: lista di dict {titolo, link, tag, aggiunto (data di creazione, secondi dal 1970)}
       - subfolders: dict di sottocartelle
     Aggiunge a ogni file un campo "tag" basato sul percorso (escludendo la root).
+    Versione sequenziale: una cartella alla volta con un solo service.
 
     """
 
@@ -59,68 +179,231 @@ def build_and_tag_tree(service, folder_id, percorso=None):
         percorso = []
 
     tree = {"files": [], "subfolders": {}}
-    page_token = None
+    for sub_id, sub_percorso, nodo in riempi_cartella(service, folder_id, percorso, tree):
+        nodo.update(build_and_tag_tree(service, sub_id, sub_percorso))
+    return tree
 
-    while True:
-        resp = service.files().list(
-            q=f"'{folder_id}' in parents and trashed = false",
-            spaces='drive',
-            fields="nextPageToken, files(id, name, mimeType)",
-            pageToken=page_token
-        ).execute()
-        for item in resp.get('files', []):
-            if item['mimeType'] == 'application/vnd.google-apps.folder':
-                # cartella
-                tree['subfolders'][item['name']] = build_and_tag_tree(
-                    service, item['id'], percorso + [item['name']])
+
+def build_and_tag_tree_parallelo(service_factory, folder_id, num_worker=NUM_WORKER, nodi=None):
+    """
+    Come build_and_tag_tree, ma elenca fino a num_worker cartelle in parallelo.
+    - service_factory: funzione senza argomenti che crea un service Drive;
+      ogni thread ne crea uno suo (i service di googleapiclient non sono thread-safe)
+    - ogni nodo viene riempito da un solo worker e le sottocartelle sono inserite
+      nell'ordine restituito da Drive, quindi l'albero è identico a quello sequenziale
+    - nodi: come in riempi_cartella (i fratelli restano nell'ordine di Drive)
+
+    """
+
+    locale = threading.local()
+
+    def visita(sub_id, percorso, nodo):
+        if not hasattr(locale, "service"):
+            locale.service = service_factory()
+        return riempi_cartella(locale.service, sub_id, percorso, nodo, nodi)
+
+    tree = {"files": [], "subfolders": {}}
+    with ThreadPoolExecutor(max_workers=num_worker) as pool:
+        in_corso = {pool.submit(visita, folder_id, [], tree)}
+        while in_corso:
+            completati, in_corso = wait(in_corso, return_when=FIRST_COMPLETED)
+            for futuro in completati:
+                for sottocartella in futuro.result():
+                    in_corso.add(pool.submit(visita, *sottocartella))
+    return tree
+
+
+def albero_da_nodi(nodi, root_id):
+    """
+    Ricostruisce l'albero (stesso formato di build_and_tag_tree) dalla mappa id -> nodo.
+    I figli di ogni cartella seguono l'ordine della mappa; i nodi non raggiungibili
+    dalla root vengono ignorati.
+
+    """
+
+    figli = {}
+    for node_id, nodo in nodi.items():
+        figli.setdefault(nodo["parent"], []).append(node_id)
+
+    def costruisci(folder_id, percorso):
+        tree = {"files": [], "subfolders": {}}
+        for node_id in figli.get(folder_id, []):
+            nodo = nodi[node_id]
+            if nodo["mimeType"] == FOLDER_MIME:
+                tree['subfolders'][nodo["name"]] = costruisci(node_id, percorso + [nodo["name"]])
             else:
-                # file
-                link = f"https://drive.google.com/file/d/{item['id']}/view?usp=sharing"
-                # tag escludendo la root
-                tag = percorso.copy()
                 tree['files'].append({
-                    "titolo": item['name'],
-                    "link": link,
-                    "tag": tag
+                    "titolo": nodo["name"],
+                    "link": link_file(node_id),
+                    "tag": percorso.copy(),
+                    "aggiunto": nodo.get("aggiunto")
                 })
+        return tree
+
+    return costruisci(root_id, [])
+
+
+def pota_nodi(nodi, root_id):
+    """Tiene solo i nodi raggiungibili dalla root (es. il contenuto di cartelle cestinate o spostate fuori)."""
+    figli = {}
+    for node_id, nodo in nodi.items():
+        figli.setdefault(nodo["parent"], []).append(node_id)
+    raggiungibili = set()
+    da_visitare = [root_id]
+    while da_visitare:
+        for node_id in figli.get(da_visitare.pop(), []):
+            raggiungibili.add(node_id)
+            da_visitare.append(node_id)
+    return {node_id: nodo for node_id, nodo in nodi.items() if node_id in raggiungibili}
+
+
+def applica_modifica(service, nodi, root_id, change):
+    """
+    Applica un elemento del feed changes alla mappa dei nodi:
+      - rimosso, cestinato o spostato fuori dall'archivio -> tolto dalla mappa
+      - nuovo, rinominato o spostato dentro l'archivio -> aggiornato/aggiunto
+    Una cartella che entra nell'archivio senza essere già nota viene elencata
+    per intero (il suo contenuto non comparirebbe altrimenti nel feed).
+    Restituisce il nuovo nome della root se la modifica la riguarda, altrimenti None.
+
+    """
+
+    node_id = change['fileId']
+    item = change.get('file')
+    if change.get('removed') or item is None or item.get('trashed'):
+        nodi.pop(node_id, None)
+        return None
+    if node_id == root_id:
+        return item['name']
+
+    parent = next((p for p in item.get('parents', []) if p == root_id or p in nodi), None)
+    if parent is None:
+        nodi.pop(node_id, None)
+        return None
+
+    nuova_cartella = item['mimeType'] == FOLDER_MIME and node_id not in nodi
+    nodi[node_id] = {"name": item['name'], "mimeType": item['mimeType'], "parent": parent,
+                     "aggiunto": data_creazione(item)}
+    if nuova_cartella:
+        da_visitare = [node_id]
+        while da_visitare:
+            folder_id = da_visitare.pop()
+            for figlio in lista_cartella(service, folder_id):
+                nodi[figlio['id']] = {"name": figlio['name'], "mimeType": figlio['mimeType'], "parent": folder_id,
+                                      "aggiunto": data_creazione(figlio)}
+                if figlio['mimeType'] == FOLDER_MIME:
+                    da_visitare.append(figlio['id'])
+    return None
+
+
+def sincronizza(service, stato_sync):
+    """
+    Aggiornamento incrementale: legge dal feed changes solo le modifiche successive
+    al page token salvato e le applica a stato_sync["nodi"].
+    Costa O(modifiche) chiamate API invece di O(cartelle).
+    Restituisce il numero di modifiche lette.
+
+    """
+
+    nodi = stato_sync["nodi"]
+    page_token = stato_sync["page_token"]
+    num_modifiche = 0
+    while page_token:
+        resp = esegui_con_retry(service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=True,
+            pageSize=1000,
+            fields="nextPageToken, newStartPageToken, "
+                   "changes(fileId, removed, file(id, name, mimeType, parents, trashed, createdTime))"
+        ))
+        for change in resp.get('changes', []):
+            nuovo_nome = applica_modifica(service, nodi, stato_sync["root_id"], change)
+            if nuovo_nome:
+                stato_sync["root_name"] = nuovo_nome
+            num_modifiche += 1
+        if 'newStartPageToken' in resp:
+            stato_sync["page_token"] = resp['newStartPageToken']
         page_token = resp.get('nextPageToken')
-        if not page_token:
-            break
+    stato_sync["nodi"] = pota_nodi(nodi, stato_sync["root_id"])
+    return num_modifiche
 
-    return tree
 
+def scrivi_json(percorso, dati, **opzioni):
+    """Scrive il JSON con scrittura_atomica: chi legge non vede mai un file a metà."""
+    with scrittura_atomica(percorso) as f:
+        json.dump(dati, f, ensure_ascii=False, **opzioni)
 
-def main():
-    # Autenticazione e creazione service
-    service = get_drive_service()
+
+def crawl_completo(service, creds):
+    """Crawl completo: restituisce il nuovo stato di sincronizzazione, o None se la root non c'è."""
 
     # 1) Trovo la cartella principale nella root di Drive (TARGET_FOLDER_NAME)
     query = (
         "mimeType = 'application/vnd.google-apps.folder' and "
         f"name = '{TARGET_FOLDER_NAME}' and 'root' in parents and trashed = false"
     )
-    resp = service.files().list(q=query, spaces='drive',
-                                fields="files(id,name)").execute()
+    resp = esegui_con_retry(service.files().list(q=query, spaces='drive',
+                                                 fields="files(id,name)"))
     folders = resp.get('files', [])
     if not folders:
         print(f"❌ Cartella '{TARGET_FOLDER_NAME}' non trovata.")
-        return
+        return None
 
     root = folders[0]
     print(f"✅ Cartella trovata: {root['name']} (ID: {root['id']})")
 
-    # 2) Costruisco l’albero con i tag
-    tree = build_and_tag_tree(service, root['id'])
+    # Il token va preso prima del crawl, così le modifiche fatte durante il crawl
+    # verranno rilette alla prossima sincronizzazione
+    page_token = esegui_con_retry(service.changes().getStartPageToken())['startPageToken']
 
-    # 3) Lo Incorporo nella chiave principale
-    archivio = {root['name']: tree}
+    # 2) Elenco tutte le cartelle, più di una in parallelo, registrando i nodi
+    nodi = {}
+    build_and_tag_tree_parallelo(
+        lambda: build('drive', 'v3', credentials=creds), root['id'], nodi=nodi)
 
-    # 4) Salva in "archivio.json"
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(archivio, f, ensure_ascii=False, indent=4)
+    return {"root_id": root['id'], "root_name": root['name'], "page_token": page_token, "nodi": nodi}
+
+
+def main():
+    # Autenticazione e creazione service
+    creds = authenticate_drive()
+    service = build('drive', 'v3', credentials=creds)
+
+    # 1) Se ho già uno stato salvato leggo solo le modifiche, altrimenti (o con --completo) crawl completo
+    stato_sync = None
+    if os.path.exists(SYNC_FILE) and "--completo" not in sys.argv[1:]:
+        with open(SYNC_FILE, 'r', encoding='utf-8') as f:
+            stato_sync = json.load(f)
+        with LATENZA_FASE.tempo(fase="sincronizzazione"):
+            num_modifiche = sincronizza(service, stato_sync)
+        print(f"✅ Sincronizzazione incrementale: {num_modifiche} modifiche")
+    else:
+        with LATENZA_FASE.tempo(fase="crawl_completo"):
+            stato_sync = crawl_completo(service, creds)
+        if stato_sync is None:
+            return
+
+    # 2) Costruisco l’albero con i tag e lo incorporo nella chiave principale
+    tree = albero_da_nodi(stato_sync["nodi"], stato_sync["root_id"])
+    archivio = {stato_sync["root_name"]: tree}
+
+    # 3) Salvo "archivio.json" e lo stato per la prossima sincronizzazione
+    with LATENZA_FASE.tempo(fase="scrittura_json"):
+        scrivi_json(OUTPUT_FILE, archivio, indent=4)
+        scrivi_json(SYNC_FILE, stato_sync)
 
     print(f"✅ '{OUTPUT_FILE}' generato con successo!")
 
+    # 4) Snapshot già indicizzato per un avvio veloce del bot
+    with LATENZA_FASE.tempo(fase="snapshot"):
+        scrivi_snapshot(SNAPSHOT_FILE, OUTPUT_FILE)
+    print(f"✅ '{SNAPSHOT_FILE}' generato con successo!")
+
+    # 5) Metriche dell'esecuzione
+    registro.scrivi(METRICHE_FILE)
+    print(f"📊 Metriche dell'esecuzione in '{METRICHE_FILE}'")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,16 @@
+import sys
+import time
+from archivio_indice import scrivi_snapshot
+
+
+# Costruisce archivio.snapshot da archivio.json (da rilanciare se archivio.json viene modificato a mano)
+def main():
+    percorso_json = sys.argv[1] if len(sys.argv) > 1 else "archivio.json"
+    percorso_snapshot = sys.argv[2] if len(sys.argv) > 2 else "archivio.snapshot"
+    inizio = time.perf_counter()
+    scrivi_snapshot(percorso_snapshot, percorso_json)
+    print(f"✅ '{percorso_snapshot}' generato in {time.perf_counter() - inizio:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
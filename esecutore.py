@@ -0,0 +1,94 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class Sovraccarico(Exception):
+    """Troppi lavori in coda: la richiesta viene rifiutata subito invece di aspettare."""
+
+
+# Stato visto dai processi worker: ereditato dal processo principale al fork
+_stato_worker = None
+
+
+def _inizializza_worker(stato):
+    global _stato_worker
+    _stato_worker = stato
+
+
+def _nel_worker(funzione, *args):
+    return funzione(_stato_worker, *args)
+
+
+def _pronto(stato):
+    return True
+
+
+class EsecutoreCPU:
+    """
+    Esegue funzioni pure (ricerca, costruzione tastiere) fuori dal loop asyncio,
+    così una richiesta pesante non blocca gli update degli altri utenti.
+      - modalita: "thread", "processo" oppure "diretta" (nel loop, come prima)
+      - max_in_coda: lavori in corso o in attesa oltre i quali si solleva Sovraccarico
+      - timeout: secondi oltre i quali si solleva asyncio.TimeoutError
+
+    Le funzioni ricevono lo stato come primo argomento: funzione(stato, *args).
+    In modalità "processo" i worker vengono creati con fork dopo il caricamento
+    dello stato, quindi ne condividono una copia in sola lettura senza ricaricarlo;
+    a ogni ricaricamento dell'archivio il pool va ricreato con aggiorna_stato.
+    """
+
+    def __init__(self, modalita="thread", num_worker=4, max_in_coda=64, timeout=10):
+        self.modalita = modalita
+        self.num_worker = num_worker
+        self.max_in_coda = max_in_coda
+        self.timeout = timeout
+        self.in_corso = 0
+        self._stato_pool = None
+        self._pool = None
+        if modalita == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=num_worker, thread_name_prefix="esecutore")
+
+    # Solo modalità processo: ricrea i worker con il nuovo stato (quelli vecchi finiscono i lavori in corso)
+    def aggiorna_stato(self, stato):
+        if self.modalita != "processo":
+            return
+        vecchio = self._pool
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.num_worker,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_inizializza_worker,
+            initargs=(stato,),
+        )
+        # avvio subito i worker, così il fork avviene ora e non al primo utente
+        self._pool.submit(_pronto, None)
+        self._stato_pool = stato
+        if vecchio is not None:
+            vecchio.shutdown(wait=False)
+
+    async def esegui(self, funzione, stato, *args):
+        if self.modalita == "diretta":
+            return funzione(stato, *args)
+        if self.in_corso >= self.max_in_coda:
+            raise Sovraccarico()
+
+        loop = asyncio.get_running_loop()
+        if self.modalita == "processo" and stato is self._stato_pool:
+            futuro = asyncio.wrap_future(self._pool.submit(_nel_worker, funzione, *args))
+        elif self.modalita == "processo":
+            # il pool ha ancora lo stato precedente (ricaricamento in corso): uso un thread
+            futuro = loop.run_in_executor(None, funzione, stato, *args)
+        else:
+            futuro = asyncio.wrap_future(self._pool.submit(funzione, stato, *args))
+
+        # il posto in coda si libera quando il lavoro finisce davvero, anche dopo un timeout
+        self.in_corso += 1
+        futuro.add_done_callback(lambda _: self._libera())
+        return await asyncio.wait_for(asyncio.shield(futuro), self.timeout)
+
+    def _libera(self):
+        self.in_corso -= 1
+
+    def chiudi(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
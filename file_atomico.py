@@ -0,0 +1,24 @@
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def scrittura_atomica(percorso, modo="w"):
+    """
+    Apre un file temporaneo accanto a percorso e, se il blocco with finisce senza errori,
+    lo sostituisce a percorso in un colpo solo (os.replace): chi legge trova il file vecchio
+    o quello nuovo, mai uno a metà. Dopo un errore il temporaneo viene cancellato e il file
+    originale resta com'era.
+      - modo: "w" per il testo (UTF-8) o "wb" per i dati binari
+    """
+    temporaneo = percorso + ".tmp"
+    try:
+        with open(temporaneo, modo, encoding=None if "b" in modo else "utf-8") as f:
+            yield f
+        os.replace(temporaneo, percorso)
+    except BaseException:
+        try:
+            os.remove(temporaneo)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,177 @@
+import time
+import asyncio
+import logging
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import BaseRateLimiter
+from metriche import registro
+
+logger = logging.getLogger(__name__)
+
+LATENZA_TELEGRAM = registro.istogramma("fcp_telegram_secondi", "Durata delle chiamate alla Bot API", ("metodo",))
+ATTESA_INVIO = registro.istogramma("fcp_invio_attesa_secondi", "Attesa in coda prima di una chiamata alla Bot API")
+
+
+class SecchioToken:
+    """
+    Token bucket: si riempie di `tasso` token al secondo fino a `capienza`; ogni invio ne consuma uno.
+    Chi aspetta viene servito in ordine di arrivo (turno), e pausa() blocca tutti per un certo tempo
+    (retry_after di Telegram).
+    """
+
+    __slots__ = ("tasso", "capienza", "token", "ultimo", "pausa_fino", "turno")
+
+    def __init__(self, tasso, capienza):
+        self.tasso = tasso
+        self.capienza = capienza
+        self.token = capienza
+        self.ultimo = time.monotonic()
+        self.pausa_fino = 0.0
+        self.turno = asyncio.Lock()
+
+    def _ricarica(self, adesso):
+        self.token = min(self.capienza, self.token + (adesso - self.ultimo) * self.tasso)
+        self.ultimo = adesso
+
+    # Aspetta un token e lo consuma: va chiamato dentro `async with secchio.turno`
+    async def consuma(self):
+        while True:
+            adesso = time.monotonic()
+            self._ricarica(adesso)
+            attesa = max(self.pausa_fino - adesso, (1 - self.token) / self.tasso)
+            if attesa <= 0:
+                self.token -= 1
+                return
+            await asyncio.sleep(attesa)
+
+    async def preleva(self):
+        async with self.turno:
+            await self.consuma()
+
+    def pausa(self, secondi):
+        self.pausa_fino = max(self.pausa_fino, time.monotonic() + secondi)
+
+    # Nessuno in attesa e secchio pieno: si può buttare, verrà ricreato uguale
+    def inattivo(self):
+        self._ricarica(time.monotonic())
+        return not self.turno.locked() and self.token >= self.capienza and self.pausa_fino <= self.ultimo
+
+
+class LimitatoreInvii(BaseRateLimiter):
+    """
+    Limita le chiamate alla Bot API per restare sotto i limiti di Telegram:
+      - globale_al_secondo: messaggi al secondo in tutto il bot
+      - chat_al_secondo / chat_raffica: per ogni chat privata (con una piccola raffica concessa)
+      - gruppo_al_minuto: per ogni gruppo o canale (chat_id negativo)
+      - max_tentativi: ripetizioni dopo un 429 (RetryAfter), aspettando il tempo indicato da Telegram
+    Le richieste della stessa chat partono nell'ordine di arrivo; "message is not modified" viene
+    considerato un successo. Le chiamate senza chat (answerCallbackQuery, answerInlineQuery, ...)
+    non passano dai secchi. I click ripetuti sullo stesso messaggio si unificano prima, nella fila
+    della chat (ProcessoreUpdatePerChat): qui non ci sono mai due modifiche in coda per la stessa chat.
+    """
+
+    def __init__(self, globale_al_secondo=30, chat_al_secondo=1, chat_raffica=3, gruppo_al_minuto=20, max_tentativi=3):
+        self.chat_al_secondo = chat_al_secondo
+        self.chat_raffica = chat_raffica
+        self.gruppo_al_minuto = gruppo_al_minuto
+        self.max_tentativi = max_tentativi
+        self._globale = SecchioToken(globale_al_secondo, max(1, globale_al_secondo))
+        self._chat = {}
+        # metriche
+        self.in_coda = 0
+        self.in_coda_max = 0
+        self.inviati = 0
+        self.non_modificati = 0
+        self.retry_after = 0
+        self.attese = 0
+        self.attesa_totale = 0.0
+        self.attesa_max = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _secchio_chat(self, chat_id):
+        secchio = self._chat.get(chat_id)
+        if secchio is None:
+            if len(self._chat) > 1024:
+                for chiave, vecchio in list(self._chat.items()):
+                    if vecchio.inattivo():
+                        del self._chat[chiave]
+            if isinstance(chat_id, int) and chat_id < 0:
+                secchio = SecchioToken(self.gruppo_al_minuto / 60, 1)
+            else:
+                secchio = SecchioToken(self.chat_al_secondo, self.chat_raffica)
+            self._chat[chat_id] = secchio
+        return secchio
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._con_tentativi(None, endpoint, callback, args, kwargs, rate_limit_args)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        secchio = self._secchio_chat(chat_id)
+        inizio = time.monotonic()
+        self.in_coda += 1
+        self.in_coda_max = max(self.in_coda_max, self.in_coda)
+        try:
+            async with secchio.turno:
+                await secchio.consuma()
+                await self._globale.preleva()
+                self._registra_attesa(time.monotonic() - inizio)
+                self.in_coda -= 1
+                inizio = None
+                return await self._con_tentativi(secchio, endpoint, callback, args, kwargs, rate_limit_args)
+        finally:
+            if inizio is not None:
+                self.in_coda -= 1
+
+    async def _con_tentativi(self, secchio, endpoint, callback, args, kwargs, rate_limit_args):
+        max_tentativi = rate_limit_args if rate_limit_args is not None else self.max_tentativi
+        tentativo = 0
+        while True:
+            try:
+                with LATENZA_TELEGRAM.tempo(metodo=endpoint):
+                    risultato = await callback(*args, **kwargs)
+                self.inviati += 1
+                return risultato
+            except RetryAfter as e:
+                self.retry_after += 1
+                if tentativo >= max_tentativi:
+                    raise
+                tentativo += 1
+                attesa = e.retry_after
+                if hasattr(attesa, "total_seconds"):
+                    attesa = attesa.total_seconds()
+                logger.warning("Limite di Telegram raggiunto: riprovo tra %s s", attesa)
+                # la pausa vale per la chat se c'è, altrimenti per tutto il bot
+                (secchio or self._globale).pausa(attesa + 0.1)
+                await asyncio.sleep(attesa + 0.1)
+            except BadRequest as e:
+                if "message is not modified" in str(e).lower():
+                    self.non_modificati += 1
+                    return True
+                raise
+
+    def _registra_attesa(self, secondi):
+        ATTESA_INVIO.osserva(secondi)
+        self.attese += 1
+        self.attesa_totale += secondi
+        self.attesa_max = max(self.attesa_max, secondi)
+
+    def statistiche(self):
+        return {
+            "in_coda": self.in_coda,
+            "in_coda_max": self.in_coda_max,
+            "chat_attive": len(self._chat),
+            "inviati": self.inviati,
+            "non_modificati": self.non_modificati,
+            "retry_after": self.retry_after,
+            "attesa_media_s": self.attesa_totale / self.attese if self.attese else 0.0,
+            "attesa_max_s": self.attesa_max,
+        }
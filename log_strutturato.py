@@ -0,0 +1,92 @@
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# Attributi che ogni LogRecord ha già: tutto il resto arriva da extra={...} ed è un campo strutturato
+_ATTRIBUTI_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def campi_extra(record):
+    return {k: v for k, v in vars(record).items() if k not in _ATTRIBUTI_STANDARD}
+
+
+class FormattatoreJSON(logging.Formatter):
+    """Una riga JSON per record: ora, livello, logger, messaggio e i campi passati con extra."""
+
+    def format(self, record):
+        dati = {
+            "ora": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "livello": record.levelname,
+            "logger": record.name,
+            "messaggio": record.getMessage(),
+        }
+        dati.update(campi_extra(record))
+        if record.exc_info:
+            dati["eccezione"] = self.formatException(record.exc_info)
+        return json.dumps(dati, ensure_ascii=False, default=str)
+
+
+class FiltroCampionamento(logging.Filter):
+    """
+    Tiene solo una frazione degli eventi molto frequenti: campionamento = {evento: frazione}.
+    Vale per i record INFO/DEBUG con il campo `evento` ed esito "ok"; avvisi ed errori passano tutti.
+    Ai record tenuti aggiunge il campo `campionamento`, per poter ripesare i conteggi nelle analisi.
+    """
+
+    def __init__(self, campionamento):
+        super().__init__()
+        self.campionamento = dict(campionamento)
+
+    def filter(self, record):
+        frazione = self.campionamento.get(getattr(record, "evento", None))
+        if frazione is None or record.levelno > logging.INFO or getattr(record, "esito", "ok") != "ok":
+            return True
+        if random.random() >= frazione:
+            return False
+        record.campionamento = frazione
+        return True
+
+
+class _GestoreCoda(logging.handlers.QueueHandler):
+    # Il record va in coda così com'è: messaggio e campi vengono formattati dal thread di scrittura
+    # (la coda è nello stesso processo, non serve renderlo serializzabile)
+    def prepare(self, record):
+        return record
+
+
+def configura_logging(livello=logging.INFO, formato_testo=None, file_json=None, campionamento=None,
+                      file_json_max_byte=50 * 2**20, file_json_copie=5):
+    """
+    Logging non bloccante: chi scrive un log mette solo il record in una coda; un thread in background
+    lo formatta e lo scrive sulla console (testo) e, se indicato, su file_json (una riga JSON per record,
+    con rotazione). campionamento: vedi FiltroCampionamento.
+    Restituisce il QueueListener, che viene comunque fermato (svuotando la coda) all'uscita.
+    """
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(formato_testo))
+    gestori = [console]
+    if file_json:
+        su_file = logging.handlers.RotatingFileHandler(
+            file_json, maxBytes=file_json_max_byte, backupCount=file_json_copie, encoding="utf-8"
+        )
+        su_file.setFormatter(FormattatoreJSON())
+        gestori.append(su_file)
+
+    coda = queue.SimpleQueue()
+    gestore = _GestoreCoda(coda)
+    if campionamento:
+        gestore.addFilter(FiltroCampionamento(campionamento))
+
+    radice = logging.getLogger()
+    for vecchio in radice.handlers[:]:
+        radice.removeHandler(vecchio)
+    radice.addHandler(gestore)
+    radice.setLevel(livello)
+
+    listener = logging.handlers.QueueListener(coda, *gestori, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,189 @@
+import time
+import socket
+import asyncio
+import threading
+from file_atomico import scrittura_atomica
+
+# Limiti dei bucket degli istogrammi di latenza (secondi)
+BUCKET_LATENZA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escapa(valore):
+    return str(valore).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etichette(nomi, valori):
+    if not nomi:
+        return ""
+    return "{" + ",".join(f'{n}="{_escapa(v)}"' for n, v in zip(nomi, valori)) + "}"
+
+
+class Contatore:
+    """Contatore che può solo crescere, una serie per ogni combinazione di etichette."""
+
+    tipo = "counter"
+
+    def __init__(self, nome, aiuto, etichette=()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = tuple(etichette)
+        self._valori = {}
+        self._lock = threading.Lock()
+
+    def inc(self, quantita=1, **etichette):
+        chiave = tuple(etichette[n] for n in self.etichette)
+        with self._lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + quantita
+
+    def righe(self):
+        for chiave, valore in sorted(self._valori.items()):
+            yield f"{self.nome}{_etichette(self.etichette, chiave)} {valore}"
+
+
+class Istogramma:
+    """Distribuzione dei valori osservati (latenze) in bucket cumulativi, più somma e conteggio."""
+
+    tipo = "histogram"
+
+    def __init__(self, nome, aiuto, etichette=(), bucket=BUCKET_LATENZA):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = tuple(etichette)
+        self.bucket = tuple(bucket)
+        # chiave -> [conteggi per bucket (non cumulativi, l'ultimo è +Inf), somma]
+        self._serie = {}
+        self._lock = threading.Lock()
+
+    def osserva(self, valore, **etichette):
+        chiave = tuple(etichette[n] for n in self.etichette)
+        indice = len(self.bucket)
+        for i, limite in enumerate(self.bucket):
+            if valore <= limite:
+                indice = i
+                break
+        with self._lock:
+            serie = self._serie.get(chiave)
+            if serie is None:
+                serie = self._serie[chiave] = [[0] * (len(self.bucket) + 1), 0.0]
+            serie[0][indice] += 1
+            serie[1] += valore
+
+    # Misura la durata di un blocco: with istogramma.tempo(handler="cerca"): ...
+    def tempo(self, **etichette):
+        return _Cronometro(self, etichette)
+
+    def righe(self):
+        nomi_le = self.etichette + ("le",)
+        for chiave, (conteggi, somma) in sorted(self._serie.items()):
+            cumulato = 0
+            for limite, n in zip(self.bucket + ("+Inf",), conteggi):
+                cumulato += n
+                yield f"{self.nome}_bucket{_etichette(nomi_le, chiave + (limite,))} {cumulato}"
+            yield f"{self.nome}_sum{_etichette(self.etichette, chiave)} {somma}"
+            yield f"{self.nome}_count{_etichette(self.etichette, chiave)} {cumulato}"
+
+
+class Misura:
+    """Valore letto al momento dell'esportazione: funzione() -> numero, o {valori etichette: numero}."""
+
+    tipo = "gauge"
+
+    def __init__(self, nome, aiuto, funzione, etichette=()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.funzione = funzione
+        self.etichette = tuple(etichette)
+
+    def righe(self):
+        valore = self.funzione()
+        if not self.etichette:
+            yield f"{self.nome} {valore}"
+            return
+        for chiave, v in sorted(valore.items()):
+            if not isinstance(chiave, tuple):
+                chiave = (chiave,)
+            yield f"{self.nome}{_etichette(self.etichette, chiave)} {v}"
+
+
+class _Cronometro:
+    __slots__ = ("istogramma", "etichette", "inizio")
+
+    def __init__(self, istogramma, etichette):
+        self.istogramma = istogramma
+        self.etichette = etichette
+
+    def __enter__(self):
+        self.inizio = time.perf_counter()
+        return self
+
+    def __exit__(self, *errore):
+        self.istogramma.osserva(time.perf_counter() - self.inizio, **self.etichette)
+        return False
+
+
+class RegistroMetriche:
+    """
+    Raccolta delle metriche di un processo, esportate nel formato testuale di Prometheus
+    (testo()) su un endpoint HTTP locale (avvia_server) o in un file (scrivi).
+    Le metriche con lo stesso nome vengono create una volta sola.
+    """
+
+    def __init__(self):
+        self._metriche = {}
+        self._lock = threading.Lock()
+
+    def _registra(self, classe, nome, *args, **kwargs):
+        with self._lock:
+            metrica = self._metriche.get(nome)
+            if metrica is None:
+                metrica = self._metriche[nome] = classe(nome, *args, **kwargs)
+            return metrica
+
+    def contatore(self, nome, aiuto, etichette=()):
+        return self._registra(Contatore, nome, aiuto, etichette)
+
+    def istogramma(self, nome, aiuto, etichette=(), bucket=BUCKET_LATENZA):
+        return self._registra(Istogramma, nome, aiuto, etichette, bucket)
+
+    def misura(self, nome, aiuto, funzione, etichette=()):
+        return self._registra(Misura, nome, aiuto, funzione, etichette)
+
+    def testo(self):
+        righe = []
+        for metrica in list(self._metriche.values()):
+            righe.append(f"# HELP {metrica.nome} {metrica.aiuto}")
+            righe.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+            righe.extend(metrica.righe())
+        return "\n".join(righe) + "\n"
+
+    # Scrittura atomica, leggibile anche dal textfile collector di node_exporter
+    def scrivi(self, percorso):
+        with scrittura_atomica(percorso) as f:
+            f.write(self.testo())
+
+    # Server HTTP minimo: qualsiasi GET riceve le metriche (es. http://127.0.0.1:9108/metrics)
+    async def avvia_server(self, ascolto, porta):
+        async def rispondi(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+                corpo = self.testo().encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + f"Content-Length: {len(corpo)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + corpo
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        # reuse_port: dopo un ricaricamento i worker nuovi (smistatore.py) aprono la porta
+        # mentre quelli vecchi finiscono gli ultimi update
+        return await asyncio.start_server(rispondi, ascolto, porta, reuse_port=hasattr(socket, "SO_REUSEPORT"))
+
+
+# Registro condiviso dai moduli di un processo
+registro = RegistroMetriche()
@@ -0,0 +1,90 @@
+import json
+import time
+import heapq
+import logging
+from file_atomico import scrittura_atomica
+
+logger = logging.getLogger(__name__)
+
+
+def _in_tupla(valore):
+    # il JSON restituisce liste: le chiavi in memoria devono essere hashabili
+    if isinstance(valore, list):
+        return tuple(_in_tupla(v) for v in valore)
+    return valore
+
+
+class ContatorePopolari:
+    """
+    Conteggio degli elementi più frequenti di un flusso (query, cartelle visitate) in memoria limitata:
+      - capacita: elementi tenuti dopo ogni potatura; fra una potatura e l'altra se ne tengono
+        fino al doppio, poi restano solo i capacita più frequenti
+      - emivita: secondi dopo i quali un conteggio vale la metà (invecchia), così le mode passate
+        lasciano il posto a quelle nuove
+
+    I conteggi sono approssimati: un elemento scartato nella potatura e poi rivisto riparte da zero.
+    Per scegliere cosa tenere pronto in cache basta: gli elementi molto frequenti non vengono mai scartati.
+    """
+
+    def __init__(self, capacita=1000, emivita=7 * 24 * 3600):
+        self.capacita = capacita
+        self.emivita = emivita
+        self._conteggi = {}
+
+    def aggiungi(self, chiave, peso=1):
+        self._conteggi[chiave] = self._conteggi.get(chiave, 0) + peso
+        if len(self._conteggi) > 2 * self.capacita:
+            self._pota()
+
+    def _pota(self):
+        tenuti = heapq.nlargest(self.capacita, self._conteggi.items(), key=lambda voce: voce[1])
+        self._conteggi = dict(tenuti)
+
+    # I primi n elementi come (chiave, conteggio), dal più frequente
+    def piu_frequenti(self, n):
+        return heapq.nlargest(n, self._conteggi.items(), key=lambda voce: voce[1])
+
+    # Riduce i conteggi come se fossero passati tanti secondi
+    def invecchia(self, secondi):
+        if not self.emivita or secondi <= 0:
+            return
+        fattore = 0.5 ** (secondi / self.emivita)
+        self._conteggi = {c: n * fattore for c, n in self._conteggi.items() if n * fattore >= 0.01}
+
+    def voci(self):
+        return [[chiave, round(n, 3)] for chiave, n in self.piu_frequenti(self.capacita)]
+
+    def unisci(self, voci):
+        for chiave, n in voci:
+            self.aggiungi(_in_tupla(chiave), n)
+
+    def __len__(self):
+        return len(self._conteggi)
+
+
+def salva_popolari(percorso, contatori):
+    """Scrive i contatori (nome -> ContatorePopolari) in un file JSON, sostituendolo in un colpo solo."""
+    dati = {"salvato": time.time()}
+    dati.update((nome, c.voci()) for nome, c in contatori.items())
+    with scrittura_atomica(percorso) as f:
+        json.dump(dati, f, ensure_ascii=False)
+
+
+def carica_popolari(percorso, contatori):
+    """
+    Aggiunge ai contatori i conteggi salvati da salva_popolari, invecchiati del tempo passato
+    dal salvataggio. Un file mancante o illeggibile lascia i contatori come sono.
+    """
+    try:
+        with open(percorso, "r", encoding="utf-8") as f:
+            dati = json.load(f)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as e:
+        logger.warning("Conteggi delle ricerche in %s non leggibili, riparto da zero: %s", percorso, e)
+        return False
+    trascorsi = time.time() - dati.get("salvato", time.time())
+    for nome, contatore in contatori.items():
+        contatore.unisci(dati.get(nome, []))
+        contatore.invecchia(trascorsi)
+    return True
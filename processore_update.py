@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+# Chiave di ordinamento di un update: la chat (o l'utente, per le query inline); None se non c'è
+def chiave_update(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+# Messaggio su cui è stato cliccato un pulsante: (chat, message_id); None se non è un click
+def chiave_click(update):
+    if not isinstance(update, Update) or update.callback_query is None:
+        return None
+    messaggio = update.callback_query.message
+    if messaggio is None:
+        return None
+    return (messaggio.chat.id, messaggio.message_id)
+
+
+class ProcessoreUpdatePerChat(BaseUpdateProcessor):
+    """
+    Gestisce più update contemporaneamente, ma quelli della stessa chat uno alla volta
+    e nell'ordine di arrivo (naviga e mail_callback modificano lo stesso messaggio:
+    due click gestiti in parallelo potrebbero applicare le modifiche al contrario).
+      - max_concorrenti: update gestiti davvero in parallelo
+      - max_in_attesa_chat: update di una stessa chat in fila dietro a quello in corso; oltre
+        questo numero i nuovi update della chat vengono scartati (e contati in `scartati`)
+      - chiave_modifica: funzione(update) -> messaggio che l'update modifica (None se non ne modifica);
+        di più click in fila sullo stesso messaggio si gestisce solo l'ultimo, perché ognuno
+        sostituirebbe comunque il messaggio del precedente (il gruppo che clicca sullo stesso menu).
+        Ai click saltati si risponde solo con answerCallbackQuery, e sono contati in `click_unificati`
+
+    Un update prende un posto di esecuzione solo quando tocca a lui nella sua chat: una chat
+    che manda molti update (il gruppo di un corso) occupa un solo posto alla volta e non
+    rallenta le altre chat. Per questo process_update sostituisce quello di BaseUpdateProcessor,
+    che prenderebbe il posto prima della fila della chat.
+    """
+
+    __slots__ = (
+        "max_in_attesa_chat", "chiave_modifica", "_code", "_ultimi_click", "_numero_click",
+        "in_attesa", "in_attesa_max", "scartati", "click_unificati",
+    )
+
+    def __init__(self, max_concorrenti=16, max_in_attesa_chat=32, chiave_modifica=chiave_click):
+        super().__init__(max_concorrenti)
+        self.max_in_attesa_chat = max_in_attesa_chat
+        self.chiave_modifica = chiave_modifica
+        # chiave -> [lock, update in fila, click in fila già superati]; la voce si toglie quando la fila è vuota
+        self._code = {}
+        # messaggio -> numero dell'ultimo click in fila (tolto quando parte)
+        self._ultimi_click = {}
+        self._numero_click = 0
+        # metriche
+        self.in_attesa = 0
+        self.in_attesa_max = 0
+        self.scartati = 0
+        self.click_unificati = 0
+
+    async def process_update(self, update, coroutine):
+        chiave = chiave_update(update)
+        if chiave is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+
+        voce = self._code.get(chiave)
+        if voce is None:
+            voce = self._code[chiave] = [asyncio.Lock(), 0, 0]
+        elif voce[1] - voce[2] > self.max_in_attesa_chat:
+            # uno in corso più max_in_attesa_chat in fila (i click già superati non contano): scarto il nuovo
+            coroutine.close()
+            self.scartati += 1
+            if self.scartati == 1 or self.scartati % 100 == 0:
+                logger.warning("Troppi update in fila dalla chat %s: scartati finora %s", chiave, self.scartati)
+            return
+        messaggio = self.chiave_modifica(update) if self.chiave_modifica is not None else None
+        if messaggio is not None:
+            if messaggio in self._ultimi_click:
+                voce[2] += 1  # il click in fila sullo stesso messaggio ora è superato
+            self._numero_click += 1
+            numero = self._numero_click
+            self._ultimi_click[messaggio] = numero
+        voce[1] += 1
+        self.in_attesa += 1
+        self.in_attesa_max = max(self.in_attesa_max, self.in_attesa)
+        in_fila = True
+        turno = False
+        superato = False
+        try:
+            # asyncio.Lock sveglia chi aspetta in ordine di arrivo: l'ordine della chat è rispettato
+            async with voce[0]:
+                turno = True
+                if messaggio is not None and self._ultimi_click.get(messaggio) != numero:
+                    # mentre aspettava è arrivato un click più recente sullo stesso messaggio
+                    superato = True
+                    voce[2] -= 1
+                else:
+                    if messaggio is not None:
+                        del self._ultimi_click[messaggio]
+                    async with self._semaphore:
+                        self.in_attesa -= 1
+                        in_fila = False
+                        await self.do_process_update(update, coroutine)
+        finally:
+            if in_fila:
+                self.in_attesa -= 1
+                coroutine.close()  # saltato, o annullato mentre aspettava: la coroutine non è mai partita
+                if not turno and messaggio is not None and self._ultimi_click.get(messaggio) != numero:
+                    voce[2] -= 1  # superato, ma annullato prima del suo turno
+            voce[1] -= 1
+            if voce[1] == 0:
+                del self._code[chiave]
+            if messaggio is not None and self._ultimi_click.get(messaggio) == numero:
+                del self._ultimi_click[messaggio]
+        if superato:
+            self.click_unificati += 1
+            try:
+                await update.callback_query.answer()
+            except TelegramError as e:
+                logger.debug("Risposta al click saltato non riuscita: %s", e)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def statistiche(self):
+        return {
+            "chat_in_fila": len(self._code),
+            "in_attesa": self.in_attesa,
+            "in_attesa_max": self.in_attesa_max,
+            "scartati": self.scartati,
+            "click_unificati": self.click_unificati,
+        }
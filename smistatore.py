@@ -0,0 +1,260 @@
+import gc
+import os
+import hmac
+import json
+import signal
+import socket
+import struct
+import asyncio
+import logging
+import multiprocessing
+from http import HTTPStatus
+
+logger = logging.getLogger(__name__)
+
+# Dimensione massima di un update ricevuto dal webhook (byte)
+UPDATE_MAX_BYTE = 1 << 20
+# Ogni quanti secondi controllare che i worker siano vivi
+CONTROLLO_WORKER = 2.0
+# Secondi concessi a un worker per finire gli update ricevuti e uscire, poi viene interrotto
+ARRESTO_WORKER = 30.0
+
+_LUNGHEZZA = struct.Struct("!I")
+
+
+# Chiave di smistamento di un update (JSON già decodificato): la chat, o l'utente per le query inline;
+# come chiave_update di processore_update, ma senza costruire l'Update
+def chiave_json(dati):
+    for valore in dati.values():
+        if not isinstance(valore, dict):
+            continue
+        chat = valore.get("chat") or (valore.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        utente = valore.get("from") or valore.get("user")
+        if utente and "id" in utente:
+            return utente["id"]
+    return None
+
+
+# Messaggi tra smistatore e worker: lunghezza (4 byte) + corpo JSON dell'update
+async def invia_messaggio(writer, corpo):
+    writer.write(_LUNGHEZZA.pack(len(corpo)) + corpo)
+    await writer.drain()
+
+
+# Corpo del prossimo messaggio, None quando lo smistatore ha chiuso la connessione
+async def leggi_messaggio(reader):
+    try:
+        intestazione = await reader.readexactly(_LUNGHEZZA.size)
+        return await reader.readexactly(_LUNGHEZZA.unpack(intestazione)[0])
+    except asyncio.IncompleteReadError:
+        return None
+
+
+def _esegui_worker(funzione, indice, connessione, eredita, fd_da_chiudere):
+    # Il fork eredita gestori dei segnali, wakeup fd del loop e socket dello smistatore:
+    # li chiudo, altrimenti un segnale al worker sveglierebbe il loop del padre e
+    # gli altri worker non vedrebbero mai la chiusura della propria connessione
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C: l'arresto lo coordina lo smistatore
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    for fd in fd_da_chiudere:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    funzione(indice, connessione, eredita)
+
+
+class Smistatore:
+    """
+    Processo frontale del deployment multi-processo: riceve gli update dal webhook di Telegram
+    e li passa a num_worker processi creati con fork, ognuno con la propria Application.
+      - esegui_worker(indice, connessione, eredita): funzione eseguita nel worker; legge gli update
+        dalla connessione (socket) con leggi_messaggio e termina quando questa viene chiusa, dopo
+        averci scritto (invia_messaggio) un eventuale ultimo messaggio per il suo successore.
+        eredita è quel messaggio (bytes) se il worker sostituisce uno uscito così, altrimenti None
+      - percorso, segreto: come url_path e secret_token di run_webhook
+
+    I worker nascono dopo il caricamento dell'archivio nel processo frontale e non devono
+    caricarne ognuno una copia: file e indice sono un'immagine piatta (testi e array di interi,
+    mappati dallo snapshot, o costruiti prima del fork se manca) che le ricerche leggono senza
+    scriverci, quindi le sue pagine restano condivise anche sotto carico. Di proprio ogni worker
+    ha le cache e le poche strutture per cartella (elenchi, registro); gc.freeze prima del fork
+    tiene lontano da queste il garbage collector.
+    Gli update della stessa chat vanno sempre allo stesso worker, nell'ordine di arrivo.
+    """
+
+    def __init__(self, esegui_worker, num_worker, percorso="telegram", segreto=None):
+        self.esegui_worker = esegui_worker
+        self.num_worker = num_worker
+        self.percorso = "/" + percorso.strip("/")
+        self.segreto = segreto
+        self.processi = [None] * num_worker
+        self.connessioni = [None] * num_worker
+        self.lettori = [None] * num_worker
+        self.inoltrati = [0] * num_worker
+        self._turno = 0
+        self._server = None
+        self._controllo = None
+        self._in_arresto = False
+
+    # Descrittori che un nuovo worker non deve ereditare aperti: le connessioni dello smistatore
+    # (altrimenti gli altri worker non vedrebbero mai la fine della propria), gli estremi
+    # dei worker non ancora avviati e il server del webhook
+    def _fd_frontali(self, altri=()):
+        fd = [w.get_extra_info("socket").fileno() for w in self.connessioni if w is not None]
+        fd.extend(s.fileno() for s in altri)
+        if self._server is not None:
+            fd.extend(s.fileno() for s in self._server.sockets)
+        return fd
+
+    # Nuova connessione verso il worker indice: da qui gli update per lui restano nel socket finché
+    # il processo non parte. Restituisce l'estremo da passare al worker
+    async def _collega(self, indice):
+        frontale, worker = socket.socketpair()
+        self.lettori[indice], self.connessioni[indice] = await asyncio.open_connection(sock=frontale)
+        return worker
+
+    def _avvia(self, indice, worker, eredita=None, altri=()):
+        processo = multiprocessing.get_context("fork").Process(
+            target=_esegui_worker,
+            args=(self.esegui_worker, indice, worker, eredita, self._fd_frontali(altri)),
+            name=f"worker-{indice}",
+        )
+        processo.start()
+        worker.close()
+        self.processi[indice] = processo
+        logger.info("Worker %s avviato (pid %s)", indice, processo.pid)
+
+    async def avvia_worker(self):
+        """
+        Crea (o ricrea, dopo un ricaricamento) tutti i worker. Prima i vecchi finiscono gli update
+        già ricevuti ed escono, passando al successore con lo stesso indice il loro ultimo messaggio
+        (eredita); gli update che arrivano nel frattempo aspettano nelle connessioni dei nuovi, così
+        l'ordine di ogni chat resta quello di arrivo.
+        """
+        vecchi = self._attivi()
+        self.processi = [None] * self.num_worker  # il controllo non deve riavviare quelli che escono
+        estremi = [await self._collega(indice) for indice in range(self.num_worker)]
+        eredita = await self._ferma(vecchi)
+        # scongelo prima di raccogliere, così un archivio sostituito può essere liberato
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+        for indice, worker in enumerate(estremi):
+            self._avvia(indice, worker, eredita.get(indice), estremi[indice + 1:])
+        if self._controllo is None:
+            self._controllo = asyncio.create_task(self._controlla_worker())
+
+    # Worker in esecuzione come (indice, processo, lettore, writer)
+    def _attivi(self):
+        return [
+            (indice, self.processi[indice], self.lettori[indice], self.connessioni[indice])
+            for indice in range(self.num_worker) if self.processi[indice] is not None
+        ]
+
+    # Chiude le connessioni verso i worker (indice, processo, lettore, writer), che così finiscono
+    # gli update ricevuti ed escono. Restituisce indice -> ultimo messaggio di chi ne ha mandato uno
+    async def _ferma(self, worker):
+        for _, _, _, writer in worker:
+            if not writer.is_closing():
+                writer.write_eof()
+        ultimi = {}
+        for indice, processo, lettore, writer in worker:
+            try:
+                corpo = await asyncio.wait_for(leggi_messaggio(lettore), ARRESTO_WORKER)
+            except (asyncio.TimeoutError, ConnectionError):
+                corpo = None
+            if corpo:
+                ultimi[indice] = corpo
+            writer.close()
+            await asyncio.to_thread(processo.join, ARRESTO_WORKER)
+            if processo.is_alive():
+                logger.warning("Worker %s non terminato in tempo, lo interrompo", processo.pid)
+                processo.terminate()
+        return ultimi
+
+    # Un worker morto (eccezione non gestita, OOM) viene ricreato; gli update che aveva in coda sono persi
+    async def _controlla_worker(self):
+        while not self._in_arresto:
+            await asyncio.sleep(CONTROLLO_WORKER)
+            for indice, processo in enumerate(self.processi):
+                if processo is not None and not processo.is_alive() and not self._in_arresto:
+                    logger.error("Worker %s terminato (codice %s), lo riavvio", indice, processo.exitcode)
+                    self.connessioni[indice].close()
+                    self._avvia(indice, await self._collega(indice))
+
+    async def inoltra(self, corpo, chiave):
+        if chiave is None:
+            indice = self._turno
+            self._turno = (self._turno + 1) % self.num_worker
+        else:
+            indice = chiave % self.num_worker
+        self.inoltrati[indice] += 1
+        await invia_messaggio(self.connessioni[indice], corpo)
+
+    async def _gestisci(self, metodo, percorso, intestazioni, corpo):
+        if percorso.split("?", 1)[0] != self.percorso:
+            return HTTPStatus.NOT_FOUND
+        if metodo != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        ricevuto = intestazioni.get("x-telegram-bot-api-secret-token", "").encode("latin-1")
+        if self.segreto and not hmac.compare_digest(ricevuto, self.segreto.encode("utf-8")):
+            return HTTPStatus.FORBIDDEN
+        try:
+            dati = json.loads(corpo)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST
+        if not isinstance(dati, dict):
+            return HTTPStatus.BAD_REQUEST
+        await self.inoltra(corpo, chiave_json(dati))
+        return HTTPStatus.OK
+
+    # Server HTTP minimo per il webhook (connessioni keep-alive, risposta vuota appena l'update è smistato)
+    async def _servi_connessione(self, reader, writer):
+        try:
+            while True:
+                try:
+                    testa = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                prima, *righe = testa.decode("latin-1").split("\r\n")
+                metodo, percorso, _ = prima.split(" ", 2)
+                intestazioni = {}
+                for riga in righe:
+                    if ":" in riga:
+                        nome, valore = riga.split(":", 1)
+                        intestazioni[nome.strip().lower()] = valore.strip()
+                lunghezza = int(intestazioni.get("content-length", 0))
+                if lunghezza > UPDATE_MAX_BYTE:
+                    codice = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                    intestazioni["connection"] = "close"
+                else:
+                    corpo = await reader.readexactly(lunghezza)
+                    codice = await self._gestisci(metodo, percorso, intestazioni, corpo)
+                writer.write(f"HTTP/1.1 {codice.value} {codice.phrase}\r\nContent-Length: 0\r\n\r\n".encode())
+                await writer.drain()
+                if intestazioni.get("connection", "").lower() == "close":
+                    break
+        except (ValueError, ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def ascolta(self, ascolto, porta):
+        self._server = await asyncio.start_server(self._servi_connessione, ascolto, porta)
+        return self._server
+
+    async def chiudi(self):
+        """Smette di ricevere update, poi chiude i worker lasciando finire quelli già smistati."""
+        self._in_arresto = True
+        if self._server is not None:
+            self._server.close()
+        if self._controllo is not None:
+            self._controllo.cancel()
+        await self._ferma(self._attivi())
+        logger.info("Update smistati per worker: %s", self.inoltrati)